@@ -456,8 +456,8 @@ def get_unit_amplitudes(recording, sorting, unit_ids=None, method='absolute', sa
             indices = np.arange(len(spike_train))
         spike_train = spike_train[indices]
 
-        snippets = recording.get_snippets(reference_frames=spike_train,
-                                          snippet_len=[frames_before, frames_after])
+        snippets = _get_snippets(recording, reference_frames=spike_train,
+                                 snippet_len=[frames_before, frames_after])
         if peak == 'both':
             amps = np.max(np.abs(snippets), axis=-1)
             if len(amps.shape) > 1:
@@ -864,12 +864,36 @@ def _get_random_spike_waveforms(recording, sorting, unit, max_spikes_per_unit, s
     else:
         event_indices = range(num_events)
 
-    spikes = recording.get_snippets(reference_frames=st[event_indices].astype('int64'),
-                                    snippet_len=snippet_len, channel_ids=channel_ids)
+    spikes = _get_snippets(recording, reference_frames=st[event_indices].astype('int64'),
+                           snippet_len=snippet_len, channel_ids=channel_ids)
     spikes = np.dstack(tuple(spikes))
     return spikes, event_indices
 
 
+def _get_snippets(recording, reference_frames, snippet_len, channel_ids=None):
+    # Same as recording.get_snippets, but preprocessed recordings read all snippets with batched reads
+    if not hasattr(recording, 'get_traces_multi'):
+        return recording.get_snippets(reference_frames=reference_frames, snippet_len=snippet_len,
+                                      channel_ids=channel_ids)
+    if isinstance(snippet_len, (tuple, list, np.ndarray)):
+        snippet_len_before = int(snippet_len[0])
+        snippet_len_after = int(snippet_len[1])
+    else:
+        snippet_len_before = int((snippet_len + 1) / 2)
+        snippet_len_after = int(snippet_len) - snippet_len_before
+    if channel_ids is None:
+        channel_ids = recording.get_channel_ids()
+    reference_frames = np.asarray(reference_frames, dtype='int64')
+    snippets = np.zeros((len(reference_frames), len(channel_ids), snippet_len_before + snippet_len_after))
+    valid = (reference_frames >= 0) & (reference_frames < recording.get_num_frames())
+    windows = np.vstack((reference_frames[valid] - snippet_len_before,
+                         reference_frames[valid] + snippet_len_after)).T
+    traces_list = recording.get_traces_multi(windows=windows, channel_ids=channel_ids)
+    if len(traces_list) > 0:
+        snippets[valid] = traces_list
+    return snippets
+
+
 def _get_spike_times_clusters(sorting):
     if not isinstance(sorting, se.SortingExtractor):
         raise AttributeError()
@@ -1 +1,3 @@
 from .preprocessinglist import *
+from .pipeline import Pipeline
+from .streaming import StreamingPipeline
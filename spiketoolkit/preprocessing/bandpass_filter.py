@@ -1,4 +1,4 @@
-from .filterrecording import FilterRecording
+from .filterrecording import FilterRecording, _sos_filtfilt, _sos_filt, _check_sos_stability, _get_sos_padding
 import numpy as np
 from scipy import special
 import spikeextractors as se
@@ -9,10 +9,17 @@ try:
 except ImportError:
     HAVE_BFR = False
 
+try:
+    import scipy.fft
+    HAVE_SCIPY_FFT = True
+except ImportError:
+    HAVE_SCIPY_FFT = False
+
 
 class BandpassFilterRecording(FilterRecording):
 
     preprocessor_name = 'BandpassFilter'
+    _allow_direct_filtering = True
     installed = HAVE_BFR  # check at class level if installed or not
     preprocessor_gui_params = [
         {'name': 'freq_min', 'type': 'float', 'value': 300.0, 'default': 300.0, 'title': "High-pass frequency"},
@@ -25,11 +32,24 @@ class BandpassFilterRecording(FilterRecording):
             "Chunk size for the filter."},
         {'name': 'cache_chunks', 'type': 'bool', 'value': False, 'default': False, 'title':
             "If True fileterd chunk traces are computed and cached in memory"},
+        {'name': 'cache_folder', 'type': 'str', 'value': None, 'default': None, 'title':
+            "If given, filtered chunks are cached lazily in a memory-mapped file in this folder"},
+        {'name': 'n_jobs', 'type': 'int', 'value': 1, 'default': 1, 'title':
+            "Number of threads used to filter chunks in parallel"},
+        {'name': 'prefetch_chunks', 'type': 'int', 'value': 0, 'default': 0, 'title':
+            "Number of chunks filtered ahead in the background during sequential reads"},
+        {'name': 'fft_workers', 'type': 'int', 'value': 1, 'default': 1, 'title':
+            "Number of workers used by each FFT (when type is 'fft')"},
+        {'name': 'dtype', 'type': 'dtype', 'value': None, 'default': None, 'title':
+            "Traces dtype. If None, dtype is maintained."},
+        {'name': 'causal', 'type': 'bool', 'value': False, 'default': False, 'title':
+            "If True, the filter is applied forward only (causal), warmed up on the padding of each chunk"},
     ]
     installation_mesg = "To use the BandpassFilterRecording, install scipy: \n\n pip install scipy\n\n"  # err
 
     def __init__(self, recording, freq_min=300, freq_max=6000, freq_wid=1000, type='fft', order=3,
-                 chunk_size=30000, cache_chunks=False):
+                 chunk_size=30000, cache_chunks=False, cache_folder=None, n_jobs=1, prefetch_chunks=0,
+                 fft_workers=1, dtype=None, causal=False):
         assert HAVE_BFR, "To use the BandpassFilterRecording, install scipy: \n\n pip install scipy\n\n"
         self._freq_min = freq_min
         self._freq_max = freq_max
@@ -37,61 +57,82 @@ class BandpassFilterRecording(FilterRecording):
         self._type = type
         self._order = order
         self._chunk_size = chunk_size
+        self._fft_workers = fft_workers
+        self._kernels = dict()
+        if causal and self._type != 'butter':
+            raise ValueError("'causal' filtering is only available for the 'butter' type")
 
         if self._type == 'butter':
             fn = recording.get_sampling_frequency() / 2.
             band = np.array([self._freq_min, self._freq_max]) / fn
 
-            self._b, self._a = ss.butter(self._order, band, btype='bandpass')
-
-            if not np.all(np.abs(np.roots(self._a)) < 1):
-                raise ValueError('Filter is not stable')
-        FilterRecording.__init__(self, recording=recording, chunk_size=chunk_size, cache_chunks=cache_chunks)
+            self._sos = ss.butter(self._order, band, btype='bandpass', output='sos')
+            _check_sos_stability(self._sos)
+            self._padding = _get_sos_padding(self._sos)
+        else:
+            self._padding = 3000
+        self._causal = causal
+        FilterRecording.__init__(self, recording=recording, chunk_size=chunk_size, cache_chunks=cache_chunks,
+                                 cache_folder=cache_folder, n_jobs=n_jobs, prefetch_chunks=prefetch_chunks,
+                                 dtype=dtype)
         self.copy_channel_properties(recording)
 
-    def filter_chunk(self, *, start_frame, end_frame):
-        padding = 3000
-        i1 = start_frame - padding
-        i2 = end_frame + padding
-        padded_chunk = self._read_chunk(i1, i2)
+    def _get_filter_params(self):
+        return {'freq_min': self._freq_min, 'freq_max': self._freq_max, 'freq_wid': self._freq_wid,
+                'type': self._type, 'order': self._order, 'causal': self._causal}
+
+    def _get_dependent_channel_ids(self, channel_ids):
+        return channel_ids
+
+    def filter_chunk(self, *, start_frame, end_frame, channel_ids=None):
+        if self._causal:
+            return self._filter_chunk_causal(start_frame, end_frame, channel_ids)
+        i1 = start_frame - self._padding
+        i2 = end_frame + self._padding
+        padded_chunk = self._read_chunk(i1, i2, channel_ids, dtype=self._get_filter_dtype())
         filtered_padded_chunk = self._do_filter(padded_chunk)
         return filtered_padded_chunk[:, start_frame - i1:end_frame - i1]
 
+    def _process_traces(self, traces):
+        # used by Pipeline: filters traces already padded by self._padding
+        if self._causal:
+            # the padding before the chunk warms up the filter
+            return _sos_filt(self._sos, traces)
+        return self._do_filter(traces)
+
     def _do_filter(self, chunk):
-        sampling_frequency = self._recording.get_sampling_frequency()
-        M = chunk.shape[0]
         chunk2 = chunk
         # Do the actual filtering with a DFT with real input
         if self._type == 'fft':
-            chunk_fft = np.fft.rfft(chunk2)
-            kernel = _create_filter_kernel(
-                chunk2.shape[1],
-                sampling_frequency,
-                self._freq_min, self._freq_max, self._freq_wid
-            )
-            kernel = kernel[0:chunk_fft.shape[1]]  # because this is the DFT of real data
-            chunk_fft = chunk_fft * np.tile(kernel, (M, 1))
-            chunk_filtered = np.fft.irfft(chunk_fft)
+            N = chunk2.shape[1]
+            if HAVE_SCIPY_FFT:
+                # zero-pad to a length with small prime factors, the padding is discarded after the inverse FFT
+                nfft = scipy.fft.next_fast_len(N, real=True)
+                chunk_fft = scipy.fft.rfft(chunk2, n=nfft, axis=1, workers=self._fft_workers)
+            else:
+                nfft = N
+                chunk_fft = np.fft.rfft(chunk2, axis=1)
+            kernel = self._get_filter_kernel(nfft, chunk_fft.real.dtype)
+            chunk_fft *= kernel[np.newaxis, :]
+            if HAVE_SCIPY_FFT:
+                chunk_filtered = scipy.fft.irfft(chunk_fft, n=nfft, axis=1, workers=self._fft_workers)
+            else:
+                chunk_filtered = np.fft.irfft(chunk_fft, n=nfft, axis=1)
+            chunk_filtered = chunk_filtered[:, :N]
         elif self._type == 'butter':
-            chunk_filtered = ss.filtfilt(self._b, self._a, chunk2, axis=1)
+            chunk_filtered = _sos_filtfilt(self._sos, chunk2)
 
         return chunk_filtered
 
-    def _read_chunk(self, i1, i2):
-        M = len(self._recording.get_channel_ids())
-        N = self._recording.get_num_frames()
-        if i1 < 0:
-            i1b = 0
-        else:
-            i1b = i1
-        if i2 > N:
-            i2b = N
-        else:
-            i2b = i2
-        ret = np.zeros((M, i2 - i1))
-        ret[:, i1b - i1:i2b - i1] = self._recording.get_traces(start_frame=i1b, end_frame=i2b)
+    def _get_filter_kernel(self, N, dtype):
+        # kernels only depend on the (padded) chunk length, so they are computed once per length
+        key = (N, np.dtype(dtype).str)
+        if key not in self._kernels:
+            kernel = _create_filter_kernel(N, self._recording.get_sampling_frequency(),
+                                           self._freq_min, self._freq_max, self._freq_wid)
+            self._kernels[key] = kernel[:N // 2 + 1].astype(dtype)  # because this is the DFT of real data
+        return self._kernels[key]
 
-        return ret
 
 
 def _create_filter_kernel(N, sampling_frequency, freq_min, freq_max, freq_wid=1000):
@@ -118,7 +159,8 @@ def _create_filter_kernel(N, sampling_frequency, freq_min, freq_max, freq_wid=10
 
 
 def bandpass_filter(recording, freq_min=300, freq_max=6000, freq_wid=1000, type='fft', order=3,
-                    chunk_size=30000, cache_to_file=False, cache_chunks=False):
+                    chunk_size=30000, cache_to_file=False, cache_chunks=False, cache_folder=None, n_jobs=1,
+                    prefetch_chunks=0, fft_workers=1, dtype=None, causal=False):
     '''
     Performs a lazy filter on the recording extractor traces.
 
@@ -134,15 +176,37 @@ def bandpass_filter(recording, freq_min=300, freq_max=6000, freq_wid=1000, type=
         Width of the filter (when type is 'fft').
     type: str
         'fft' or 'butter'. The 'fft' filter uses a kernel in the frequency domain. The 'butter' filter uses
-        scipy butter and filtfilt functions.
+        scipy butter (as second-order sections) and sosfiltfilt functions. Chunks are padded by the length of the
+        impulse response of the butter filter.
     order: int
         Order of the filter (if 'butter').
     chunk_size: int
         The chunk size to be used for the filtering.
     cache_to_file: bool (default False).
         If True, filtered traces are computed and cached all at once on disk in temp file 
-    cache_chunks: bool (default False).
-        If True then each chunk is cached in memory (in a dict)
+    cache_chunks: bool or FilteredChunkCache (default False).
+        If True then each chunk is cached in memory (in a least-recently-used cache). A FilteredChunkCache can be
+        passed to share the same memory budget between several filters.
+    cache_folder: str or None (default None).
+        If given, each filtered chunk is written once in a memory-mapped file in this folder. The file is identified
+        by the parent recording and the filter parameters, so it is reused (without filtering again) by later
+        processes or sessions. Unlike 'cache_to_file', chunks are filtered lazily when they are first requested.
+    n_jobs: int (default 1).
+        Number of threads used to filter in parallel the chunks of a request spanning several chunks
+    prefetch_chunks: int (default 0).
+        Number of following chunks filtered in the background after each request, to speed up sequential reads
+        (e.g. writing the filtered recording to file)
+    fft_workers: int (default 1).
+        Number of workers used by each FFT (when type is 'fft'). It requires scipy.fft (scipy>=1.4).
+    dtype: dtype or None (default None).
+        The dtype of the returned traces. If None, the dtype of the parent recording is maintained. Traces are
+        filtered in float32, unless dtype is a 64-bit type.
+    causal: bool (default False).
+        If True (only for the 'butter' type), the filter is applied forward only (scipy sosfilt) instead of forward and backward, so that each
+        output sample only depends on the past samples (e.g. for online use), at the cost of a phase delay. Each
+        chunk warms up the filter from a zero state on the preceding padding samples (the filter state is not
+        carried between chunks), so that results do not depend on the read order or on n_jobs. They match a
+        single pass of sosfilt over the recording up to the truncation of the impulse response.
     Returns
     -------
     filter_recording: BandpassFilterRecording
@@ -150,6 +214,7 @@ def bandpass_filter(recording, freq_min=300, freq_max=6000, freq_wid=1000, type=
     '''
     if cache_to_file:
         assert not cache_chunks, 'if cache_to_file cache_chunks should be False'
+        assert cache_folder is None, 'if cache_to_file cache_folder should be None'
     
     bpf_recording = BandpassFilterRecording(
         recording=recording,
@@ -160,6 +225,12 @@ def bandpass_filter(recording, freq_min=300, freq_max=6000, freq_wid=1000, type=
         order=order,
         chunk_size=chunk_size,
         cache_chunks=cache_chunks,
+        cache_folder=cache_folder,
+        n_jobs=n_jobs,
+        prefetch_chunks=prefetch_chunks,
+        fft_workers=fft_workers,
+        dtype=dtype,
+        causal=causal
     )
     if cache_to_file:
         return se.CacheRecordingExtractor(bpf_recording, chunk_size=chunk_size)
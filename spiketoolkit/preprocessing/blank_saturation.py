@@ -1,5 +1,7 @@
 from spikeextractors import RecordingExtractor
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+from .preprocessing_tools import get_traces_multi, get_quantiles
 
 
 class BlankSaturationRecording(RecordingExtractor):
@@ -10,15 +12,26 @@ class BlankSaturationRecording(RecordingExtractor):
          'title': "Scale for the output distribution"},
         {'name': 'seed', 'type': 'int', 'value': 0, 'default': 0, 
          'title': "Random seed for reproducibility."},
+        {'name': 'scan', 'type': 'bool', 'value': False, 'default': False,
+         'title': "If True, the saturated intervals of each channel are found once by scanning the recording"},
+        {'name': 'chunk_size', 'type': 'int', 'value': 30000, 'default': 30000,
+         'title': "Chunk size for the scan (and the quantiles, if 'fraction' is given)"},
+        {'name': 'n_jobs', 'type': 'int', 'value': 1, 'default': 1,
+         'title': "Number of threads used for the scan and the quantiles"},
+        {'name': 'fraction', 'type': 'float', 'value': None, 'default': None,
+         'title': "If given, fraction of the recording scanned to estimate the quantiles (otherwise 50 random snippets)"},
     ]
     installation_mesg = ""  # err
 
-    def __init__(self, recording, threshold=None, seed=0):
+    def __init__(self, recording, threshold=None, seed=0, scan=False, chunk_size=30000, n_jobs=1, fraction=None):
         if not isinstance(recording, RecordingExtractor):
             raise ValueError("'recording' must be a RecordingExtractor")
         self._recording = recording
-        random_data = self._get_random_data_for_scaling(seed=seed).ravel()
-        q = np.quantile(random_data, [0.001, 0.5, 1 - 0.001])
+        if fraction is None:
+            q = get_quantiles(recording, [0.001, 0.5, 1 - 0.001], seed=seed, n_jobs=n_jobs)
+        else:
+            q = get_quantiles(recording, [0.001, 0.5, 1 - 0.001], fraction=fraction, chunk_size=chunk_size, seed=seed,
+                              n_jobs=n_jobs)
         if 2 * q[1] - q[0] - q[2] < 2 * np.min([q[1] - q[0], q[2] - q[1]]):
             print('Warning, narrow signal range suggests artefact-free data.')
         self._median = q[1]
@@ -35,19 +48,13 @@ class BlankSaturationRecording(RecordingExtractor):
                 self._lower = False
             else:
                 self._lower = True
+        if scan:
+            self._saturation_intervals = self._scan_saturation(chunk_size=chunk_size, n_jobs=n_jobs)
+        else:
+            self._saturation_intervals = None
         RecordingExtractor.__init__(self)
         self.copy_channel_properties(recording=self._recording)
 
-    def _get_random_data_for_scaling(self, num_chunks=50, chunk_size=500, seed=0):
-        N = self._recording.get_num_frames()
-        random_ints = np.random.RandomState(seed=seed).randint(0, N - chunk_size, size=num_chunks)
-        chunk_list = []
-        for ff in random_ints:
-            chunk = self._recording.get_traces(start_frame=ff,
-                                               end_frame=ff + chunk_size)
-            chunk_list.append(chunk)
-        return np.concatenate(chunk_list, axis=1)
-
     def get_sampling_frequency(self):
         return self._recording.get_sampling_frequency()
 
@@ -64,17 +71,112 @@ class BlankSaturationRecording(RecordingExtractor):
             end_frame = self.get_num_frames()
         if channel_ids is None:
             channel_ids = self.get_channel_ids()
+        if isinstance(channel_ids, (int, np.integer)):
+            channel_ids = [channel_ids]
         traces = self._recording.get_traces(channel_ids=channel_ids,
                                             start_frame=start_frame,
                                             end_frame=end_frame)
+        # the traces of the parent recording (which can be a view of its data) are copied only if they are blanked
+        if self._saturation_intervals is not None:
+            copied = False
+            for i, chan in enumerate(channel_ids):
+                intervals = self._saturation_intervals[chan]
+                i1 = np.searchsorted(intervals[:, 1], start_frame, side='right')
+                i2 = np.searchsorted(intervals[:, 0], end_frame, side='left')
+                if i2 > i1 and not copied:
+                    traces = traces.copy()
+                    copied = True
+                for (interval_start, interval_end) in intervals[i1:i2]:
+                    traces[i, max(interval_start - start_frame, 0):interval_end - start_frame] = self._median
+        else:
+            mask = self._get_saturation_mask(traces)
+            if np.any(mask):
+                traces = traces.copy()
+                traces[mask] = self._median
+        return traces
+
+    def get_saturation_intervals(self, channel_id=None):
+        '''
+        Returns the saturated intervals found by the scan (scan=True).
+
+        Parameters
+        ----------
+        channel_id: int or None
+            If given, only the intervals of this channel are returned
+
+        Returns
+        -------
+        saturation_intervals: dict or np.array
+            (num_intervals, 2) array of sorted [start_frame, end_frame) saturated intervals of the channel, or dict
+            with the arrays of all channels
+        '''
+        assert self._saturation_intervals is not None, "Saturated intervals are only available with 'scan=True'"
+        if channel_id is not None:
+            return self._saturation_intervals[channel_id]
+        return dict(self._saturation_intervals)
+
+    def is_saturated(self, frames, channel_id):
+        '''
+        Returns a boolean array which is True for the frames (e.g. spike frames) in a saturated interval of the
+        channel (scan=True), without reading traces.
+        '''
+        intervals = self.get_saturation_intervals(channel_id)
+        frames = np.asarray(frames)
+        if len(intervals) == 0:
+            return np.zeros(frames.shape, dtype='bool')
+        # last interval starting at or before each frame
+        idx = np.searchsorted(intervals[:, 0], frames, side='right') - 1
+        return (idx >= 0) & (frames < intervals[np.maximum(idx, 0), 1])
+
+    def _get_saturation_mask(self, traces):
         if self._lower:
-            traces[traces <= self._threshold] = self._median
+            return traces <= self._threshold
+        else:
+            return traces >= self._threshold
+
+    def _scan_saturation(self, chunk_size, n_jobs):
+        # finds the runs of saturated frames of each channel, chunk by chunk (in parallel if n_jobs > 1)
+        channel_ids = self._recording.get_channel_ids()
+        num_frames = self._recording.get_num_frames()
+
+        def _scan_chunk(start_frame):
+            traces = self._recording.get_traces(start_frame=start_frame,
+                                                end_frame=min(start_frame + chunk_size, num_frames))
+            edges = np.diff(self._get_saturation_mask(traces).astype('int8'), axis=1, prepend=0, append=0)
+            rows, starts = np.nonzero(edges == 1)
+            _, ends = np.nonzero(edges == -1)
+            return rows, starts + start_frame, ends + start_frame
+
+        chunk_starts = range(0, num_frames, chunk_size)
+        if n_jobs > 1:
+            with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                results = list(executor.map(_scan_chunk, chunk_starts))
         else:
-            traces[traces >= self._threshold] = self._median
+            results = [_scan_chunk(start_frame) for start_frame in chunk_starts]
+        rows = np.concatenate([r[0] for r in results])
+        starts = np.concatenate([r[1] for r in results])
+        ends = np.concatenate([r[2] for r in results])
+
+        saturation_intervals = {}
+        for i, chan in enumerate(channel_ids):
+            chan_starts = starts[rows == i]
+            chan_ends = ends[rows == i]
+            # runs split by chunk boundaries are merged
+            split = np.nonzero(chan_starts[1:] == chan_ends[:-1])[0]
+            chan_starts = np.delete(chan_starts, split + 1)
+            chan_ends = np.delete(chan_ends, split)
+            saturation_intervals[chan] = np.stack([chan_starts, chan_ends], axis=1).astype('int64')
+        return saturation_intervals
+
+    def _process_traces(self, traces):
+        traces[self._get_saturation_mask(traces)] = self._median
         return traces
 
+    def get_traces_multi(self, windows, channel_ids=None):
+        return get_traces_multi(self, windows=windows, channel_ids=channel_ids)
+
 
-def blank_saturation(recording, threshold=None, seed=0):
+def blank_saturation(recording, threshold=None, seed=0, scan=False, chunk_size=30000, n_jobs=1, fraction=None):
     '''
     Find and remove parts of the signal with extereme values. Some arrays
     may produce these when amplifiers enter saturation, typically for
@@ -96,6 +198,17 @@ def blank_saturation(recording, threshold=None, seed=0):
         If `None`, the threshold will be determined from the 0.1 signal percentile.
     seed: int
         Random seed for reproducibility
+    scan: bool
+        If True, the recording is scanned once (chunk by chunk) to find the saturated intervals of each channel. Reads
+        then blank these intervals without comparing the traces to the threshold, and the intervals are available
+        with get_saturation_intervals() and is_saturated() (e.g. to discard spikes in saturated periods).
+    chunk_size: int
+        Chunk size for the scan (and the estimation of the quantiles, if 'fraction' is given)
+    n_jobs: int
+        Number of threads used for the scan and the estimation of the quantiles
+    fraction: float or None
+        If given, this fraction (between 0 and 1) of the recording is scanned to estimate the quantiles. Otherwise,
+        they are estimated on 50 random snippets of 500 frames.
     Returns
     -------
     rescaled_traces: BlankSaturationRecording
@@ -104,5 +217,9 @@ def blank_saturation(recording, threshold=None, seed=0):
     return BlankSaturationRecording(
         recording=recording, 
         threshold=threshold,
-        seed=seed
+        seed=seed,
+        scan=scan,
+        chunk_size=chunk_size,
+        n_jobs=n_jobs,
+        fraction=fraction
     )
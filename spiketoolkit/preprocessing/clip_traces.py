@@ -1,8 +1,7 @@
-from spikeextractors import RecordingExtractor
-import numpy as np
+from .elementwiserecording import ElementwiseRecording
 
 
-class ClipTracesRecording(RecordingExtractor):
+class ClipTracesRecording(ElementwiseRecording):
     preprocessor_name = 'ClipTraces'
     installed = True  # check at class level if installed or not
     preprocessor_gui_params = [
@@ -10,45 +9,18 @@ class ClipTracesRecording(RecordingExtractor):
          'title': "Minimum value. If `None`, clipping is not performed on lower interval edge."},
         {'name': 'a_max', 'type': 'float',
          'title': "Maximum value. If `None`, clipping is not performed on upper interval edge."},
+        {'name': 'dtype', 'type': 'dtype', 'value': None, 'default': None,
+         'title': "Traces dtype. If None, dtype is maintained."},
     ]
     installation_mesg = ""  # err
 
-    def __init__(self, recording, a_min=None, a_max=None):
-        if not isinstance(recording, RecordingExtractor):
-            raise ValueError("'recording' must be a RecordingExtractor")
-        self._recording = recording
+    def __init__(self, recording, a_min=None, a_max=None, dtype=None):
         self._a_min = a_min
         self._a_max = a_max
-        RecordingExtractor.__init__(self)
-        self.copy_channel_properties(recording=self._recording)
+        ElementwiseRecording.__init__(self, recording=recording, operations=[('clip', a_min, a_max)], dtype=dtype)
 
-    def get_sampling_frequency(self):
-        return self._recording.get_sampling_frequency()
 
-    def get_num_frames(self):
-        return self._recording.get_num_frames()
-
-    def get_channel_ids(self):
-        return self._recording.get_channel_ids()
-
-    def get_traces(self, channel_ids=None, start_frame=None, end_frame=None):
-        if start_frame is None:
-            start_frame = 0
-        if end_frame is None:
-            end_frame = self.get_num_frames()
-        if channel_ids is None:
-            channel_ids = self.get_channel_ids()
-        traces = self._recording.get_traces(channel_ids=channel_ids,
-                                            start_frame=start_frame,
-                                            end_frame=end_frame)
-        if self._a_min is not None:
-            traces[traces < self._a_min] = self._a_min
-        if self._a_max is not None:
-            traces[traces > self._a_max] = self._a_max
-        return traces
-
-
-def clip_traces(recording, a_min=None, a_max=None):
+def clip_traces(recording, a_min=None, a_max=None, dtype=None):
     '''
     Limit the values of the data between a_min and a_max. Values exceeding the
     range will be set to the minimum or maximum, respectively.
@@ -57,12 +29,14 @@ def clip_traces(recording, a_min=None, a_max=None):
     ----------
     recording: RecordingExtractor
         The recording extractor to be transformed
-    a_min: float or `None` (default `None`)
-        Minimum value. If `None`, clipping is not performed on lower
+    a_min: float, array-like or `None` (default `None`)
+        Minimum value (or one value per channel). If `None`, clipping is not performed on lower
         interval edge.
-    a_max: float or `None` (default `None`)
-        Maximum value. If `None`, clipping is not performed on upper
+    a_max: float, array-like or `None` (default `None`)
+        Maximum value (or one value per channel). If `None`, clipping is not performed on upper
         interval edge.
+    dtype: dtype
+        The dtype of the returned traces. If None, dtype is maintained.
 
     Returns
     -------
@@ -70,5 +44,5 @@ def clip_traces(recording, a_min=None, a_max=None):
         The clipped traces recording extractor object
     '''
     return ClipTracesRecording(
-        recording=recording, a_min=a_min, a_max=a_max
+        recording=recording, a_min=a_min, a_max=a_max, dtype=dtype
     )
@@ -1,5 +1,12 @@
 from spikeextractors import RecordingExtractor
 import numpy as np
+from .preprocessing_tools import get_traces_multi
+
+try:
+    from scipy.spatial import cKDTree
+    HAVE_KDTREE = True
+except ImportError:
+    HAVE_KDTREE = False
 
 
 class CommonReferenceRecording(RecordingExtractor):
@@ -7,7 +14,7 @@ class CommonReferenceRecording(RecordingExtractor):
     installed = True  # check at class level if installed or not
     preprocessor_gui_params = [
         {'name': 'reference', 'type': 'str', 'value': 'median', 'default': 'median',
-         'title': "Reference type ('median', 'average', or 'single')"},
+         'title': "Reference type ('median', 'average', 'single', or 'local')"},
         {'name': 'groups', 'type': 'int_list_list', 'value': None, 'default': None, 'title': "List of int lists containins the channels for splitting the reference, \
         The CMR, CAR, or referencing with respect to single channels are applied group-wise. It is useful when dealing with different channel groups, e.g. multiple tetrodes."},
         {'name': 'ref_channels', 'type': 'int_list', 'value': None, 'default': None, 'title': "If no 'groups' are specified, all channels are referenced to 'ref_channels'. \
@@ -15,15 +22,18 @@ class CommonReferenceRecording(RecordingExtractor):
         {'name': 'dtype', 'type': 'dtype', 'value': None, 'default': None,
          'title': "Traces dtype. If None, dtype is maintained."},
         {'name': 'verbose', 'type': 'bool', 'value': False, 'default': False,
-         'title': "If True, then the function will be verbose"}
+         'title': "If True, then the function will be verbose"},
+        {'name': 'local_radius', 'type': 'float_list', 'value': [30, 55], 'default': [30, 55],
+         'title': "Inner and outer radius of the annulus of neighbouring channels (if 'local')"},
     ]
     installation_mesg = ""  # err
 
-    def __init__(self, recording, reference='median', groups=None, ref_channels=None, dtype=None, verbose=False):
+    def __init__(self, recording, reference='median', groups=None, ref_channels=None, dtype=None, verbose=False,
+                 local_radius=(30, 55)):
         if not isinstance(recording, RecordingExtractor):
             raise ValueError("'recording' must be a RecordingExtractor")
-        if reference != 'median' and reference != 'average' and reference != 'single':
-            raise ValueError("'reference' must be either 'median' or 'average'")
+        if reference not in ['median', 'average', 'single', 'local']:
+            raise ValueError("'reference' must be either 'median', 'average', 'single', or 'local'")
         self._recording = recording
         self._ref = reference
         self._groups = groups
@@ -39,11 +49,28 @@ class CommonReferenceRecording(RecordingExtractor):
                     assert isinstance(ref_channels, (int, np.integer)), "'ref_channels' must be int"
                     ref_channels = [ref_channels]
         self._ref_channel = ref_channels
+        self._local_radius = local_radius
         if dtype is None:
             self._dtype = recording.get_dtype()
         else:
             self._dtype = dtype
         self.verbose = verbose
+        # groups (restricted to the channels of the recording) and their reference channel, as indices of the
+        # channels of the recording
+        recording_channel_ids = recording.get_channel_ids()
+        recording_channel_set = set(recording_channel_ids)
+        if self._groups is None:
+            ref_groups = [recording_channel_ids]
+        else:
+            ref_groups = self._groups
+        self._ref_groups = [[chan for chan in group if chan in recording_channel_set] for group in ref_groups]
+        if self._ref == 'single':
+            self._ref_group_channels = list(self._ref_channel)
+        else:
+            self._ref_group_channels = [None] * len(self._ref_groups)
+        if self._ref == 'local':
+            self._local_neighbours = self._compute_local_neighbours()
+        self._group_idx, self._ref_idx = self._get_reference_indices(recording_channel_ids)
         RecordingExtractor.__init__(self)
         self.copy_channel_properties(recording=self._recording)
 
@@ -65,82 +92,159 @@ class CommonReferenceRecording(RecordingExtractor):
             channel_ids = self.get_channel_ids()
         if isinstance(channel_ids, (int, np.integer)):
             channel_ids = [channel_ids]
-        if self._ref == 'median':
-            if self._groups is None:
-                if self.verbose:
-                    print('Common median reference using all channels')
-                traces = self._recording.get_traces(start_frame=start_frame, end_frame=end_frame)
-                traces = traces - np.median(traces, axis=0, keepdims=True)
-                return traces[channel_ids].astype(self._dtype)
+        if self.verbose:
+            if self._ref == 'single':
+                print('Reference', self._ref_groups, 'to channels', self._ref_channel)
+            elif self._ref == 'local':
+                print('Local median reference with radius', self._local_radius)
             else:
-                new_groups = []
-                for g in self._groups:
-                    new_chans = []
-                    for chan in g:
-                        if chan in self._recording.get_channel_ids():
-                            new_chans.append(chan)
-                    new_groups.append(new_chans)
-                if self.verbose:
-                    print('Common median in groups: ', new_groups)
-                traces = np.vstack(np.array([self._recording.get_traces(channel_ids=split_group,
-                                                                        start_frame=start_frame, end_frame=end_frame)
-                                             - np.median(self._recording.get_traces(channel_ids=split_group,
-                                                                                    start_frame=start_frame,
-                                                                                    end_frame=end_frame),
-                                                         axis=0, keepdims=True) for split_group in new_groups]))
-                return traces[channel_ids].astype(self._dtype)
-        elif self._ref == 'average':
-            if self.verbose:
-                print('Common average reference using all channels')
-            if self._groups is None:
-                traces = self._recording.get_traces(start_frame=start_frame, end_frame=end_frame)
-                traces = traces - np.mean(traces, axis=0, keepdims=True)
-                return traces[channel_ids].astype(self._dtype)
+                print('Common', self._ref, 'reference in groups:', self._ref_groups)
+        # the traces of all the channels needed are read at once and re-referenced in place
+        read_channel_ids = self._get_dependent_channel_ids(channel_ids)
+        raw_traces = self._recording.get_traces(channel_ids=read_channel_ids, start_frame=start_frame,
+                                                end_frame=end_frame)
+        # float32 is enough for outputs up to 32 bits (e.g. int16 data), float64 is kept otherwise
+        if np.dtype(self._dtype).itemsize <= 4 and raw_traces.dtype.itemsize <= 4:
+            traces = raw_traces.astype('float32')
+        else:
+            traces = raw_traces.astype('float64')
+        if len(read_channel_ids) == self._recording.get_num_channels():
+            group_idx, ref_idx = self._group_idx, self._ref_idx
+        else:
+            group_idx, ref_idx = self._get_reference_indices(read_channel_ids)
+        # medians are computed on the raw traces, so that integer data is partitioned in its own dtype
+        traces = self._reference_traces(traces, group_idx, ref_idx, raw_traces=raw_traces)
+        if list(read_channel_ids) != list(channel_ids):
+            read_channel_idx = {chan: i for i, chan in enumerate(read_channel_ids)}
+            traces = traces[[read_channel_idx[chan] for chan in channel_ids]]
+        return traces.astype(self._dtype, copy=False)
+
+    def _compute_local_neighbours(self):
+        # channels in the annulus (inner radius <= distance <= outer radius) around each channel, within its group
+        assert HAVE_KDTREE, "To use the 'local' reference, install scipy: \n\n pip install scipy\n\n"
+        channel_ids = self._recording.get_channel_ids()
+        locations = np.array(self._recording.get_channel_locations(channel_ids), dtype='float64')
+        inner_radius, outer_radius = self._local_radius
+        channel_group = {}
+        for i, group in enumerate(self._ref_groups):
+            for chan in group:
+                channel_group[chan] = i
+        tree = cKDTree(locations)
+        neighbours = {}
+        for i, (chan, idx) in enumerate(zip(channel_ids, tree.query_ball_point(locations, r=outer_radius))):
+            idx = np.sort(np.array(idx, dtype='int64'))
+            distances = np.linalg.norm(locations[idx] - locations[i], axis=1)
+            neighbours[chan] = [channel_ids[j] for j, distance in zip(idx, distances)
+                                if j != i and distance >= inner_radius and chan in channel_group and
+                                channel_group.get(channel_ids[j]) == channel_group[chan]]
+        return neighbours
+
+    def _get_reference_indices(self, channel_ids):
+        # indices (slices for contiguous groups) in 'channel_ids' of the groups with at least one channel in
+        # 'channel_ids', and of their reference channels
+        channel_idx = {chan: i for i, chan in enumerate(channel_ids)}
+        if self._ref == 'local':
+            return self._get_local_reference_indices(channel_idx)
+        group_idx = []
+        ref_idx = []
+        for group, ref in zip(self._ref_groups, self._ref_group_channels):
+            idx = [channel_idx[chan] for chan in group if chan in channel_idx]
+            if len(idx) == 0:
+                continue
+            if idx == list(range(idx[0], idx[-1] + 1)):
+                group_idx.append(slice(idx[0], idx[-1] + 1))
             else:
-                new_groups = []
-                for g in self._groups:
-                    new_chans = []
-                    for chan in g:
-                        if chan in self._recording.get_channel_ids():
-                            new_chans.append(chan)
-                    new_groups.append(new_chans)
-                if self.verbose:
-                    print('Common average in groups: ', new_groups)
-                traces = np.vstack(np.array([self._recording.get_traces(channel_ids=split_group,
-                                                                        start_frame=start_frame, end_frame=end_frame)
-                                             - np.mean(self._recording.get_traces(channel_ids=split_group,
-                                                                                  start_frame=start_frame,
-                                                                                  end_frame=end_frame),
-                                                       axis=0, keepdims=True) for split_group in new_groups]))
-                return traces[channel_ids].astype(self._dtype)
-        elif self._ref == 'single':
-            if self._groups is None:
-                if self.verbose:
-                    print('Reference to channel', self._ref_channel)
-                traces = self._recording.get_traces(channel_ids=channel_ids, start_frame=start_frame,
-                                                    end_frame=end_frame) \
-                         - self._recording.get_traces(channel_ids=self._ref_channel, start_frame=start_frame,
-                                                      end_frame=end_frame)
-                return traces.astype(self._dtype)
+                group_idx.append(np.array(idx))
+            if ref is not None:
+                ref_idx.append(channel_idx[ref])
             else:
-                new_groups = []
-                for g in self._groups:
-                    new_chans = []
-                    for chan in g:
-                        if chan in self._recording.get_channel_ids():
-                            new_chans.append(chan)
-                    new_groups.append(new_chans)
-                if self.verbose:
-                    print('Reference', new_groups, 'to channels', self._ref_channel)
-                traces = np.vstack(np.array([self._recording.get_traces(channel_ids=split_group,
-                                                                      start_frame=start_frame, end_frame=end_frame)
-                                           - self._recording.get_traces(channel_ids=[ref], start_frame=start_frame,
-                                                                        end_frame=end_frame)
-                                           for (split_group, ref) in zip(new_groups, self._ref_channel)]))
-                return traces.astype(self._dtype)
-
-
-def common_reference(recording, reference='median', groups=None, ref_channels=None, dtype=None, verbose=False):
+                ref_idx.append(None)
+        return group_idx, ref_idx
+
+    def _get_local_reference_indices(self, channel_idx):
+        # channels with the same number k of neighbours are referenced together: the indices of the channels and the
+        # (num_channels, k) matrix of the indices of their neighbours. Channels without neighbours (or whose
+        # neighbours are not in 'channel_idx') are not re-referenced.
+        channels_by_count = {}
+        for chan, i in channel_idx.items():
+            neighbours = self._local_neighbours[chan]
+            if len(neighbours) == 0 or not all(neighbour in channel_idx for neighbour in neighbours):
+                continue
+            rows, neighbours_idx = channels_by_count.setdefault(len(neighbours), ([], []))
+            rows.append(i)
+            neighbours_idx.append([channel_idx[neighbour] for neighbour in neighbours])
+        group_idx = []
+        ref_idx = []
+        for rows, neighbours_idx in channels_by_count.values():
+            group_idx.append(np.array(rows))
+            ref_idx.append(np.array(neighbours_idx))
+        return group_idx, ref_idx
+
+    def _reference_traces(self, traces, group_idx, ref_idx, raw_traces=None):
+        if raw_traces is None:
+            raw_traces = traces
+        if self._ref == 'local':
+            # the neighbours of all channels are gathered in a (k, num_channels, num_frames) array. All medians are
+            # computed before re-referencing, because channels are neighbours of each other
+            medians = [_fast_median(raw_traces[neighbours_idx.T], dtype=traces.dtype)[0]
+                       for neighbours_idx in ref_idx]
+            for idx, median in zip(group_idx, medians):
+                traces[idx] -= median
+            return traces
+        if self._ref == 'single':
+            # the reference channels are copied (fancy indexing) before re-referencing, because a reference channel
+            # can belong to a group processed before its own
+            references = traces[list(ref_idx)]
+            for i, idx in enumerate(group_idx):
+                traces[idx] -= references[i:i + 1]
+            return traces
+        for idx in group_idx:
+            if self._ref == 'median':
+                traces[idx] -= _fast_median(raw_traces[idx], dtype=traces.dtype)
+            elif self._ref == 'average':
+                traces[idx] -= np.mean(traces[idx], axis=0, keepdims=True)
+        return traces
+
+    def _process_traces(self, traces):
+        # used by Pipeline: re-references the traces of all the channels of the parent recording
+        return self._reference_traces(traces, self._group_idx, self._ref_idx)
+
+    def _get_dependent_channel_ids(self, channel_ids):
+        # channels of the parent recording needed to re-reference 'channel_ids'
+        channel_set = set(channel_ids)
+        needed = set(channel_ids)
+        if self._ref == 'local':
+            for chan in channel_ids:
+                needed.update(self._local_neighbours[chan])
+            return [chan for chan in self._recording.get_channel_ids() if chan in needed]
+        for group, ref in zip(self._ref_groups, self._ref_group_channels):
+            if channel_set.intersection(group):
+                if ref is not None:
+                    needed.add(ref)
+                else:
+                    needed.update(group)
+        return [chan for chan in self._recording.get_channel_ids() if chan in needed]
+
+    def get_traces_multi(self, windows, channel_ids=None):
+        return get_traces_multi(self, windows=windows, channel_ids=channel_ids)
+
+
+def _fast_median(traces, dtype='float64'):
+    # median over channels (axis 0) with np.partition in the dtype of the traces (e.g. int16), without the float64
+    # upcast of np.median. Returns a (1, num_frames) array of 'dtype'.
+    n = traces.shape[0]
+    k = n // 2
+    if n % 2 == 1:
+        return np.partition(traces, k, axis=0)[k:k + 1].astype(dtype)
+    partitioned = np.partition(traces, [k - 1, k], axis=0)
+    median = partitioned[k - 1:k].astype(dtype)
+    median += partitioned[k:k + 1]
+    median *= 0.5
+    return median
+
+
+def common_reference(recording, reference='median', groups=None, ref_channels=None, dtype=None, verbose=False,
+                     local_radius=(30, 55)):
     '''
     Re-references the recording extractor traces.
 
@@ -155,6 +259,8 @@ def common_reference(recording, reference='median', groups=None, ref_channels=No
         If 'average', common average reference (CAR) is implemented (the mean of the selected channels is removed
         for each timestamp).
         If 'single', the selected channel(s) is remove from all channels.
+        If 'local', the median of the neighbouring channels of each channel (within 'local_radius', using the
+        'location' property) is removed from it. Channels without neighbours are not re-referenced.
     groups: list
         List of lists containins the channels for splitting the reference. The CMR, CAR, or referencing with respect to
         single channels are applied group-wise. It is useful when dealing with different channel groups, e.g. multiple
@@ -164,9 +270,13 @@ def common_reference(recording, reference='median', groups=None, ref_channels=No
         list of channels to be applied to each group is expected. If 'single' reference, a list of one channel  or an
         int is expected.
     dtype: str
-        dtype of the returned traces. If None, dtype is maintained
+        dtype of the returned traces. If None, dtype is maintained. Traces of dtypes up to 32 bits (e.g. int16) are
+        re-referenced in float32, so 'float32' avoids any float64 copy of integer data.
     verbose: bool
         If True, output is verbose
+    local_radius: tuple
+        Inner and outer radius (in the units of the channel locations, e.g. um) of the annulus of neighbouring
+        channels used by the 'local' reference. With 'groups', only neighbours of the same group are used.
 
     Returns
     -------
@@ -174,5 +284,6 @@ def common_reference(recording, reference='median', groups=None, ref_channels=No
         The re-referenced recording extractor object
     '''
     return CommonReferenceRecording(
-        recording=recording, reference=reference, groups=groups, ref_channels=ref_channels, dtype=dtype, verbose=verbose
+        recording=recording, reference=reference, groups=groups, ref_channels=ref_channels, dtype=dtype, verbose=verbose,
+        local_radius=local_radius
     )
@@ -0,0 +1,153 @@
+from spikeextractors import RecordingExtractor
+import numpy as np
+from .preprocessing_tools import get_traces_multi
+
+
+class ElementwiseRecording(RecordingExtractor):
+    '''
+    Base class of the preprocessors that transform each sample independently (TransformTraces, ClipTraces, Rectify,
+    NormalizeByQuantile). Each preprocessor defines a list of operations:
+        ('scale', scalar, offset): traces * scalar + offset
+        ('clip', a_min, a_max): clipping between a_min and a_max (None for no clipping on one side)
+        ('abs',): absolute value
+    Parameters of 'scale' and 'clip' are floats or (num_channels,) arrays with one value per channel.
+
+    When elementwise preprocessors are stacked, they collapse into one node: the operations of the parent are applied
+    first, on the traces of its own parent, so that a chain (e.g. transform -> clip -> rectify) is computed in a
+    single pass over the traces, into one output array. The parent is not collapsed if its output has an integer dtype
+    (e.g. clipping integer traces), since its output would be rounded.
+
+    Parameters
+    ----------
+    recording: RecordingExtractor
+        The recording extractor to be transformed
+    operations: list
+        List of operations (tuples) applied in order
+    dtype: dtype
+        The dtype of the returned traces. If None, float traces keep their dtype, and integer traces are converted to
+        float64 if a 'scale' operation is applied (otherwise their dtype is maintained).
+    '''
+    def __init__(self, recording, operations, dtype=None):
+        if not isinstance(recording, RecordingExtractor):
+            raise ValueError("'recording' must be a RecordingExtractor")
+        self._own_operations = [self._check_operation(op, recording.get_num_channels()) for op in operations]
+        if isinstance(recording, ElementwiseRecording) and recording.get_dtype().kind == 'f':
+            # the parent is collapsed into this node
+            self._recording = recording._recording
+            self._operations = recording._operations + self._own_operations
+            if dtype is None:
+                dtype = recording._dtype
+        else:
+            self._recording = recording
+            self._operations = list(self._own_operations)
+        if dtype is None:
+            self._dtype = None
+        else:
+            self._dtype = np.dtype(dtype)
+        self._channel_idx = {chan: i for i, chan in enumerate(self._recording.get_channel_ids())}
+        RecordingExtractor.__init__(self)
+        self.copy_channel_properties(recording=recording)
+
+    def get_sampling_frequency(self):
+        return self._recording.get_sampling_frequency()
+
+    def get_num_frames(self):
+        return self._recording.get_num_frames()
+
+    def get_channel_ids(self):
+        return self._recording.get_channel_ids()
+
+    def get_dtype(self):
+        # output dtype: 'dtype' if given, otherwise the dtype of the computation on the traces of the parent
+        if self._dtype is not None:
+            return self._dtype
+        return self._get_compute_dtype(self._recording.get_dtype())
+
+    def get_operations(self):
+        '''
+        Returns the list of operations applied (in order) on the traces of the underlying recording, including the
+        ones of the collapsed parents.
+        '''
+        return list(self._operations)
+
+    def get_traces(self, channel_ids=None, start_frame=None, end_frame=None):
+        if start_frame is None:
+            start_frame = 0
+        if end_frame is None:
+            end_frame = self.get_num_frames()
+        if channel_ids is None:
+            channel_ids = self.get_channel_ids()
+        if isinstance(channel_ids, (int, np.integer)):
+            channel_ids = [channel_ids]
+        traces = self._recording.get_traces(channel_ids=channel_ids, start_frame=start_frame, end_frame=end_frame)
+        compute_dtype = self._get_compute_dtype(traces.dtype)
+        channel_idx = [self._channel_idx[chan] for chan in channel_ids]
+        # the first operation reads the parent traces and writes into the output, the next ones are in place
+        out = np.empty(traces.shape, dtype=compute_dtype)
+        if len(self._operations) == 0:
+            out[:] = traces
+        for i, operation in enumerate(self._operations):
+            _apply_operation(operation, traces if i == 0 else out, out, channel_idx)
+        if self._dtype is not None:
+            out = out.astype(self._dtype, copy=False)
+        return out
+
+    def _process_traces(self, traces):
+        # only the operations of this node: collapsed parents are stages of the pipeline too
+        for operation in self._own_operations:
+            _apply_operation(operation, traces, traces)
+        return traces
+
+    def _get_compute_dtype(self, dtype):
+        if self._dtype is not None and self._dtype.kind == 'f':
+            return self._dtype
+        if np.dtype(dtype).kind == 'f':
+            return np.dtype(dtype)
+        if any(operation[0] == 'scale' for operation in self._operations):
+            return np.dtype('float64')
+        return np.dtype(dtype)
+
+    @staticmethod
+    def _check_operation(operation, num_channels):
+        name, params = operation[0], operation[1:]
+        if name not in ['scale', 'clip', 'abs']:
+            raise ValueError("Operations must be either 'scale', 'clip' or 'abs'")
+        checked_params = []
+        for param in params:
+            if param is not None and np.ndim(param) > 0:
+                param = np.asarray(param, dtype='float64')
+                if param.shape != (num_channels,):
+                    raise ValueError("Per-channel parameters must have one value per channel")
+            checked_params.append(param)
+        return (name,) + tuple(checked_params)
+
+    def get_traces_multi(self, windows, channel_ids=None):
+        return get_traces_multi(self, windows=windows, channel_ids=channel_ids)
+
+
+def _apply_operation(operation, traces, out, channel_idx=None):
+    # applies one operation on 'traces' and writes the result into 'out' (which can be 'traces')
+    name = operation[0]
+    params = [_get_param(param, out.dtype, channel_idx) for param in operation[1:]]
+    if name == 'scale':
+        np.multiply(traces, params[0], out=out, casting='unsafe')
+        np.add(out, params[1], out=out, casting='unsafe')
+    elif name == 'clip':
+        if params[0] is None and params[1] is None:
+            if out is not traces:
+                out[:] = traces
+        else:
+            np.clip(traces, params[0], params[1], out=out, casting='unsafe')
+    else:
+        np.abs(traces, out=out, casting='unsafe')
+
+
+def _get_param(param, dtype, channel_idx=None):
+    # scalar, or column of per-channel values for the given channels, in the dtype of the computation
+    if param is None:
+        return None
+    if np.ndim(param) == 0:
+        return np.asarray(param).astype(dtype)
+    if channel_idx is not None:
+        param = param[channel_idx]
+    return param.astype(dtype)[:, None]
@@ -1,20 +1,63 @@
 from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import hashlib
+import itertools
+import threading
 import spikeextractors as se
 import numpy as np
 from spikeextractors import RecordingExtractor
+from .preprocessing_tools import get_traces_multi, get_recording_fingerprint
+
+try:
+    import scipy.signal as ss
+    HAVE_SS = True
+except ImportError:
+    HAVE_SS = False
+
+# unique keys of the filter recordings, so that several filters can share the same chunk cache
+_cache_key_counter = itertools.count()
 
 
 class FilterRecording(RecordingExtractor):
-    def __init__(self, recording, chunk_size=10000, cache_chunks=False):
+    # if True, short requests can be filtered directly on their own range (see _use_direct_filtering). This is only
+    # correct for filters whose output does not depend on the chunk boundaries (e.g. padded linear filters)
+    _allow_direct_filtering = False
+
+    def __init__(self, recording, chunk_size=10000, cache_chunks=False, cache_folder=None, n_jobs=1,
+                 prefetch_chunks=0, dtype=None):
         if not isinstance(recording, RecordingExtractor):
             raise ValueError("'recording' must be a RecordingExtractor")
         self._recording = recording
         self._chunk_size = chunk_size
-        self._cache_chunks = cache_chunks
-        if cache_chunks:
+        if dtype is None:
+            self._dtype = None
+        else:
+            self._dtype = np.dtype(dtype)
+        self._n_jobs = n_jobs
+        self._prefetch_chunks = prefetch_chunks
+        self._executor = None
+        self._prefetched_chunks = dict()
+        if cache_folder is not None:
+            assert chunk_size is not None, "'chunk_size' must be given to use 'cache_folder'"
+            self._cache_chunks = True
+            self._filtered_cache_chunks = FilteredChunkDiskCache(cache_folder, key=self._get_cache_fingerprint(),
+                                                                 num_channels=recording.get_num_channels(),
+                                                                 num_frames=self.get_num_frames(),
+                                                                 chunk_size=chunk_size,
+                                                                 dtype=self._get_filter_dtype())
+        elif isinstance(cache_chunks, FilteredChunkCache):
+            # cache shared with other filters
+            self._cache_chunks = True
+            self._filtered_cache_chunks = cache_chunks
+        elif cache_chunks:
+            self._cache_chunks = True
             self._filtered_cache_chunks = FilteredChunkCache()
         else:
+            self._cache_chunks = False
             self._filtered_cache_chunks = None
+        self._cache_key = next(_cache_key_counter)
         self._traces = None
         se.RecordingExtractor.__init__(self)
         self.copy_channel_properties(recording)
@@ -28,6 +71,12 @@ class FilterRecording(RecordingExtractor):
     def get_sampling_frequency(self):
         return self._recording.get_sampling_frequency()
 
+    def get_dtype(self):
+        # output dtype: the one of the parent recording unless 'dtype' is given
+        if self._dtype is None:
+            self._dtype = np.dtype(self._recording.get_traces(start_frame=0, end_frame=1).dtype)
+        return self._dtype
+
     def get_traces(self, channel_ids=None, start_frame=None, end_frame=None):
         if start_frame is None:
             start_frame = 0
@@ -37,14 +86,22 @@ class FilterRecording(RecordingExtractor):
             channel_ids = self.get_channel_ids()
         if isinstance(channel_ids, (int, np.integer)):
             channel_ids = [channel_ids]
-        if self._chunk_size is not None:
+        if self._cache_chunks:
+            # cached chunks always contain all channels, so that they can be reused
+            read_channel_ids = self.get_channel_ids()
+        else:
+            read_channel_ids = self._get_dependent_channel_ids(channel_ids)
+        read_channel_idx = {chan: i for i, chan in enumerate(read_channel_ids)}
+        chan_idx = [read_channel_idx[chan] for chan in channel_ids]
+        if self._chunk_size is not None and not self._use_direct_filtering(start_frame, end_frame):
             ich1 = int(start_frame / self._chunk_size)
             ich2 = int((end_frame - 1) / self._chunk_size)
-            dt = self._recording.get_traces(start_frame=0, end_frame=1).dtype
-            filtered_chunk = np.zeros((len(channel_ids), (end_frame-start_frame)), dtype=dt)
+            filtered_chunk = np.zeros((len(channel_ids), (end_frame-start_frame)), dtype=self.get_dtype())
             pos = 0
-            for ich in range(ich1, ich2 + 1):
-                filtered_chunk0 = self._get_filtered_chunk(ich)
+            # each chunk is copied into the output as it arrives
+            filtered_chunks = self._iter_filtered_chunks(list(range(ich1, ich2 + 1)), channel_ids=read_channel_ids)
+            for i, filtered_chunk0 in enumerate(filtered_chunks):
+                ich = ich1 + i
                 if ich == ich1:
                     start0 = start_frame - ich * self._chunk_size
                 else:
@@ -53,20 +110,105 @@ class FilterRecording(RecordingExtractor):
                     end0 = end_frame - ich * self._chunk_size
                 else:
                     end0 = self._chunk_size
-                chan_idx = [self.get_channel_ids().index(chan) for chan in channel_ids]
                 filtered_chunk[:, pos:pos+end0-start0] = filtered_chunk0[chan_idx, start0:end0]
                 pos += (end0-start0)
         else:
-            filtered_chunk = self.filter_chunk(start_frame=start_frame, end_frame=end_frame)[channel_ids, :]
+            filtered_chunk = self.filter_chunk(start_frame=start_frame, end_frame=end_frame,
+                                               channel_ids=read_channel_ids)[chan_idx, :]
+            if self._chunk_size is not None:
+                # same output dtype as the chunked path
+                filtered_chunk = filtered_chunk.astype(self.get_dtype(), copy=False)
         return filtered_chunk
 
+    def get_traces_multi(self, windows, channel_ids=None):
+        return get_traces_multi(self, windows=windows, channel_ids=channel_ids)
+
+    def _use_direct_filtering(self, start_frame, end_frame):
+        # Short requests (e.g. snippets) are filtered on their own range plus the filter padding instead of
+        # computing the full chunks they fall in. Chunks are still used when they are cached, because they can be
+        # reused by later calls.
+        if not self._allow_direct_filtering or self._cache_chunks:
+            return False
+        return (end_frame - start_frame) < self._chunk_size
+
+    def _get_dependent_channel_ids(self, channel_ids):
+        # Channels of the parent recording needed to compute 'channel_ids'. By default all channels are needed (e.g.
+        # whitening). Filters that process each channel independently return 'channel_ids', so that only the
+        # requested channels are read and filtered.
+        return self.get_channel_ids()
+
     @abstractmethod
-    def filter_chunk(self, *, start_frame, end_frame):
+    def filter_chunk(self, *, start_frame, end_frame, channel_ids=None):
+        # returns the filtered traces of 'channel_ids' (all channels if None). It can return more channels (all of
+        # them) if the filter is not channel-separable, as long as they are the ones of _get_dependent_channel_ids
         raise NotImplementedError('filter_chunk not implemented')
 
-    def _get_filtered_chunk(self, ind):
+    def _iter_filtered_chunks(self, inds, channel_ids=None):
+        # Yields the chunks 'inds' in order, computed in parallel if n_jobs > 1 with at most 2 * n_jobs chunks in
+        # flight (so that only a few filtered chunks are held in memory at once), and then schedules the computation
+        # of the next 'prefetch_chunks' chunks for sequential scans
+        executor = self._get_executor()
+        prefetch_key = tuple(channel_ids) if channel_ids is not None else None
+        futures = dict()
+        for ind in inds:
+            if (ind, prefetch_key) in self._prefetched_chunks:
+                futures[ind] = self._prefetched_chunks.pop((ind, prefetch_key))
+        parallel = self._n_jobs > 1 and len(inds) > 1
+        num_submitted = 0
+        for i, ind in enumerate(inds):
+            while parallel and num_submitted < min(i + 2 * self._n_jobs, len(inds)):
+                if inds[num_submitted] not in futures:
+                    futures[inds[num_submitted]] = executor.submit(self._get_filtered_chunk, inds[num_submitted],
+                                                                   channel_ids)
+                num_submitted += 1
+            future = futures.pop(ind, None)
+            if future is not None:
+                yield future.result()
+            else:
+                yield self._get_filtered_chunk(ind, channel_ids)
+
+        if self._prefetch_chunks > 0:
+            num_chunks = int(np.ceil(self.get_num_frames() / self._chunk_size))
+            next_inds = range(inds[-1] + 1, min(inds[-1] + 1 + self._prefetch_chunks, num_chunks))
+            for key in list(self._prefetched_chunks.keys()):
+                if key[0] not in next_inds or key[1] != prefetch_key:
+                    self._prefetched_chunks.pop(key).cancel()
+            for ind in next_inds:
+                if (ind, prefetch_key) not in self._prefetched_chunks:
+                    self._prefetched_chunks[(ind, prefetch_key)] = executor.submit(self._get_filtered_chunk, ind,
+                                                                                   channel_ids)
+
+    def _get_executor(self):
+        if self._executor is None and (self._n_jobs > 1 or self._prefetch_chunks > 0):
+            self._executor = ThreadPoolExecutor(max_workers=max(self._n_jobs, 1))
+        return self._executor
+
+    def close(self):
+        '''
+        Cancels the prefetched chunks and shuts down the threads used to filter chunks in parallel (they are started
+        again if needed).
+        '''
+        for future in self._prefetched_chunks.values():
+            future.cancel()
+        self._prefetched_chunks = dict()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def __del__(self):
+        if getattr(self, '_executor', None) is not None:
+            self._executor.shutdown(wait=False)
+
+    def __getstate__(self):
+        # threads and pending chunks are not pickled (e.g. when the recording is sent to another process)
+        state = self.__dict__.copy()
+        state['_executor'] = None
+        state['_prefetched_chunks'] = dict()
+        return state
+
+    def _get_filtered_chunk(self, ind, channel_ids=None):
         if self._cache_chunks:
-            code = str(ind)
+            code = self._get_chunk_code(ind)
             chunk0 = self._filtered_cache_chunks.get(code)
         else:
             chunk0 = None
@@ -75,35 +217,237 @@ class FilterRecording(RecordingExtractor):
 
         start0 = ind * self._chunk_size
         end0 = (ind + 1) * self._chunk_size
-        chunk1 = self.filter_chunk(start_frame=start0, end_frame=end0)
+        chunk1 = self.filter_chunk(start_frame=start0, end_frame=end0, channel_ids=channel_ids)
         if self._cache_chunks:
             self._filtered_cache_chunks.add(code, chunk1)
-        
+
         return chunk1
-            
+
+    def _filter_chunk_causal(self, start_frame, end_frame, channel_ids=None):
+        # Causal (forward only) filtering with the second-order sections self._sos. The filter is always warmed up
+        # from a zero state on the self._padding preceding frames (no state is carried between chunks), so that the
+        # output does not depend on the order in which chunks are read, nor on the number of threads.
+        if channel_ids is None:
+            channel_ids = self._recording.get_channel_ids()
+        dtype = self._get_filter_dtype()
+        i1 = max(start_frame - self._padding, 0)
+        chunk = self._read_chunk(i1, end_frame, channel_ids, dtype=dtype)
+        filtered_chunk = _sos_filt(self._sos, chunk)
+        return filtered_chunk[:, start_frame - i1:]
+
+    def _get_filter_dtype(self):
+        # filters compute in float32 unless a 64-bit output is requested, so that memory traffic is halved
+        if self.get_dtype().itemsize > 4:
+            return np.dtype('float64')
+        else:
+            return np.dtype('float32')
+
+    def _read_chunk(self, i1, i2, channel_ids=None, dtype='float64'):
+        # reads the parent traces from i1 to i2, zero-padded outside of the recording
+        if channel_ids is None:
+            channel_ids = self._recording.get_channel_ids()
+        M = len(channel_ids)
+        N = self._recording.get_num_frames()
+        i1b = max(i1, 0)
+        i2b = min(i2, N)
+        ret = np.zeros((M, i2 - i1), dtype=dtype)
+        ret[:, i1b - i1:i2b - i1] = self._recording.get_traces(channel_ids=channel_ids, start_frame=i1b,
+                                                                end_frame=i2b)
+        return ret
+
+    def _get_chunk_code(self, ind):
+        return (self._cache_key, ind)
+
+    def _get_filter_params(self):
+        # parameters that define the filter output, used to identify on-disk cached chunks
+        return {}
+
+    def _get_cache_fingerprint(self):
+        h = hashlib.sha1()
+        h.update(get_recording_fingerprint(self._recording).encode())
+        h.update(type(self).__name__.encode())
+        h.update(str(sorted(self._get_filter_params().items())).encode())
+        h.update(str(self._chunk_size).encode())
+        h.update(str(self._get_filter_dtype()).encode())
+        return h.hexdigest()
+
+
+def _sos_filtfilt(sos, traces):
+    # zero-phase second-order sections filter along time. The sections are cast to the dtype of the traces, so that
+    # float32 traces are filtered (and returned) in float32
+    return ss.sosfiltfilt(sos.astype(traces.dtype, copy=False), traces, axis=1)
+
+
+def _sos_filt(sos, traces):
+    # causal version of _sos_filtfilt, from a zero initial state
+    return ss.sosfilt(sos.astype(traces.dtype, copy=False), traces, axis=1)
+
+
+def _check_sos_stability(sos):
+    _, poles, _ = ss.sos2zpk(sos)
+    if not np.all(np.abs(poles) < 1):
+        raise ValueError('Filter is not stable')
+
+
+def _get_sos_padding(sos, tol=1e-5, max_padding=2 ** 20):
+    # number of samples after which the impulse response of the filter has decayed below 'tol' (relative to its
+    # peak). Chunks are padded by this length, so that narrow filters get enough padding and wide filters do not
+    # read more than needed
+    n = 1024
+    while True:
+        impulse = np.zeros(n)
+        impulse[0] = 1
+        response = np.abs(ss.sosfilt(sos, impulse))
+        padding = int(np.nonzero(response > tol * response.max())[0][-1]) + 1
+        if padding < n // 2 or n >= max_padding:
+            return min(padding, max_padding)
+        n = n * 2
 
 
 class FilteredChunkCache():
-    def __init__(self):
-        self._chunks_by_code = dict()
-        self._codes = []
-        self._total_size = 0
-        self._max_size = 1024 * 1024 * 100
+    '''
+    In-memory least-recently-used cache of filtered chunks with a memory budget in bytes. The same cache can be
+    shared by several FilterRecording objects (by passing it as 'cache_chunks'), so that all the filtering stages of
+    a pipeline use a single budget.
+
+    Parameters
+    ----------
+    max_bytes: int
+        Maximum number of bytes of the cached chunks. When exceeded, the least recently used chunks are evicted.
+    '''
+    def __init__(self, max_bytes=1024 * 1024 * 1024):
+        self._lock = threading.Lock()
+        self._chunks_by_code = OrderedDict()
+        self._total_bytes = 0
+        self._max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def add(self, code, chunk):
+        with self._lock:
+            if code in self._chunks_by_code:
+                self._total_bytes = self._total_bytes - self._chunks_by_code.pop(code).nbytes
+            if chunk.nbytes > self._max_bytes:
+                return
+            self._chunks_by_code[code] = chunk
+            self._total_bytes = self._total_bytes + chunk.nbytes
+            while self._total_bytes > self._max_bytes:
+                _, evicted_chunk = self._chunks_by_code.popitem(last=False)
+                self._total_bytes = self._total_bytes - evicted_chunk.nbytes
+                self.evictions = self.evictions + 1
+
+    def get(self, code):
+        with self._lock:
+            if code in self._chunks_by_code:
+                self._chunks_by_code.move_to_end(code)
+                self.hits = self.hits + 1
+                return self._chunks_by_code[code]
+            else:
+                self.misses = self.misses + 1
+                return None
+
+    def clear(self):
+        with self._lock:
+            self._chunks_by_code.clear()
+            self._total_bytes = 0
+
+    def __getstate__(self):
+        # the lock and the cached chunks are not pickled: the unpickled cache starts empty
+        state = self.__dict__.copy()
+        del state['_lock']
+        state['_chunks_by_code'] = OrderedDict()
+        state['_total_bytes'] = 0
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def get_stats(self):
+        '''
+        Returns a dict with the 'hits', 'misses', 'evictions', 'num_chunks', 'total_bytes' and 'max_bytes' of the cache.
+        '''
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'num_chunks': len(self._chunks_by_code), 'total_bytes': self._total_bytes,
+                'max_bytes': self._max_bytes}
+
+
+class FilteredChunkDiskCache():
+    '''
+    Persistent cache of filtered chunks in a memory-mapped binary file. Chunks are written lazily, the first time
+    they are computed, and the file is reused by any later FilterRecording with the same key (the fingerprint of the
+    parent recording and of the filter parameters), also in other processes or sessions.
+
+    Parameters
+    ----------
+    folder: str or Path
+        Folder where the cache files are saved
+    key: str
+        Key identifying the filtered recording (used as file name)
+    num_channels: int
+        Number of channels of the filtered recording
+    num_frames: int
+        Number of frames of the filtered recording
+    chunk_size: int
+        Number of frames of each chunk
+    dtype: dtype
+        The dtype of the cached chunks
+    '''
+    def __init__(self, folder, key, num_channels, num_frames, chunk_size, dtype='float32'):
+        folder = Path(folder)
+        folder.mkdir(parents=True, exist_ok=True)
+        num_chunks = int(np.ceil(num_frames / chunk_size))
+        self._shape = (num_chunks, num_channels, chunk_size)
+        self._dtype = np.dtype(dtype)
+        self._raw_file = folder / (key + '.raw')
+        self._filled_file = folder / (key + '_filled.npy')
+        self._open()
+        self.hits = 0
+        self.misses = 0
+
+    def _open(self):
+        if self._raw_file.is_file() and self._filled_file.is_file():
+            self._chunks = np.memmap(str(self._raw_file), dtype=self._dtype, mode='r+', shape=self._shape)
+            self._filled = np.load(str(self._filled_file), mmap_mode='r+')
+        else:
+            self._chunks = np.memmap(str(self._raw_file), dtype=self._dtype, mode='w+', shape=self._shape)
+            self._filled = np.lib.format.open_memmap(str(self._filled_file), mode='w+', dtype='bool',
+                                                     shape=(self._shape[0],))
+
+    def __getstate__(self):
+        # the files are opened again when unpickled, instead of copying their content
+        state = self.__dict__.copy()
+        del state['_chunks']
+        del state['_filled']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
 
     def add(self, code, chunk):
-        self._chunks_by_code[code] = chunk
-        self._codes.append(code)
-        self._total_size = self._total_size + chunk.size
-        if self._total_size > self._max_size:
-            ii = 0
-            while (ii < len(self._codes)) and (self._total_size > self._max_size / 2):
-                self._total_size = self._total_size - self._chunks_by_code[self._codes[ii]].size
-                del self._chunks_by_code[self._codes[ii]]
-                ii = ii + 1
-            self._codes = self._codes[ii:]
+        _, ind = code
+        self._chunks[ind] = chunk
+        self._chunks.flush()
+        self._filled[ind] = True
+        self._filled.flush()
 
     def get(self, code):
-        if code in self._chunks_by_code:
-            return self._chunks_by_code[code]
+        _, ind = code
+        if self._filled[ind]:
+            self.hits = self.hits + 1
+            return self._chunks[ind]
         else:
+            self.misses = self.misses + 1
             return None
+
+    def get_filename(self):
+        return str(self._raw_file)
+
+    def get_stats(self):
+        '''
+        Returns a dict with the 'hits', 'misses', 'num_chunks' (cached) and 'total_chunks' of the cache.
+        '''
+        return {'hits': self.hits, 'misses': self.misses, 'num_chunks': int(np.sum(self._filled)),
+                'total_chunks': len(self._filled)}
@@ -0,0 +1,166 @@
+from .filterrecording import FilterRecording, _check_sos_stability, _get_sos_padding
+import numpy as np
+import spikeextractors as se
+
+try:
+    import scipy.signal as ss
+    HAVE_LFP = True
+except ImportError:
+    HAVE_LFP = False
+
+
+class LFPRecording(FilterRecording):
+
+    preprocessor_name = 'LFP'
+    _allow_direct_filtering = True
+    installed = HAVE_LFP  # check at class level if installed or not
+    preprocessor_gui_params = [
+        {'name': 'freq_max', 'type': 'float', 'value': 300.0, 'default': 300.0, 'title': "Low-pass frequency"},
+        {'name': 'freq_min', 'type': 'float', 'value': None, 'default': None, 'title':
+            "High-pass frequency. If None, the filter is only low-pass"},
+        {'name': 'lfp_rate', 'type': 'float', 'value': 2500.0, 'default': 2500.0, 'title':
+            "Sampling frequency of the LFP (it must divide the sampling frequency of the recording)"},
+        {'name': 'order', 'type': 'int', 'value': 3, 'default': 3, 'title': "Order of the filter"},
+        {'name': 'chunk_size', 'type': 'int', 'value': 30000, 'default': 30000, 'title':
+            "Chunk size (in LFP frames) for the filter."},
+        {'name': 'cache_chunks', 'type': 'bool', 'value': False, 'default': False, 'title':
+            "If True filtered chunk traces are computed and cached in memory"},
+        {'name': 'n_jobs', 'type': 'int', 'value': 1, 'default': 1, 'title':
+            "Number of threads used to filter chunks in parallel"},
+        {'name': 'prefetch_chunks', 'type': 'int', 'value': 0, 'default': 0, 'title':
+            "Number of chunks filtered ahead in the background during sequential reads"},
+        {'name': 'dtype', 'type': 'dtype', 'value': None, 'default': None, 'title':
+            "Traces dtype. If None, dtype is maintained."},
+    ]
+    installation_mesg = "To use the LFPRecording, install scipy: \n\n pip install scipy\n\n"  # err
+
+    def __init__(self, recording, freq_max=300, freq_min=None, lfp_rate=2500, order=3, chunk_size=30000,
+                 cache_chunks=False, n_jobs=1, prefetch_chunks=0, dtype=None):
+        assert HAVE_LFP, "To use the LFPRecording, install scipy: \n\n pip install scipy\n\n"
+        fs = float(recording.get_sampling_frequency())
+        decimation = int(round(fs / lfp_rate))
+        if decimation < 1 or not np.isclose(fs / decimation, lfp_rate):
+            raise ValueError("'lfp_rate' must divide the sampling frequency of the recording")
+        if freq_max >= lfp_rate / 2:
+            raise ValueError("'freq_max' must be lower than the Nyquist frequency of the LFP")
+        self._freq_max = freq_max
+        self._freq_min = freq_min
+        self._order = order
+        self._decimation = decimation
+        self._lfp_rate = fs / decimation
+        # two stages: a linear-phase FIR anti-aliasing filter that only computes the decimated samples (polyphase,
+        # scipy upfirdn), then the butterworth filter applied forward and backward at the LFP rate
+        if decimation > 1:
+            self._taps = _get_decimation_taps(fs, self._lfp_rate, freq_max)
+        else:
+            self._taps = np.ones(1)
+        if freq_min is None:
+            self._sos = ss.butter(order, freq_max / (self._lfp_rate / 2), btype='lowpass', output='sos')
+        else:
+            self._sos = ss.butter(order, np.array([freq_min, freq_max]) / (self._lfp_rate / 2), btype='bandpass',
+                                  output='sos')
+        _check_sos_stability(self._sos)
+        # padding in LFP frames
+        self._padding = _get_sos_padding(self._sos)
+        FilterRecording.__init__(self, recording=recording, chunk_size=chunk_size, cache_chunks=cache_chunks,
+                                 n_jobs=n_jobs, prefetch_chunks=prefetch_chunks, dtype=dtype)
+        self.copy_channel_properties(recording)
+
+    def get_sampling_frequency(self):
+        return self._lfp_rate
+
+    def get_num_frames(self):
+        # LFP frame i is frame i * decimation of the recording
+        return -(-self._recording.get_num_frames() // self._decimation)
+
+    def _get_filter_params(self):
+        return {'freq_max': self._freq_max, 'freq_min': self._freq_min, 'order': self._order,
+                'decimation': self._decimation, 'numtaps': len(self._taps)}
+
+    def _get_dependent_channel_ids(self, channel_ids):
+        return channel_ids
+
+    def filter_chunk(self, *, start_frame, end_frame, channel_ids=None):
+        # start_frame and end_frame are LFP frames: LFP frame i is computed from the FIR centered on frame
+        # i * decimation of the recording, so that LFP frames are aligned to the frames of the recording
+        D = self._decimation
+        center = (len(self._taps) - 1) // 2
+        # the first frame read is shifted so that the centered outputs fall on the decimated samples of upfirdn
+        shift = -2 * center % D
+        i1 = (start_frame - self._padding) * D - center - shift
+        i2 = (end_frame + self._padding - 1) * D + center + 1
+        padded_chunk = self._read_chunk(i1, i2, channel_ids, dtype=self._get_filter_dtype())
+        offset = (2 * center + shift) // D
+        num_frames = end_frame - start_frame + 2 * self._padding
+        decimated = ss.upfirdn(self._taps.astype(padded_chunk.dtype), padded_chunk, down=D,
+                               axis=1)[:, offset:offset + num_frames]
+        # the butterworth sections are applied in float64 on the decimated samples only
+        filtered = ss.sosfiltfilt(self._sos, decimated.astype('float64'), axis=1)
+        return filtered[:, self._padding:num_frames - self._padding].astype(self._get_filter_dtype(), copy=False)
+
+def lfp(recording, freq_max=300, freq_min=None, lfp_rate=2500, order=3, chunk_size=30000, cache_to_file=False,
+        cache_chunks=False, n_jobs=1, prefetch_chunks=0, dtype=None):
+    '''
+    Extracts the local field potential (LFP) from the recording extractor traces in a single lazy pass. Traces are
+    decimated with a linear-phase FIR anti-aliasing filter that only computes the LFP samples (scipy upfirdn), then
+    low-pass (or band-pass) filtered with a butterworth filter (scipy sosfiltfilt) at the LFP rate. LFP frame i is
+    aligned to frame i * decimation of the recording, whatever the requested window.
+
+    Parameters
+    ----------
+    recording: RecordingExtractor
+        The recording extractor to extract the LFP from.
+    freq_max: int or float
+        Low-pass cutoff frequency. It must be lower than half 'lfp_rate'.
+    freq_min: int, float, or None
+        High-pass cutoff frequency. If None (default), the filter is only low-pass.
+    lfp_rate: int or float
+        Sampling frequency of the LFP. It must divide the sampling frequency of the recording.
+    order: int
+        Order of the filter.
+    chunk_size: int
+        The chunk size (in LFP frames) to be used for the filtering.
+    cache_to_file: bool (default False).
+        If True, LFP traces are computed and cached all at once on disk in temp file
+    cache_chunks: bool or FilteredChunkCache (default False).
+        If True then each chunk is cached in memory (in a least-recently-used cache). A FilteredChunkCache can be
+        passed to share the same memory budget between several filters.
+    n_jobs: int (default 1).
+        Number of threads used to filter in parallel the chunks of a request spanning several chunks
+    prefetch_chunks: int (default 0).
+        Number of following chunks filtered in the background after each request, to speed up sequential reads
+    dtype: dtype or None (default None).
+        The dtype of the returned traces. If None, the dtype of the parent recording is maintained.
+    Returns
+    -------
+    lfp_recording: LFPRecording
+        The LFP recording extractor object
+    '''
+    if cache_to_file:
+        assert not cache_chunks, 'if cache_to_file cache_chunks should be False'
+
+    lfp_recording = LFPRecording(
+        recording=recording,
+        freq_max=freq_max,
+        freq_min=freq_min,
+        lfp_rate=lfp_rate,
+        order=order,
+        chunk_size=chunk_size,
+        cache_chunks=cache_chunks,
+        n_jobs=n_jobs,
+        prefetch_chunks=prefetch_chunks,
+        dtype=dtype
+    )
+    if cache_to_file:
+        return se.CacheRecordingExtractor(lfp_recording, chunk_size=chunk_size)
+    else:
+        return lfp_recording
+
+
+def _get_decimation_taps(fs, lfp_rate, freq_max, attenuation=60):
+    # linear-phase low-pass FIR (kaiser window), flat up to freq_max and attenuated by 'attenuation' dB from the
+    # Nyquist frequency of the LFP, so that the decimated traces are not aliased
+    width = lfp_rate / 2 - freq_max
+    numtaps, beta = ss.kaiserord(attenuation, width / (fs / 2))
+    numtaps += 1 - numtaps % 2  # odd number of taps: the filter is centered on a frame
+    return ss.firwin(numtaps, freq_max + width / 2, window=('kaiser', beta), fs=fs)
@@ -1,8 +1,10 @@
 from spikeextractors import RecordingExtractor
 import numpy as np
+from .elementwiserecording import ElementwiseRecording
+from .preprocessing_tools import get_quantiles
 
 
-class NormalizeByQuantileRecording(RecordingExtractor):
+class NormalizeByQuantileRecording(ElementwiseRecording):
 
     preprocessor_name = 'NormalizeByQuantile'
     installed = True  # check at class level if installed or not
@@ -17,56 +19,54 @@ class NormalizeByQuantileRecording(RecordingExtractor):
             'title': "Upper quantile used for measuring the scale"},
         {'name': 'seed', 'type': 'int', 'value': 0, 'default': 0, 
          'title': "Random seed for reproducibility."},
+        {'name': 'fraction', 'type': 'float', 'value': None, 'default': None,
+         'title': "If given, fraction of the recording scanned to estimate the quantiles (otherwise 50 random snippets)"},
+        {'name': 'chunk_size', 'type': 'int', 'value': 30000, 'default': 30000,
+         'title': "Chunk size used to scan the recording (if 'fraction' is given)"},
+        {'name': 'n_jobs', 'type': 'int', 'value': 1, 'default': 1,
+         'title': "Number of threads used to estimate the quantiles"},
+        {'name': 'mode', 'type': 'str', 'value': 'global', 'default': 'global',
+         'title': "'global' (one scale and offset for all channels) or 'per_channel'"},
+        {'name': 'dtype', 'type': 'dtype', 'value': 'float32', 'default': 'float32',
+         'title': "Traces dtype"},
     ]
     installation_mesg = ""  # err
 
-    def __init__(self, recording, scale=1.0, median=0.0, q1=0.01, q2=0.99, seed=0):
+    def __init__(self, recording, scale=1.0, median=0.0, q1=0.01, q2=0.99, seed=0, fraction=None, chunk_size=30000,
+                 n_jobs=1, mode='global', dtype='float32'):
         if not isinstance(recording, RecordingExtractor):
             raise ValueError("'recording' must be a RecordingExtractor")
-        self._recording = recording
+        if mode not in ['global', 'per_channel']:
+            raise ValueError("'mode' must be either 'global' or 'per_channel'")
+        self._mode = mode
 
-        random_data = self._get_random_data_for_scaling(seed=seed).ravel()
-        loc_q1, pre_median, loc_q2 = np.quantile(random_data, q=[q1, 0.5, q2])
-        pre_scale = abs(loc_q2 - loc_q1)
+        per_channel = mode == 'per_channel'
+        if fraction is None:
+            quantiles = get_quantiles(recording, [q1, 0.5, q2], per_channel=per_channel, seed=seed, n_jobs=n_jobs)
+        else:
+            quantiles = get_quantiles(recording, [q1, 0.5, q2], per_channel=per_channel, fraction=fraction,
+                                      chunk_size=chunk_size, seed=seed, n_jobs=n_jobs)
+        loc_q1, pre_median, loc_q2 = quantiles.T
+        pre_scale = np.abs(loc_q2 - loc_q1)
 
+        # floats, or (num_channels,) vectors in 'per_channel' mode
         self._scalar = scale / pre_scale
         self._offset = median - pre_median * self._scalar
-        RecordingExtractor.__init__(self)
-        self.copy_channel_properties(recording=self._recording)
+        ElementwiseRecording.__init__(self, recording=recording, operations=[('scale', self._scalar, self._offset)],
+                                      dtype=dtype)
 
-    def _get_random_data_for_scaling(self, num_chunks=50, chunk_size=500, seed=0):
-        N = self._recording.get_num_frames()
-        random_ints = np.random.RandomState(seed=seed).randint(0, N - chunk_size, size=num_chunks)
-        chunk_list = []
-        for ff in random_ints:
-            chunk = self._recording.get_traces(start_frame=ff,
-                                               end_frame=ff + chunk_size)
-            chunk_list.append(chunk)
-        return np.concatenate(chunk_list, axis=1)
+    def get_scalar_offset(self):
+        '''
+        Returns the scalar and offset of the normalization (traces * scalar + offset): floats, or (num_channels,)
+        arrays in 'per_channel' mode.
+        '''
+        if self._mode == 'per_channel':
+            return self._scalar.copy(), self._offset.copy()
+        return float(self._scalar), float(self._offset)
 
-    def get_sampling_frequency(self):
-        return self._recording.get_sampling_frequency()
 
-    def get_num_frames(self):
-        return self._recording.get_num_frames()
-
-    def get_channel_ids(self):
-        return self._recording.get_channel_ids()
-
-    def get_traces(self, channel_ids=None, start_frame=None, end_frame=None):
-        if start_frame is None:
-            start_frame = 0
-        if end_frame is None:
-            end_frame = self.get_num_frames()
-        if channel_ids is None:
-            channel_ids = self.get_channel_ids()
-        traces = self._recording.get_traces(channel_ids=channel_ids,
-                                            start_frame=start_frame,
-                                            end_frame=end_frame)
-        return traces * self._scalar + self._offset
-
-
-def normalize_by_quantile(recording, scale=1.0, median=0.0, q1=0.01, q2=0.99, seed=0):
+def normalize_by_quantile(recording, scale=1.0, median=0.0, q1=0.01, q2=0.99, seed=0, fraction=None, chunk_size=30000,
+                          n_jobs=1, mode='global', dtype='float32'):
     '''
     Rescale the traces from the given recording extractor with a scalar
     and offset. First, the median and quantiles of the distribution are estimated.
@@ -88,6 +88,20 @@ def normalize_by_quantile(recording, scale=1.0, median=0.0, q1=0.01, q2=0.99, se
         Upper quantile used for measuring the 
     seed: int
         Random seed for reproducibility
+    fraction: float or None
+        If given, this fraction (between 0 and 1) of the recording is scanned to estimate the quantiles. Otherwise,
+        they are estimated on 50 random snippets of 500 frames.
+    chunk_size: int
+        Chunk size used to scan the recording (if 'fraction' is given)
+    n_jobs: int
+        Number of threads used to estimate the quantiles
+    mode: str
+        'global': the quantiles of all channels are pooled, and all channels are scaled by the same scalar and
+        offset. 'per_channel': quantiles are estimated for each channel, which is rescaled independently (e.g. for
+        arrays with channels of different impedances).
+    dtype: dtype
+        The dtype of the returned traces (default float32). Traces are scaled directly into the output array.
+        Stacked elementwise preprocessors (e.g. transform_traces, clip_traces, rectify) are applied in the same pass.
     Returns
     -------
     rescaled_traces: NormalizeByQuantileRecording
@@ -99,5 +113,10 @@ def normalize_by_quantile(recording, scale=1.0, median=0.0, q1=0.01, q2=0.99, se
         median=median, 
         q1=q1, 
         q2=q2,
-        seed=seed
+        seed=seed,
+        fraction=fraction,
+        chunk_size=chunk_size,
+        n_jobs=n_jobs,
+        mode=mode,
+        dtype=dtype
     )
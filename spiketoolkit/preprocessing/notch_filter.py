@@ -1,4 +1,5 @@
-from .filterrecording import FilterRecording
+from .filterrecording import FilterRecording, _sos_filtfilt, _sos_filt, _check_sos_stability, _get_sos_padding
+from .preprocessing_tools import get_psd
 import spikeextractors as se
 import numpy as np
 
@@ -12,76 +13,127 @@ except ImportError:
 class NotchFilterRecording(FilterRecording):
 
     preprocessor_name = 'NotchFilter'
+    _allow_direct_filtering = True
     installed = HAVE_NFR  # check at class level if installed or not
     preprocessor_gui_params = [
-        {'name': 'freq', 'type': 'float', 'value':3000.0, 'default':3000.0, 'title': "Frequency"},
+        {'name': 'freq', 'type': 'float', 'value':3000.0, 'default':3000.0, 'title': "Frequency (or 'line' to detect the line noise frequency)"},
         {'name': 'q', 'type': 'int', 'value':30, 'default':30, 'title': "Quality factor"},
         {'name': 'chunk_size', 'type': 'int', 'value': 30000, 'default': 30000, 'title':
             "Chunk size for the filter."},
         {'name': 'cache_chunks', 'type': 'bool', 'value': False, 'default': False, 'title':
             "If True filtered traces are computed and cached"},
+        {'name': 'cache_folder', 'type': 'str', 'value': None, 'default': None, 'title':
+            "If given, filtered chunks are cached lazily in a memory-mapped file in this folder"},
+        {'name': 'n_jobs', 'type': 'int', 'value': 1, 'default': 1, 'title':
+            "Number of threads used to filter chunks in parallel"},
+        {'name': 'prefetch_chunks', 'type': 'int', 'value': 0, 'default': 0, 'title':
+            "Number of chunks filtered ahead in the background during sequential reads"},
+        {'name': 'dtype', 'type': 'dtype', 'value': None, 'default': None, 'title':
+            "Traces dtype. If None, dtype is maintained."},
+        {'name': 'causal', 'type': 'bool', 'value': False, 'default': False, 'title':
+            "If True, the filter is applied forward only (causal), warmed up on the padding of each chunk"},
     ]
     installation_mesg = "To use the NotchFilterRecording, install scipy: \n\n pip install scipy\n\n"  # error message when not installed
 
-    def __init__(self, recording, freq=3000, q=30, chunk_size=30000, cache_chunks=False):
+    def __init__(self, recording, freq=3000, q=30, chunk_size=30000, cache_chunks=False, cache_folder=None, n_jobs=1,
+                 prefetch_chunks=0, dtype=None, causal=False):
         assert HAVE_NFR, "To use the NotchFilterRecording, install scipy: \n\n pip install scipy\n\n"
+        if freq == 'line':
+            freq = _detect_line_frequency(recording)
         self._freq = freq
         self._q = q
         fn = 0.5 * float(recording.get_sampling_frequency())
-        self._b, self._a = ss.iirnotch(self._freq / fn, self._q)
-
-        if not np.all(np.abs(np.roots(self._a)) < 1):
-            raise ValueError('Filter is not stable')
-        FilterRecording.__init__(self, recording=recording, chunk_size=chunk_size, cache_chunks=cache_chunks)
+        b, a = ss.iirnotch(self._freq / fn, self._q)
+        self._sos = ss.tf2sos(b, a)
+        _check_sos_stability(self._sos)
+        self._padding = _get_sos_padding(self._sos)
+        self._causal = causal
+        FilterRecording.__init__(self, recording=recording, chunk_size=chunk_size, cache_chunks=cache_chunks,
+                                 cache_folder=cache_folder, n_jobs=n_jobs, prefetch_chunks=prefetch_chunks,
+                                 dtype=dtype)
         self.copy_channel_properties(recording)
 
-    def filter_chunk(self, *, start_frame, end_frame):
-        padding = 3000
-        i1 = start_frame - padding
-        i2 = end_frame + padding
-        padded_chunk = self._read_chunk(i1, i2)
+    def _get_filter_params(self):
+        return {'freq': self._freq, 'q': self._q, 'causal': self._causal}
+
+    def _get_dependent_channel_ids(self, channel_ids):
+        return channel_ids
+
+    def filter_chunk(self, *, start_frame, end_frame, channel_ids=None):
+        if self._causal:
+            return self._filter_chunk_causal(start_frame, end_frame, channel_ids)
+        i1 = start_frame - self._padding
+        i2 = end_frame + self._padding
+        padded_chunk = self._read_chunk(i1, i2, channel_ids, dtype=self._get_filter_dtype())
         filtered_padded_chunk = self._do_filter(padded_chunk)
         return filtered_padded_chunk[:, start_frame - i1:end_frame - i1]
 
+    def _process_traces(self, traces):
+        # used by Pipeline: filters traces already padded by self._padding
+        if self._causal:
+            # the padding before the chunk warms up the filter
+            return _sos_filt(self._sos, traces)
+        return self._do_filter(traces)
+
     def _do_filter(self, chunk):
-        chunk_filtered = ss.filtfilt(self._b, self._a, chunk, axis=1)
+        chunk_filtered = _sos_filtfilt(self._sos, chunk)
 
         return chunk_filtered
 
-    def _read_chunk(self, i1, i2):
-        M = len(self._recording.get_channel_ids())
-        N = self._recording.get_num_frames()
-        if i1 < 0:
-            i1b = 0
-        else:
-            i1b = i1
-        if i2 > N:
-            i2b = N
-        else:
-            i2b = i2
-        ret = np.zeros((M, i2 - i1))
-        ret[:, i1b - i1:i2b - i1] = self._recording.get_traces(start_frame=i1b, end_frame=i2b)
-        return ret
-
-
-def notch_filter(recording, freq=3000, q=30, chunk_size=30000, cache_to_file=False, cache_chunks=False):
+
+def _detect_line_frequency(recording, line_frequencies=(50, 60), fraction=0.1, seed=0):
+    # line frequency with the highest peak (relative to the neighbouring frequencies) in the median power spectral
+    # density of the channels, estimated with 1 Hz resolution on a fraction of the recording
+    nperseg = int(recording.get_sampling_frequency())
+    freqs, psd = get_psd(recording, nperseg=nperseg, fraction=fraction, chunk_size=10 * nperseg, seed=seed)
+    power = np.median(psd, axis=1)
+    peak_ratios = []
+    for line_frequency in line_frequencies:
+        distances = np.abs(freqs - line_frequency)
+        peak_ratios.append(power[np.argmin(distances)] / np.median(power[(distances > 2) & (distances < 10)]))
+    return float(line_frequencies[int(np.argmax(peak_ratios))])
+
+
+def notch_filter(recording, freq=3000, q=30, chunk_size=30000, cache_to_file=False, cache_chunks=False,
+                 cache_folder=None, n_jobs=1, prefetch_chunks=0, dtype=None, causal=False):
     '''
-    Performs a notch filter on the recording extractor traces using scipy iirnotch function.
+    Performs a notch filter on the recording extractor traces using scipy iirnotch function. The filter is applied
+    as second-order sections and chunks are padded by the length of its impulse response.
 
     Parameters
     ----------
     recording: RecordingExtractor
         The recording extractor to be notch-filtered.
-    freq: int or float
-        The target frequency of the notch filter.
+    freq: int, float or 'line'
+        The target frequency of the notch filter. If 'line', the line noise frequency (50 or 60 Hz) is detected from
+        the power spectral density of the recording (see get_psd).
     q: int
         The quality factor of the notch filter.
     chunk_size: int
         The chunk size to be used for the filtering.
     cache_to_file: bool (default False).
         If True, filtered traces are computed and cached all at once on disk in temp file 
-    cache_chunks: bool (default False).
-        If True then each chunk is cached in memory (in a dict)
+    cache_chunks: bool or FilteredChunkCache (default False).
+        If True then each chunk is cached in memory (in a least-recently-used cache). A FilteredChunkCache can be
+        passed to share the same memory budget between several filters.
+    cache_folder: str or None (default None).
+        If given, each filtered chunk is written once in a memory-mapped file in this folder. The file is identified
+        by the parent recording and the filter parameters, so it is reused (without filtering again) by later
+        processes or sessions. Unlike 'cache_to_file', chunks are filtered lazily when they are first requested.
+    n_jobs: int (default 1).
+        Number of threads used to filter in parallel the chunks of a request spanning several chunks
+    prefetch_chunks: int (default 0).
+        Number of following chunks filtered in the background after each request, to speed up sequential reads
+        (e.g. writing the filtered recording to file)
+    dtype: dtype or None (default None).
+        The dtype of the returned traces. If None, the dtype of the parent recording is maintained. Traces are
+        filtered in float32, unless dtype is a 64-bit type.
+    causal: bool (default False).
+        If True, the filter is applied forward only (scipy sosfilt) instead of forward and backward, so that each
+        output sample only depends on the past samples (e.g. for online use), at the cost of a phase delay. Each
+        chunk warms up the filter from a zero state on the preceding padding samples (the filter state is not
+        carried between chunks), so that results do not depend on the read order or on n_jobs. They match a
+        single pass of sosfilt over the recording up to the truncation of the impulse response.
     Returns
     -------
     filter_recording: NotchFilterRecording
@@ -90,6 +142,7 @@ def notch_filter(recording, freq=3000, q=30, chunk_size=30000, cache_to_file=Fal
 
     if cache_to_file:
         assert not cache_chunks, 'if cache_to_file cache_chunks should be False'
+        assert cache_folder is None, 'if cache_to_file cache_folder should be None'
     
     notch_recording =  NotchFilterRecording(
         recording=recording,
@@ -97,6 +150,11 @@ def notch_filter(recording, freq=3000, q=30, chunk_size=30000, cache_to_file=Fal
         q=q,
         chunk_size=chunk_size,
         cache_chunks=cache_chunks,
+        cache_folder=cache_folder,
+        n_jobs=n_jobs,
+        prefetch_chunks=prefetch_chunks,
+        dtype=dtype,
+        causal=causal
     )
     if cache_to_file:
         return se.CacheRecordingExtractor(notch_recording, chunk_size=chunk_size)
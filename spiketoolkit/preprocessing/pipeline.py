@@ -0,0 +1,170 @@
+from spikeextractors import RecordingExtractor
+import numpy as np
+import threading
+from .preprocessinglist import preprocesser_dict
+from .preprocessing_tools import get_traces_multi
+
+
+class Pipeline(RecordingExtractor):
+    '''
+    Chain of preprocessing stages executed chunk by chunk in a single pass.
+
+    The stages are instantiated as the usual lazy preprocessing recordings (so that data-driven stages, e.g.
+    whitening, are estimated on the output of the previous stages). When all stages can be fused (bandpass and notch
+    filters, common reference, whitening, transform, clip, rectify, normalization and saturation blanking), each
+    chunk of the raw recording is read once with the sum of the paddings of all stages, copied into a preallocated
+    buffer and processed by all the stages in memory. Otherwise traces are read through the lazy chain.
+
+    The chunks are processed in the filter dtype of the stages (float32 unless a stage needs float64). Common
+    reference, elementwise stages and saturation blanking work in place in the buffer, and whitening writes into a
+    second buffer (the two buffers alternate). Each thread has its own buffers, so that the pipeline can be read
+    concurrently. The bandpass and notch filters return new arrays (scipy does not
+    filter into a given output).
+
+    Parameters
+    ----------
+    recording: RecordingExtractor
+        The recording extractor to be preprocessed
+    stages: list
+        Ordered list of stages. Each stage is a preprocessor name of 'preprocesser_dict' (e.g. 'BandpassFilter') or
+        class, or a tuple (name or class, dict of parameters), e.g. [('BandpassFilter', {'freq_min': 300}),
+        'CommonReference', 'Whiten'].
+    chunk_size: int
+        Number of frames processed at once
+    dtype: dtype
+        The dtype of the returned traces. If None, the dtype of the last stage is used.
+    '''
+    def __init__(self, recording, stages, chunk_size=30000, dtype=None):
+        if not isinstance(recording, RecordingExtractor):
+            raise ValueError("'recording' must be a RecordingExtractor")
+        self._recording = recording
+        self._chunk_size = chunk_size
+        self._stages = []
+        stage_recording = recording
+        for stage in stages:
+            if isinstance(stage, (tuple, list)):
+                pp_class, params = stage
+            else:
+                pp_class, params = stage, {}
+            if isinstance(pp_class, str):
+                if pp_class not in preprocesser_dict:
+                    raise ValueError("'" + pp_class + "' is not a preprocessor. Available preprocessors are: " +
+                                     str(list(preprocesser_dict.keys())))
+                pp_class = preprocesser_dict[pp_class]
+            stage_recording = pp_class(stage_recording, **params)
+            self._stages.append(stage_recording)
+        self._output_recording = stage_recording
+        self._fused = all(hasattr(stage, '_process_traces') for stage in self._stages)
+        self._padding = int(sum(getattr(stage, '_padding', 0) for stage in self._stages))
+        # scratch buffers of each thread, so that concurrent reads do not overwrite each other's chunks
+        self._thread_buffers = threading.local()
+        self._buffer_dtype = None
+        if dtype is None:
+            self._dtype = None
+        else:
+            self._dtype = np.dtype(dtype)
+        RecordingExtractor.__init__(self)
+        self.copy_channel_properties(recording=self._output_recording)
+
+    def get_sampling_frequency(self):
+        return self._output_recording.get_sampling_frequency()
+
+    def get_num_frames(self):
+        return self._output_recording.get_num_frames()
+
+    def get_channel_ids(self):
+        return self._output_recording.get_channel_ids()
+
+    def get_stages(self):
+        return list(self._stages)
+
+    def get_traces(self, channel_ids=None, start_frame=None, end_frame=None):
+        if start_frame is None:
+            start_frame = 0
+        if end_frame is None:
+            end_frame = self.get_num_frames()
+        if channel_ids is None:
+            channel_ids = self.get_channel_ids()
+        if isinstance(channel_ids, (int, np.integer)):
+            channel_ids = [channel_ids]
+        if not self._fused:
+            traces = self._output_recording.get_traces(channel_ids=channel_ids, start_frame=start_frame,
+                                                       end_frame=end_frame)
+            if self._dtype is not None:
+                traces = traces.astype(self._dtype)
+            return traces
+        dtype = self._output_recording.get_dtype() if self._dtype is None else self._dtype
+        channel_idx = {chan: i for i, chan in enumerate(self.get_channel_ids())}
+        chan_idx = [channel_idx[chan] for chan in channel_ids]
+        traces = np.zeros((len(channel_ids), end_frame - start_frame), dtype=dtype)
+        for chunk_start in range(start_frame, end_frame, self._chunk_size):
+            chunk_end = min(chunk_start + self._chunk_size, end_frame)
+            chunk = self._process_chunk(chunk_start, chunk_end)
+            traces[:, chunk_start - start_frame:chunk_end - start_frame] = chunk[chan_idx]
+        return traces
+
+    def get_traces_multi(self, windows, channel_ids=None):
+        return get_traces_multi(self, windows=windows, channel_ids=channel_ids)
+
+    def _process_chunk(self, start_frame, end_frame):
+        num_frames = self._recording.get_num_frames()
+        i1 = start_frame - self._padding
+        i2 = end_frame + self._padding
+        i1b = max(i1, 0)
+        i2b = min(i2, num_frames)
+        traces = self._get_buffer(i2 - i1, 0)
+        traces[:, :i1b - i1] = 0
+        traces[:, i2b - i1:] = 0
+        traces[:, i1b - i1:i2b - i1] = self._recording.get_traces(start_frame=i1b, end_frame=i2b)
+        current = 0  # index of the buffer holding 'traces' (None if a stage returned a new array)
+        for stage in self._stages:
+            if getattr(stage, '_process_traces_out', False):
+                spare = 0 if current is None else 1 - current
+                out = self._get_buffer(i2 - i1, spare)
+                traces = stage._process_traces(traces, out=out)
+                current = spare if traces is out else None
+            else:
+                processed = stage._process_traces(traces)
+                if processed is not traces:
+                    current = None
+                traces = processed
+            # as in the lazy chain, the output of each stage is zero outside of the recording
+            traces[:, :i1b - i1] = 0
+            traces[:, i2b - i1:] = 0
+        return traces[:, self._padding:self._padding + end_frame - start_frame]
+
+    def _get_buffer(self, num_frames, index):
+        # two buffers per thread reused across chunks: the raw traces are read into the first one, and stages that
+        # write into an output buffer alternate between them
+        if self._buffer_dtype is None:
+            self._buffer_dtype = self._get_buffer_dtype()
+        buffers = self._get_thread_buffers()
+        buffer = buffers[index]
+        if buffer is None or buffer.shape[1] < num_frames:
+            buffer = np.zeros((self._recording.get_num_channels(),
+                               max(num_frames, self._chunk_size + 2 * self._padding)), dtype=self._buffer_dtype)
+            buffers[index] = buffer
+        return buffer[:, :num_frames]
+
+    def _get_thread_buffers(self):
+        if not hasattr(self._thread_buffers, 'buffers'):
+            self._thread_buffers.buffers = [None, None]
+        return self._thread_buffers.buffers
+
+    def __getstate__(self):
+        # the scratch buffers are not pickled
+        state = self.__dict__.copy()
+        del state['_thread_buffers']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._thread_buffers = threading.local()
+
+    def _get_buffer_dtype(self):
+        # the filter dtype of the stages (float64 if any stage filters in float64), otherwise float32 unless the
+        # output of the chain needs float64
+        dtypes = [stage._get_filter_dtype() for stage in self._stages if hasattr(stage, '_get_filter_dtype')]
+        if len(dtypes) == 0:
+            dtypes = [self._output_recording.get_traces(start_frame=0, end_frame=1).dtype]
+        return np.result_type(np.float32, *dtypes)
@@ -0,0 +1,613 @@
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+from pathlib import Path
+import threading
+import weakref
+import numpy as np
+from spikeextractors import RecordingExtractor
+
+try:
+    import scipy.signal as ss
+    HAVE_SS = True
+except ImportError:
+    HAVE_SS = False
+
+
+
+class _RecordingCache():
+    '''
+    Least-recently-used in-memory cache of results computed on recording extractors. Results are identified by the
+    recording object (not by its content) and the parameters: the recording is weakly referenced, so that another
+    recording created later at the same address is not mistaken for it.
+    '''
+    def __init__(self, max_entries=64):
+        self._max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, recording, params):
+        key = (id(recording), params)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0]() is not recording:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, recording, params, value):
+        key = (id(recording), params)
+        with self._lock:
+            self._entries[key] = (weakref.ref(recording), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# quantiles already computed, by recording object and parameters
+_quantiles_cache = _RecordingCache()
+
+
+def get_traces_multi(recording, windows, channel_ids=None, max_gap=3000, max_read_size=30000):
+    '''
+    Returns the traces of many (start_frame, end_frame) windows at once. Windows that overlap or are closer than
+    'max_gap' frames are merged into a single contiguous read, so that the recording (and all the extractors it
+    depends on) is accessed once per merged read instead of once per window.
+
+    Parameters
+    ----------
+    recording: RecordingExtractor
+        The recording extractor to read traces from
+    windows: array-like
+        (num_windows, 2) array of (start_frame, end_frame) pairs. Frames outside the recording are zero-padded.
+    channel_ids: list
+        List of channel ids to get traces from. If None, all channels are returned
+    max_gap: int
+        Windows separated by less than 'max_gap' frames are read together
+    max_read_size: int
+        Maximum number of frames of a merged read (a single window longer than this is still read at once)
+
+    Returns
+    -------
+    traces_list: list
+        List of np.array (num_channels, end_frame - start_frame) with the traces of each window, in the same order
+        as 'windows'
+    '''
+    if channel_ids is None:
+        channel_ids = recording.get_channel_ids()
+    if isinstance(channel_ids, (int, np.integer)):
+        channel_ids = [channel_ids]
+    windows = np.asarray(windows, dtype='int64').reshape(-1, 2)
+    if len(windows) == 0:
+        return []
+    num_frames = recording.get_num_frames()
+    starts = np.clip(windows[:, 0], 0, num_frames)
+    ends = np.clip(windows[:, 1], 0, num_frames)
+
+    order = np.argsort(starts, kind='stable')
+    traces_list = [None] * len(windows)
+    group = []
+    group_start = group_end = None
+    for i in order:
+        if starts[i] >= ends[i]:
+            # fully outside the recording
+            continue
+        if group and starts[i] <= group_end + max_gap and max(group_end, ends[i]) - group_start <= max_read_size:
+            group.append(i)
+            group_end = max(group_end, ends[i])
+        else:
+            if group:
+                _read_window_group(recording, windows, starts, ends, group, group_start, group_end, channel_ids,
+                                   traces_list)
+            group = [i]
+            group_start = starts[i]
+            group_end = ends[i]
+    if group:
+        _read_window_group(recording, windows, starts, ends, group, group_start, group_end, channel_ids,
+                           traces_list)
+
+    dtype = None
+    for traces in traces_list:
+        if traces is not None:
+            dtype = traces.dtype
+            break
+    if dtype is None:
+        dtype = recording.get_traces(channel_ids=channel_ids, start_frame=0, end_frame=1).dtype
+    for i, traces in enumerate(traces_list):
+        if traces is None:
+            traces_list[i] = np.zeros((len(channel_ids), windows[i, 1] - windows[i, 0]), dtype=dtype)
+    return traces_list
+
+
+def _read_window_group(recording, windows, starts, ends, group, group_start, group_end, channel_ids, traces_list):
+    group_traces = recording.get_traces(channel_ids=channel_ids, start_frame=int(group_start),
+                                        end_frame=int(group_end))
+    for i in group:
+        start_frame, end_frame = windows[i]
+        if start_frame == starts[i] and end_frame == ends[i]:
+            traces = group_traces[:, start_frame - group_start:end_frame - group_start].copy()
+        else:
+            traces = np.zeros((len(channel_ids), end_frame - start_frame), dtype=group_traces.dtype)
+            traces[:, starts[i] - start_frame:ends[i] - start_frame] = \
+                group_traces[:, starts[i] - group_start:ends[i] - group_start]
+        traces_list[i] = traces
+
+
+def get_recording_fingerprint(recording, num_windows=5, window_size=100):
+    '''
+    Computes a fingerprint (hash) of a recording extractor, to identify the same data across processes and sessions
+    (e.g. to reuse cached results on disk). It includes the shape, sampling frequency, channel ids, dtype and the
+    traces of a few short windows evenly spaced over the recording, and the chain of lazy recordings it is computed
+    from: the class and the parameters (numbers, strings, arrays and lists of them) of each preprocessor, and for the
+    original recordings, the data they hold in memory (e.g. NumpyRecordingExtractor), the path, size and modification
+    time of their files, and their sampled windows. Runtime state (caches, buffers, threads) is not included, so the
+    fingerprint does not depend on the traces read before.
+
+    Files modified in place without changing their size or modification time, or preprocessor parameters that are
+    not stored as attributes of these types, are not detected.
+
+    Parameters
+    ----------
+    recording: RecordingExtractor
+        The recording extractor
+    num_windows: int
+        Number of windows whose traces are hashed
+    window_size: int
+        Number of frames of each window
+
+    Returns
+    -------
+    fingerprint: str
+        Hexadecimal fingerprint of the recording
+    '''
+    h = hashlib.sha1()
+    _update_traces_hash(h, recording, num_windows, window_size)
+    _update_chain_hash(h, recording, num_windows, window_size, visited=set())
+    return h.hexdigest()
+
+
+def get_covariance(recording, chunk_size=30000, fraction=1., seed=0, n_jobs=1, channel_ids=None):
+    '''
+    Computes the covariance matrix of the channels of a recording extractor by scanning (a fraction of) the recording
+    chunk by chunk. Only the sums of the traces and of their products are accumulated, so the memory does not depend
+    on the number of chunks scanned.
+
+    Parameters
+    ----------
+    recording: RecordingExtractor
+        The recording extractor
+    chunk_size: int
+        Number of frames of each chunk
+    fraction: float
+        Fraction (between 0 and 1) of the chunks of the recording used. If less than 1, chunks are randomly selected.
+    seed: int
+        Random seed for the selection of the chunks
+    n_jobs: int
+        Number of threads reading and accumulating chunks in parallel
+    channel_ids: list
+        List of channel ids. If None, all channels are used
+
+    Returns
+    -------
+    covariance: np.array
+        (num_channels, num_channels) covariance matrix
+    '''
+    if channel_ids is None:
+        channel_ids = recording.get_channel_ids()
+    windows = _get_chunk_windows(recording.get_num_frames(), chunk_size=chunk_size, fraction=fraction, seed=seed)
+
+    def _get_chunk_moments(window):
+        traces = recording.get_traces(channel_ids=channel_ids, start_frame=int(window[0]),
+                                      end_frame=int(window[1])).astype('float64')
+        return traces.shape[1], np.sum(traces, axis=1), traces @ traces.T
+
+    num_samples = 0
+    sum_traces = np.zeros(len(channel_ids))
+    sum_products = np.zeros((len(channel_ids), len(channel_ids)))
+    for n, chunk_sum, chunk_products in _imap_windows(_get_chunk_moments, windows, n_jobs):
+        num_samples += n
+        sum_traces += chunk_sum
+        sum_products += chunk_products
+    mean = sum_traces / num_samples
+    return sum_products / num_samples - np.outer(mean, mean)
+
+
+def get_random_data_chunks(recording, num_chunks=50, chunk_size=500, seed=0, n_jobs=1, channel_ids=None):
+    '''
+    Returns the concatenated traces of random chunks of a recording extractor, e.g. to estimate statistics of the
+    data. Chunks are read in parallel if n_jobs > 1, and the result only depends on the seed.
+
+    Parameters
+    ----------
+    recording: RecordingExtractor
+        The recording extractor
+    num_chunks: int
+        Number of random chunks
+    chunk_size: int
+        Number of frames of each chunk
+    seed: int
+        Random seed for the selection of the chunks
+    n_jobs: int
+        Number of threads reading chunks in parallel
+    channel_ids: list
+        List of channel ids. If None, all channels are returned
+
+    Returns
+    -------
+    traces: np.array
+        (num_channels, num_chunks * chunk_size) array with the traces of the chunks
+    '''
+    windows = _get_chunk_windows(recording.get_num_frames(), chunk_size=chunk_size, num_chunks=num_chunks, seed=seed)
+    chunk_list = _map_windows(lambda window: recording.get_traces(channel_ids=channel_ids,
+                                                                  start_frame=int(window[0]),
+                                                                  end_frame=int(window[1])), windows, n_jobs)
+    return np.concatenate(chunk_list, axis=1)
+
+
+def get_quantiles(recording, q, per_channel=False, num_chunks=50, chunk_size=500, fraction=None, seed=0, n_jobs=1,
+                  sketch_size=4096, use_cache=True):
+    '''
+    Estimates quantiles of the traces of a recording extractor, globally or per channel. Chunks of the recording are
+    summarized in parallel by mergeable quantile sketches (QuantileSketch), so that the whole recording can be scanned
+    in bounded memory. Results only depend on the seed and are cached for the same recording object.
+
+    Parameters
+    ----------
+    recording: RecordingExtractor
+        The recording extractor
+    q: float or array-like
+        Quantile(s) between 0 and 1
+    per_channel: bool
+        If True, quantiles are computed for each channel, otherwise on the traces of all channels
+    num_chunks: int
+        Number of random chunks used (if 'fraction' is None)
+    chunk_size: int
+        Number of frames of each chunk
+    fraction: float or None
+        If given, this fraction (between 0 and 1) of the chunks of the recording is scanned instead of 'num_chunks'
+        random chunks
+    seed: int
+        Random seed for the selection of the chunks and the sketches
+    n_jobs: int
+        Number of threads reading and summarizing chunks in parallel
+    sketch_size: int
+        Number of items of each level of the sketches. Quantiles are exact if all the sampled traces fit in it.
+    use_cache: bool
+        If True, quantiles are cached in memory (for the same recording object and parameters, up to 64 results)
+
+    Returns
+    -------
+    quantiles: np.array
+        (num_quantiles,) array, or (num_channels, num_quantiles) array if 'per_channel' (squeezed if q is a float)
+    '''
+    q_array = np.atleast_1d(np.asarray(q, dtype='float64'))
+    if use_cache:
+        params = (tuple(q_array), per_channel, num_chunks, chunk_size, fraction, seed, sketch_size)
+        quantiles = _quantiles_cache.get(recording, params)
+        if quantiles is not None:
+            quantiles = quantiles.copy()
+            return quantiles[..., 0] if np.ndim(q) == 0 else quantiles
+    windows = _get_chunk_windows(recording.get_num_frames(), chunk_size=chunk_size, num_chunks=num_chunks,
+                                 fraction=fraction, seed=seed)
+    num_channels = recording.get_num_channels() if per_channel else 1
+
+    def _sketch_chunk(i_window):
+        i, window = i_window
+        traces = recording.get_traces(start_frame=int(window[0]), end_frame=int(window[1]))
+        chunk_sketch = QuantileSketch(num_channels=num_channels, sketch_size=sketch_size, seed=[seed, i])
+        chunk_sketch.update(traces if per_channel else traces.reshape(1, -1))
+        return chunk_sketch
+
+    sketch = QuantileSketch(num_channels=num_channels, sketch_size=sketch_size, seed=seed)
+    # sketches are merged in chunk order as they arrive, so that the result is deterministic in bounded memory
+    for chunk_sketch in _imap_windows(_sketch_chunk, list(enumerate(windows)), n_jobs):
+        sketch.merge(chunk_sketch)
+    quantiles = sketch.get_quantiles(q_array)
+    if not per_channel:
+        quantiles = quantiles[0]
+    if use_cache:
+        _quantiles_cache.set(recording, params, quantiles.copy())
+    return quantiles[..., 0] if np.ndim(q) == 0 else quantiles
+
+
+class QuantileSketch():
+    '''
+    Mergeable quantile sketch (KLL-like) of the values of several channels. Items are kept in levels of at most
+    'sketch_size' items per channel, where items of level h stand for 2 ** h values. When a level is full, its
+    sorted items are compacted: every other item (with a random offset) is promoted to the next level. All channels
+    receive the same number of values, so levels are (num_channels, num_items) arrays compacted at once.
+
+    Parameters
+    ----------
+    num_channels: int
+        Number of channels
+    sketch_size: int
+        Maximum number of items of each level
+    seed: int or list
+        Seed of the random offsets of the compactions
+    '''
+    def __init__(self, num_channels=1, sketch_size=4096, seed=0):
+        self._num_channels = num_channels
+        self._sketch_size = sketch_size
+        self._random_state = np.random.RandomState(seed=seed)
+        self._levels = []
+        self.num_values = 0
+
+    def update(self, values):
+        '''
+        Adds a (num_channels, num_values) array of values to the sketch.
+        '''
+        values = np.asarray(values, dtype='float64').reshape(self._num_channels, -1)
+        self.num_values += values.shape[1]
+        self._add_items(0, values)
+        self._compact()
+
+    def merge(self, other):
+        '''
+        Adds the values summarized by another sketch (with the same number of channels) to the sketch.
+        '''
+        assert other._num_channels == self._num_channels, "Sketches must have the same number of channels"
+        self.num_values += other.num_values
+        for h, items in enumerate(other._levels):
+            self._add_items(h, items)
+        self._compact()
+
+    def get_quantiles(self, q):
+        '''
+        Returns the (num_channels, num_quantiles) estimated quantiles 'q' (between 0 and 1) of each channel.
+        '''
+        q = np.atleast_1d(np.asarray(q, dtype='float64'))
+        items = np.concatenate(self._levels, axis=1)
+        weights = np.concatenate([np.full(level.shape[1], 2. ** h) for h, level in enumerate(self._levels)])
+        order = np.argsort(items, axis=1, kind='stable')
+        sorted_items = np.take_along_axis(items, order, axis=1)
+        sorted_weights = weights[order]
+        # rank of each item at the middle of its weight, normalized to [0, 1] as np.quantile
+        ranks = np.cumsum(sorted_weights, axis=1) - (sorted_weights + 1) / 2
+        ranks /= max(self.num_values - 1, 1)
+        return np.array([np.interp(q, ranks[i], sorted_items[i]) for i in range(self._num_channels)])
+
+    def _add_items(self, h, items):
+        while len(self._levels) <= h:
+            self._levels.append(np.zeros((self._num_channels, 0)))
+        self._levels[h] = np.concatenate([self._levels[h], items], axis=1)
+
+    def _compact(self):
+        h = 0
+        while h < len(self._levels):
+            level = self._levels[h]
+            if level.shape[1] > self._sketch_size:
+                level = np.sort(level, axis=1)
+                # an odd item stays in the level
+                num_compacted = level.shape[1] - level.shape[1] % 2
+                offset = self._random_state.randint(2)
+                self._add_items(h + 1, level[:, offset:num_compacted:2])
+                self._levels[h] = level[:, num_compacted:]
+            h += 1
+
+
+def get_psd(recording, nperseg=1024, noverlap=None, window='hann', fraction=1., chunk_size=30000, seed=0, n_jobs=1,
+            channel_ids=None, scaling='density'):
+    '''
+    Computes the power spectral density of each channel of a recording extractor with Welch's method, by scanning (a
+    fraction of) the recording chunk by chunk. The periodograms of the segments of each chunk are summed in parallel,
+    so the memory does not depend on the duration of the recording. On the whole recording (fraction=1), the result
+    is the same as scipy.signal.welch (with the default constant detrending and mean average).
+
+    Parameters
+    ----------
+    recording: RecordingExtractor
+        The recording extractor
+    nperseg: int
+        Number of frames of each segment (limited to the number of frames of the recording)
+    noverlap: int
+        Number of frames of overlap between segments. If None, nperseg // 2
+    window: str, tuple or np.array
+        Window applied to each segment (see scipy.signal.get_window), or array of nperseg values
+    fraction: float
+        Fraction (between 0 and 1) of the recording used. If less than 1, chunks are randomly selected.
+    chunk_size: int
+        Approximate number of frames of each chunk (chunks contain whole segments)
+    seed: int
+        Random seed for the selection of the chunks
+    n_jobs: int
+        Number of threads reading and accumulating chunks in parallel
+    channel_ids: list
+        List of channel ids. If None, all channels are used
+    scaling: str
+        'density' (power spectral density, V**2/Hz) or 'spectrum' (power spectrum, V**2)
+
+    Returns
+    -------
+    freqs: np.array
+        (num_freqs,) array of frequencies
+    psd: np.array
+        (num_freqs, num_channels) array of power spectral densities (or power spectra)
+    '''
+    if scaling not in ['density', 'spectrum']:
+        raise ValueError("'scaling' must be either 'density' or 'spectrum'")
+    if channel_ids is None:
+        channel_ids = recording.get_channel_ids()
+    num_frames = recording.get_num_frames()
+    sampling_frequency = recording.get_sampling_frequency()
+    nperseg = min(nperseg, num_frames)
+    if noverlap is None:
+        noverlap = nperseg // 2
+    assert 0 <= noverlap < nperseg, "'noverlap' must be less than 'nperseg'"
+    win = _get_window(window, nperseg)
+    step = nperseg - noverlap
+    num_segments = (num_frames - nperseg) // step + 1
+    segments_per_chunk = max(chunk_size // step, 1)
+    # chunks are defined by their first segment, so that the segments do not depend on the chunk size
+    first_segments = np.arange(0, num_segments, segments_per_chunk)
+    if fraction < 1:
+        num_selected = max(int(round(fraction * len(first_segments))), 1)
+        first_segments = np.sort(np.random.RandomState(seed=seed).choice(first_segments, size=num_selected,
+                                                                         replace=False))
+
+    def _get_chunk_periodograms(first_segment):
+        last_segment = min(first_segment + segments_per_chunk, num_segments)
+        traces = recording.get_traces(channel_ids=channel_ids, start_frame=int(first_segment * step),
+                                      end_frame=int((last_segment - 1) * step + nperseg))
+        return _get_periodograms(traces.astype('float64'), win, step)
+
+    num_periodograms = 0
+    sum_periodograms = np.zeros((len(channel_ids), nperseg // 2 + 1))
+    for n, chunk_periodograms in _imap_windows(_get_chunk_periodograms, first_segments, n_jobs):
+        num_periodograms += n
+        sum_periodograms += chunk_periodograms
+    if scaling == 'density':
+        scale = 1. / (sampling_frequency * np.sum(win ** 2))
+    else:
+        scale = 1. / np.sum(win) ** 2
+    psd = sum_periodograms * (scale / num_periodograms)
+    # one-sided spectrum: the power of the negative frequencies is added, except for DC and Nyquist
+    if nperseg % 2 == 0:
+        psd[:, 1:-1] *= 2
+    else:
+        psd[:, 1:] *= 2
+    freqs = np.fft.rfftfreq(nperseg, d=1. / sampling_frequency)
+    return freqs, psd.T
+
+
+def _get_window(window, nperseg):
+    # window of 'nperseg' values, as in scipy.signal.welch
+    if isinstance(window, (str, tuple)):
+        assert HAVE_SS, "To compute power spectral densities, install scipy: \n\n pip install scipy\n\n"
+        return ss.get_window(window, nperseg)
+    window = np.asarray(window, dtype='float64')
+    assert window.shape == (nperseg,), "'window' must have 'nperseg' values"
+    return window
+
+
+def _get_periodograms(traces, window, step):
+    # number of segments and (num_channels, num_freqs) sum of the (unscaled) periodograms of the detrended and
+    # windowed segments of the traces, starting every 'step' frames
+    nperseg = len(window)
+    sum_periodograms = np.zeros((traces.shape[0], nperseg // 2 + 1))
+    starts = range(0, traces.shape[1] - nperseg + 1, step)
+    for start in starts:
+        segment = traces[:, start:start + nperseg]
+        spectrum = np.fft.rfft((segment - np.mean(segment, axis=1, keepdims=True)) * window, axis=1)
+        sum_periodograms += spectrum.real ** 2 + spectrum.imag ** 2
+    return len(starts), sum_periodograms
+
+
+# runtime state of the recordings, which does not change their traces
+# attributes that do not define the traces of a recording: identifiers, parallelism settings and runtime state
+# (caches, threads, scratch buffers), which change with the read history. The output
+# dtype is hashed through get_dtype() instead of '_dtype', which can be set lazily
+_FINGERPRINT_IGNORED_ATTRIBUTES = {'id', '_epochs', '_channel_properties', '_cache_key', '_cache_chunks',
+                                   '_filtered_cache_chunks', '_n_jobs', '_prefetch_chunks', '_fft_workers', '_traces',
+                                   'verbose', '_executor', '_prefetched_chunks', '_kernels', '_whitening_matrices',
+                                   '_thread_buffers', '_buffers', '_buffer_dtype', '_dtype'}
+
+
+def _update_traces_hash(h, recording, num_windows, window_size):
+    num_frames = recording.get_num_frames()
+    channel_ids = recording.get_channel_ids()
+    h.update(str(num_frames).encode())
+    h.update(str(float(recording.get_sampling_frequency())).encode())
+    h.update(str([str(ch) for ch in channel_ids]).encode())
+    window_size = min(window_size, num_frames)
+    for start_frame in np.linspace(0, num_frames - window_size, num_windows).astype('int64'):
+        traces = recording.get_traces(start_frame=int(start_frame), end_frame=int(start_frame) + window_size)
+        h.update(str(traces.dtype).encode())
+        h.update(np.ascontiguousarray(traces).tobytes())
+
+
+def _update_chain_hash(h, recording, num_windows, window_size, visited):
+    # hashes the classes and parameters of the lazy recordings 'recording' is computed from. Original recordings
+    # (without parent recordings) are identified by their data held in memory, their files and their sampled traces
+    if id(recording) in visited:
+        return
+    visited.add(id(recording))
+    h.update((type(recording).__module__ + '.' + type(recording).__name__).encode())
+    attributes = {name: value for name, value in vars(recording).items()
+                  if name not in _FINGERPRINT_IGNORED_ATTRIBUTES}
+    h.update(str(np.dtype(recording.get_dtype())).encode())
+    parents = {name: value for name, value in attributes.items() if isinstance(value, RecordingExtractor)}
+    if len(parents) == 0:
+        for name in sorted(attributes):
+            h.update(name.encode())
+            _update_leaf_value_hash(h, attributes[name])
+        _update_traces_hash(h, recording, num_windows, window_size)
+        return
+    for name in sorted(attributes):
+        if name in parents:
+            h.update(name.encode())
+            _update_chain_hash(h, parents[name], num_windows, window_size, visited)
+        else:
+            h.update(name.encode())
+            _update_value_hash(h, attributes[name])
+
+
+def _update_leaf_value_hash(h, value):
+    # attributes of an original recording: the whole data held in memory (e.g. NumpyRecordingExtractor), and the
+    # path, size and modification time of files (memory-mapped or given as paths)
+    if isinstance(value, np.memmap) and value.filename is not None:
+        value = str(value.filename)
+    if isinstance(value, (str, Path)):
+        h.update(str(value).encode())
+        if os.path.isfile(str(value)):
+            stat = os.stat(str(value))
+            h.update((str(stat.st_size) + '_' + str(stat.st_mtime_ns)).encode())
+    else:
+        _update_value_hash(h, value)
+
+
+def _update_value_hash(h, value):
+    # numbers, strings, arrays and lists or tuples of them. Other values (e.g. caches, threads) are not hashed
+    if value is None or isinstance(value, (bool, int, float, str)):
+        h.update(repr(value).encode())
+    elif isinstance(value, np.generic):
+        h.update(repr(value.item()).encode())
+    elif isinstance(value, np.dtype):
+        h.update(str(value).encode())
+    elif isinstance(value, np.ndarray) and value.dtype != object:
+        h.update((str(value.dtype) + str(value.shape)).encode())
+        h.update(np.ascontiguousarray(value).reshape(-1).view(np.uint8))
+    elif isinstance(value, (list, tuple)):
+        h.update(b'[')
+        for item in value:
+            _update_value_hash(h, item)
+        h.update(b']')
+
+
+def _get_chunk_windows(num_frames, chunk_size, num_chunks=None, fraction=None, seed=0):
+    # (start_frame, end_frame) of 'num_chunks' random chunks, or of a random 'fraction' of the consecutive chunks
+    if fraction is None:
+        chunk_size = min(chunk_size, num_frames)
+        starts = np.random.RandomState(seed=seed).randint(0, max(num_frames - chunk_size, 1), size=num_chunks)
+        return np.stack([starts, starts + chunk_size], axis=1)
+    starts = np.arange(0, num_frames, chunk_size)
+    if fraction < 1:
+        num_selected = max(int(round(fraction * len(starts))), 1)
+        starts = np.sort(np.random.RandomState(seed=seed).choice(starts, size=num_selected, replace=False))
+    return np.stack([starts, np.minimum(starts + chunk_size, num_frames)], axis=1)
+
+
+def _map_windows(func, windows, n_jobs):
+    # applies 'func' to each window, in parallel if n_jobs > 1, and returns the results in order
+    return list(_imap_windows(func, windows, n_jobs))
+
+
+def _imap_windows(func, windows, n_jobs):
+    # applies 'func' to each window, in parallel if n_jobs > 1, and yields the results in order. At most 2 * n_jobs
+    # windows are submitted ahead, so that results can be reduced as they arrive in bounded memory
+    if n_jobs <= 1:
+        for window in windows:
+            yield func(window)
+        return
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        futures = deque()
+        for window in windows:
+            futures.append(executor.submit(func, window))
+            if len(futures) >= 2 * n_jobs:
+                yield futures.popleft().result()
+        while len(futures) > 0:
+            yield futures.popleft().result()
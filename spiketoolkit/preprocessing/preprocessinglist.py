@@ -1,3 +1,7 @@
+from .preprocessing_tools import get_traces_multi, get_recording_fingerprint, get_covariance, get_random_data_chunks, \
+    get_quantiles, get_psd, QuantileSketch
+from .filterrecording import FilteredChunkCache, FilteredChunkDiskCache
+from .elementwiserecording import ElementwiseRecording
 from .bandpass_filter import bandpass_filter, BandpassFilterRecording
 from .notch_filter import notch_filter, NotchFilterRecording
 from .whiten import whiten, WhitenRecording
@@ -6,10 +10,11 @@ from .resample import resample, ResampleRecording
 from .rectify import rectify, RectifyRecording
 from .remove_artifacts import remove_artifacts, RemoveArtifactsRecording
 from .transform_traces import transform_traces, TransformTracesRecording
-from .remove_bad_channels import remove_bad_channels, RemoveBadChannelsRecording
+from .remove_bad_channels import remove_bad_channels, detect_bad_channels, RemoveBadChannelsRecording
 from .normalize_by_quantile import normalize_by_quantile, NormalizeByQuantileRecording
 from .clip_traces import clip_traces, ClipTracesRecording
 from .blank_saturation import blank_saturation, BlankSaturationRecording
+from .lfp import lfp, LFPRecording
 
 preprocessers_full_list = [
     BandpassFilterRecording,
@@ -23,7 +28,8 @@ preprocessers_full_list = [
     TransformTracesRecording,
     NormalizeByQuantileRecording,
     ClipTracesRecording,
-    BlankSaturationRecording
+    BlankSaturationRecording,
+    LFPRecording
 ]
 
 installed_preprocessers_list = [pp for pp in preprocessers_full_list if pp.installed]
@@ -1,38 +1,20 @@
-from spikeextractors import RecordingExtractor
-import numpy as np
+from .elementwiserecording import ElementwiseRecording
 
-class RectifyRecording(RecordingExtractor):
+class RectifyRecording(ElementwiseRecording):
 
     preprocessor_name = 'Rectify'
     installed = True  # check at class level if installed or not
-    preprocessor_gui_params = []
+    preprocessor_gui_params = [
+        {'name': 'dtype', 'type': 'dtype', 'value': None, 'default': None,
+         'title': "Traces dtype. If None, dtype is maintained."},
+    ]
     installation_mesg = ""  # err
 
-    def __init__(self, recording):
-        self._recording = recording
-        RecordingExtractor.__init__(self)
-        self.copy_channel_properties(recording)
+    def __init__(self, recording, dtype=None):
+        ElementwiseRecording.__init__(self, recording=recording, operations=[('abs',)], dtype=dtype)
 
-    def get_sampling_frequency(self):
-        return self._recording.get_sampling_frequency()
 
-    def get_num_frames(self):
-        return self._recording.get_num_frames()
-
-    def get_traces(self, channel_ids=None, start_frame=None, end_frame=None):
-        if start_frame is None:
-            start_frame = 0
-        if end_frame is None:
-            end_frame = self.get_num_frames()
-        if channel_ids is None:
-            channel_ids = self.get_channel_ids()
-        return np.abs(self._recording.get_traces(channel_ids=channel_ids, start_frame=start_frame, end_frame=end_frame))
-
-    def get_channel_ids(self):
-        return self._recording.get_channel_ids()
-
-
-def rectify(recording):
+def rectify(recording, dtype=None):
     '''
     Rectifies the recording extractor traces. It is useful, in combination with 'resample', to compute multi-unit
     activity (MUA).
@@ -41,6 +23,8 @@ def rectify(recording):
     ----------
     recording: RecordingExtractor
         The recording extractor object to be rectified
+    dtype: dtype
+        The dtype of the returned traces. If None, dtype is maintained.
 
     Returns
     -------
@@ -49,5 +33,6 @@ def rectify(recording):
 
     '''
     return RectifyRecording(
-        recording=recording
+        recording=recording,
+        dtype=dtype
     )
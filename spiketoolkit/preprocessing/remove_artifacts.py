@@ -1,5 +1,6 @@
 from spikeextractors import RecordingExtractor
 import numpy as np
+from .preprocessing_tools import get_traces_multi, QuantileSketch
 
 class RemoveArtifactsRecording(RecordingExtractor):
 
@@ -9,16 +10,28 @@ class RemoveArtifactsRecording(RecordingExtractor):
         {'name': 'triggers', 'type': 'int_list', 'title': "List of int with the stimulation trigger frames"},
         {'name': 'ms_before', 'type': 'float', 'value':0.5, 'default':0.5, 'title': "Time interval in ms to remove before the trigger events"},
         {'name': 'ms_after', 'type': 'float', 'value':3.0, 'default':3.0, 'title': "Time interval in ms to remove after the trigger events"},
+        {'name': 'mode', 'type': 'str', 'value': 'zeros', 'default': 'zeros', 'title':
+            "'zeros' (artifact windows are zeroed-out) or 'median_template' (a median artifact is subtracted)"},
     ]
     installation_mesg = ""  # err
 
-    def __init__(self, recording, triggers, ms_before=0.5, ms_after=3):
+    def __init__(self, recording, triggers, ms_before=0.5, ms_after=3, mode='zeros'):
         if not isinstance(recording, RecordingExtractor):
             raise ValueError("'recording' must be a RecordingExtractor")
+        if mode not in ['zeros', 'median_template']:
+            raise ValueError("'mode' must be either 'zeros' or 'median_template'")
         self._recording = recording
-        self._triggers = np.array(triggers)
+        self._triggers = np.sort(np.array(triggers, dtype='int64'))
         self._ms_before = ms_before
         self._ms_after = ms_after
+        self._mode = mode
+        fs = recording.get_sampling_frequency()
+        self._pad = [int(ms_before * fs / 1000), int(ms_after * fs / 1000)]
+        self._channel_idx = {chan: i for i, chan in enumerate(self._recording.get_channel_ids())}
+        if self._mode == 'median_template':
+            self._template = self._compute_template()
+        else:
+            self._template = None
         RecordingExtractor.__init__(self)
         self.copy_channel_properties(recording=self._recording)
 
@@ -38,27 +51,67 @@ class RemoveArtifactsRecording(RecordingExtractor):
             end_frame = self.get_num_frames()
         if channel_ids is None:
             channel_ids = self.get_channel_ids()
+        if isinstance(channel_ids, (int, np.integer)):
+            channel_ids = [channel_ids]
         traces = self._recording.get_traces(channel_ids=channel_ids, start_frame=start_frame, end_frame=end_frame)
-        triggers = self._triggers[(self._triggers > start_frame) & (self._triggers < end_frame)] - start_frame
-
-        pad = [int(self._ms_before * self.get_sampling_frequency() / 1000),
-               int(self._ms_after * self.get_sampling_frequency() / 1000)]
-
-        for trig in triggers:
-            if trig - pad[0] > 0 and trig + pad[1] < end_frame - start_frame:
-                traces[:, trig - pad[0]:trig + pad[1]] = 0
-            elif trig - pad[0] <= 0 and trig + pad[1] >= end_frame - start_frame:
-                traces = 0
-            elif trig - pad[0] <= 0:
-                traces[:, :trig + pad[1]] = 0
-            elif trig + pad[1] >= end_frame - start_frame:
-                traces[:, trig - pad[0]:] = 0
+        num_frames = end_frame - start_frame
+        # triggers whose window [trigger - pad before, trigger + pad after) overlaps the requested frames
+        i1, i2 = np.searchsorted(self._triggers, [start_frame - self._pad[1] + 1, end_frame + self._pad[0]])
+        triggers = self._triggers[i1:i2] - start_frame
+        if len(triggers) == 0:
+            return traces
+
+        if self._mode == 'zeros':
+            # the frames covered by any window are found with a single cumulative sum of window starts and ends
+            window_edges = np.zeros(num_frames + 1, dtype='int64')
+            np.add.at(window_edges, np.clip(triggers - self._pad[0], 0, num_frames), 1)
+            np.add.at(window_edges, np.clip(triggers + self._pad[1], 0, num_frames), -1)
+            mask = np.cumsum(window_edges[:-1]) > 0
+            # the parent traces can be a view or a memmap: they are copied before blanking
+            traces = traces.copy()
+            traces[:, mask] = 0
+        else:
+            channel_idx = [self._channel_idx[chan] for chan in channel_ids]
+            template = self._template[channel_idx]
+            traces = traces.astype(np.result_type(traces.dtype, template.dtype))
+            # frames of all windows and corresponding template frames (overlapping windows add up)
+            frames = triggers[:, np.newaxis] + np.arange(-self._pad[0], self._pad[1])[np.newaxis, :]
+            template_frames = np.broadcast_to(np.arange(template.shape[1]), frames.shape)
+            inside = (frames >= 0) & (frames < num_frames)
+            np.subtract.at(traces.T, frames[inside], template.T[template_frames[inside]])
         return traces
 
+    def get_template(self):
+        '''
+        Returns the (num_channels, num_frames) artifact template subtracted in 'median_template' mode (None in
+        'zeros' mode).
+        '''
+        return self._template
+
+    def _compute_template(self, batch_size=256):
+        # median across triggers of the windows fully inside the recording. The windows are read by batches of
+        # 'batch_size' triggers into a quantile sketch of each (channel, frame), so that the memory does not depend on
+        # the number of triggers: the median is exact up to 'batch_size' triggers, and approximated beyond
+        num_frames = self._recording.get_num_frames()
+        triggers = self._triggers[(self._triggers - self._pad[0] >= 0) & (self._triggers + self._pad[1] <= num_frames)]
+        assert len(triggers) > 0, "No trigger windows are inside the recording to compute the 'median_template'"
+        template_shape = (self._recording.get_num_channels(), self._pad[0] + self._pad[1])
+        sketch = QuantileSketch(num_channels=int(np.prod(template_shape)), sketch_size=batch_size)
+        for i in range(0, len(triggers), batch_size):
+            batch = triggers[i:i + batch_size]
+            windows = np.stack([batch - self._pad[0], batch + self._pad[1]], axis=1)
+            snippets = get_traces_multi(self._recording, windows=windows)
+            sketch.update(np.stack(snippets, axis=-1).reshape(-1, len(batch)))
+        return sketch.get_quantiles(0.5).reshape(template_shape).astype('float32')
+
+    def get_traces_multi(self, windows, channel_ids=None):
+        return get_traces_multi(self, windows=windows, channel_ids=channel_ids)
+
 
-def remove_artifacts(recording, triggers, ms_before=0.5, ms_after=3):
+def remove_artifacts(recording, triggers, ms_before=0.5, ms_after=3, mode='zeros'):
     '''
-    Removes stimulation artifacts from recording extractor traces. Artifact periods are zeroed-out.
+    Removes stimulation artifacts from recording extractor traces. Artifact periods are zeroed-out ('zeros' mode) or
+    a median artifact template is subtracted from them ('median_template' mode).
 
     Parameters
     ----------
@@ -70,6 +123,11 @@ def remove_artifacts(recording, triggers, ms_before=0.5, ms_after=3):
         Time interval in ms to remove before the trigger events
     ms_after: float
         Time interval in ms to remove after the trigger events
+    mode: str
+        'zeros' (default) or 'median_template'. With 'median_template', the per-channel median of the artifact
+        windows across all triggers is computed once and subtracted from each window (overlapping windows are
+        subtracted multiple times). Traces are then returned as float. The median is exact up to 256 triggers, and
+        estimated with a quantile sketch of bounded memory beyond.
 
     Returns
     -------
@@ -78,5 +136,5 @@ def remove_artifacts(recording, triggers, ms_before=0.5, ms_after=3):
 
     '''
     return RemoveArtifactsRecording(
-        recording=recording, triggers=triggers, ms_before=ms_before, ms_after=ms_after
+        recording=recording, triggers=triggers, ms_before=ms_before, ms_after=ms_after, mode=mode
     )
@@ -1,5 +1,10 @@
 from spikeextractors import RecordingExtractor, SubRecordingExtractor
 import numpy as np
+from .preprocessing_tools import get_traces_multi, _map_windows, _get_window, _get_periodograms, _RecordingCache
+
+# bad channel ids already detected, by recording object and parameters
+_bad_channels_cache = _RecordingCache()
+
 
 class RemoveBadChannelsRecording(RecordingExtractor):
 
@@ -10,17 +15,32 @@ class RemoveBadChannelsRecording(RecordingExtractor):
         {'name': 'bad_threshold', 'type': 'float', 'title': "Threshold in number of sd to remove channels (when automatic)"},
         {'name': 'seconds', 'type': 'float', 'title': "Number of seconds to compute standard deviation (when automatic)"},
         {'name': 'verbose', 'type': 'bool', 'title': "If True output is verbose"},
+        {'name': 'method', 'type': 'str', 'value': 'std', 'default': 'std',
+         'title': "Automatic detection method: 'std' or 'robust' (MAD, power spectrum and neighbour correlation)"},
+        {'name': 'num_windows', 'type': 'int', 'value': 1, 'default': 1,
+         'title': "Number of windows spread over the recording in which channels are tested (when automatic)"},
+        {'name': 'min_bad_fraction', 'type': 'float', 'value': 0.1, 'default': 0.1,
+         'title': "Minimum fraction of the windows in which a channel is bad to remove it (when automatic)"},
+        {'name': 'n_jobs', 'type': 'int', 'value': 1, 'default': 1,
+         'title': "Number of threads used to read and test windows in parallel (when automatic)"},
     ]
     installation_mesg = ""  # err
 
-    def __init__(self, recording, bad_channel_ids, bad_threshold, seconds, verbose):
+    def __init__(self, recording, bad_channel_ids, bad_threshold, seconds, verbose, method='std', num_windows=1,
+                 min_bad_fraction=0.1, n_jobs=1):
         if not isinstance(recording, RecordingExtractor):
             raise ValueError("'recording' must be a RecordingExtractor")
+        if method not in ['std', 'robust']:
+            raise ValueError("'method' must be either 'std' or 'robust'")
         self._recording = recording
         self._bad_channel_ids = bad_channel_ids
         self._bad_threshold = bad_threshold
         self._seconds = seconds
         self.verbose = verbose
+        self._method = method
+        self._num_windows = num_windows
+        self._min_bad_fraction = min_bad_fraction
+        self._n_jobs = n_jobs
         self._initialize_subrecording_extractor()
         RecordingExtractor.__init__(self)
         self.copy_channel_properties(recording=self._subrecording)
@@ -44,6 +64,16 @@ class RemoveBadChannelsRecording(RecordingExtractor):
         traces = self._subrecording.get_traces(channel_ids=channel_ids, start_frame=start_frame, end_frame=end_frame)
         return traces
 
+    def get_traces_multi(self, windows, channel_ids=None):
+        return get_traces_multi(self, windows=windows, channel_ids=channel_ids)
+
+    def get_bad_channel_ids(self):
+        '''
+        Returns the list of the removed channel ids.
+        '''
+        active_channels = set(self.active_channels)
+        return [chan for chan in self._recording.get_channel_ids() if chan not in active_channels]
+
     def _initialize_subrecording_extractor(self):
         if isinstance(self._bad_channel_ids, (list, np.ndarray)):
             active_channels = []
@@ -52,11 +82,10 @@ class RemoveBadChannelsRecording(RecordingExtractor):
                     active_channels.append(chan)
             self._subrecording = SubRecordingExtractor(self._recording, channel_ids=active_channels)
         elif self._bad_channel_ids is None:
-            start_frame = self._recording.get_num_frames() // 2
-            end_frame = int(start_frame + self._seconds * self._recording.get_sampling_frequency())
-            traces = self._recording.get_traces(start_frame=start_frame, end_frame=end_frame)
-            stds = np.std(traces, axis=1)
-            bad_channel_ids = [ch for ch, std in enumerate(stds) if std > self._bad_threshold * np.median(stds)]
+            bad_channel_ids = detect_bad_channels(self._recording, method=self._method,
+                                                  bad_threshold=self._bad_threshold, seconds=self._seconds,
+                                                  num_windows=self._num_windows,
+                                                  min_bad_fraction=self._min_bad_fraction, n_jobs=self._n_jobs)
             if self.verbose:
                 print('Automatically removing channels:', bad_channel_ids)
             active_channels = []
@@ -69,7 +98,131 @@ class RemoveBadChannelsRecording(RecordingExtractor):
         self.active_channels = self._subrecording.get_channel_ids()
 
 
-def remove_bad_channels(recording, bad_channel_ids=None, bad_threshold=2, seconds=10, verbose=False):
+def detect_bad_channels(recording, method='robust', bad_threshold=2, seconds=10, num_windows=10,
+                        min_bad_fraction=0.1, n_jobs=1, use_cache=False):
+    '''
+    Detects bad channels in windows spread evenly over the recording, so that channels which go bad partway through
+    a session are found. Windows are read and tested in parallel, and only per-window features are kept in memory.
+    In each window, the features of each channel are compared to their median over channels:
+
+        'std': channels whose standard deviation is above 'bad_threshold' times the median are bad.
+        'robust': channels are bad if their robust standard deviation (median absolute deviation) is above
+            'bad_threshold' times the median (noisy) or below the median divided by 'bad_threshold' (dead), if their
+            power in the upper band of the spectrum (above 80% of the Nyquist frequency) is above 'bad_threshold'
+            times the median (high-frequency noise), or, when channels share a common signal (median correlation
+            above 0.2), if their correlation with the mean of their neighbours is below the median divided by
+            'bad_threshold' (disconnected). Neighbours are the 4 closest channels if the recording has channel
+            locations, and the 4 adjacent channels otherwise.
+
+    A channel is removed if it is bad in at least 'min_bad_fraction' of the windows (and at least one). Results can
+    be cached for the same recording object.
+
+    Parameters
+    ----------
+    recording: RecordingExtractor
+        The recording extractor object
+    method: str
+        'std' or 'robust'
+    bad_threshold: float
+        Threshold on the ratio between the features of each channel and their median
+    seconds: float
+        Total number of seconds of the windows
+    num_windows: int
+        Number of windows
+    min_bad_fraction: float
+        Minimum fraction of the windows in which a channel is bad to remove it
+    n_jobs: int
+        Number of threads reading and testing windows in parallel
+    use_cache: bool
+        If True, results are cached in memory (for the same recording object and parameters, up to 64 results)
+
+    Returns
+    -------
+    bad_channel_ids: list
+        List of bad channel ids
+    '''
+    if method not in ['std', 'robust']:
+        raise ValueError("'method' must be either 'std' or 'robust'")
+    if use_cache:
+        params = (method, bad_threshold, seconds, num_windows, min_bad_fraction)
+        bad_channel_ids = _bad_channels_cache.get(recording, params)
+        if bad_channel_ids is not None:
+            return list(bad_channel_ids)
+    channel_ids = recording.get_channel_ids()
+    num_frames = recording.get_num_frames()
+    window_size = int(min(max(seconds * recording.get_sampling_frequency() / num_windows, 1), num_frames))
+    # windows centered in 'num_windows' equal parts of the recording (the middle of the recording for one window)
+    starts = np.minimum(((np.arange(num_windows) + 0.5) * num_frames / num_windows).astype('int64'),
+                        num_frames - window_size)
+    if method == 'robust':
+        neighbours = _get_neighbours(recording)
+
+    def _test_window(start_frame):
+        traces = recording.get_traces(start_frame=int(start_frame), end_frame=int(start_frame) + window_size)
+        if method == 'std':
+            stds = np.std(traces, axis=1)
+            return stds > bad_threshold * np.median(stds)
+        return _test_window_robust(traces.astype('float32'), recording.get_sampling_frequency(), neighbours,
+                                   bad_threshold)
+
+    bad_windows = np.array(_map_windows(_test_window, starts, n_jobs))
+    num_bad_windows = np.sum(bad_windows, axis=0)
+    min_bad_windows = max(int(np.ceil(min_bad_fraction * num_windows)), 1)
+    bad_channel_ids = [chan for chan, n in zip(channel_ids, num_bad_windows) if n >= min_bad_windows]
+    if use_cache:
+        _bad_channels_cache.set(recording, params, list(bad_channel_ids))
+    return bad_channel_ids
+
+
+def _test_window_robust(traces, sampling_frequency, neighbours, bad_threshold):
+    # bad channels (boolean array) of one window with the 'robust' features
+    traces -= np.median(traces, axis=1, keepdims=True)
+    mads = np.median(np.abs(traces), axis=1) / 0.6745
+    median_mad = np.median(mads)
+    bad = (mads > bad_threshold * median_mad) | (mads < median_mad / bad_threshold)
+
+    nperseg = min(1024, traces.shape[1])
+    _, periodograms = _get_periodograms(traces, _get_window('hann', nperseg), nperseg // 2)
+    freqs = np.fft.rfftfreq(nperseg, d=1. / sampling_frequency)
+    hf_power = np.sum(periodograms[:, freqs > 0.4 * sampling_frequency], axis=1)
+    bad |= hf_power > bad_threshold * np.median(hf_power)
+
+    # correlation with the mean of the neighbours
+    neighbours_mean = np.zeros_like(traces)
+    for k in range(neighbours.shape[1]):
+        neighbours_mean += traces[neighbours[:, k]]
+    norms = np.linalg.norm(traces, axis=1) * np.linalg.norm(neighbours_mean, axis=1)
+    correlations = np.sum(traces * neighbours_mean, axis=1) / np.maximum(norms, np.finfo('float32').tiny)
+    median_correlation = np.median(correlations)
+    if median_correlation > 0.2:
+        bad |= correlations < median_correlation / bad_threshold
+    return bad
+
+
+def _get_neighbours(recording, num_neighbours=4):
+    # (num_channels, num_neighbours) indices of the closest channels, or of the adjacent ones without locations
+    num_channels = recording.get_num_channels()
+    num_neighbours = min(num_neighbours, num_channels - 1)
+    if num_neighbours < 1:
+        return np.arange(num_channels)[:, None]
+    try:
+        locations = np.array(recording.get_channel_locations(), dtype='float64')
+    except Exception:
+        locations = None
+    if locations is not None and len(locations) == num_channels:
+        distances = np.linalg.norm(locations[:, None] - locations[None], axis=2)
+        np.fill_diagonal(distances, np.inf)
+        return np.argsort(distances, axis=1, kind='stable')[:, :num_neighbours]
+    offsets = np.array([offset for k in range(1, num_channels) for offset in [-k, k]])
+    neighbours = []
+    for i in range(num_channels):
+        idx = i + offsets
+        neighbours.append(idx[(idx >= 0) & (idx < num_channels)][:num_neighbours])
+    return np.array(neighbours)
+
+
+def remove_bad_channels(recording, bad_channel_ids=None, bad_threshold=2, seconds=10, verbose=False, method='std',
+                        num_windows=1, min_bad_fraction=0.1, n_jobs=1):
     '''
     Remove bad channels from the recording extractor.
 
@@ -80,11 +233,23 @@ def remove_bad_channels(recording, bad_channel_ids=None, bad_threshold=2, second
     bad_channel_ids: list
         List of bad channel ids (int). If None, automatic removal will be done based on standard deviation.
     bad_threshold: float
-        If automatic is used, the threshold for the standard deviation over which channels are removed
+        If automatic is used, the threshold for the standard deviation over which channels are removed (relative to
+        the median over channels)
     seconds: float
-        If automatic is used, the number of seconds used to compute standard deviations
+        If automatic is used, the number of seconds used to compute standard deviations (split in 'num_windows'
+        windows)
     verbose: bool
         If True, output is verbose
+    method: str
+        If automatic is used, 'std' (standard deviation) or 'robust' (median absolute deviation, high-frequency power
+        and correlation with the neighbour channels). See detect_bad_channels.
+    num_windows: int
+        If automatic is used, the number of windows spread over the recording in which channels are tested. With one
+        window, the middle of the recording is used.
+    min_bad_fraction: float
+        If automatic is used, the minimum fraction of the windows in which a channel is bad to remove it
+    n_jobs: int
+        If automatic is used, the number of threads used to read and test windows in parallel
 
     Returns
     -------
@@ -93,4 +258,5 @@ def remove_bad_channels(recording, bad_channel_ids=None, bad_threshold=2, second
 
     '''
     return RemoveBadChannelsRecording(recording=recording, bad_channel_ids=bad_channel_ids,
-                                      bad_threshold=bad_threshold, seconds=seconds, verbose=verbose)
+                                      bad_threshold=bad_threshold, seconds=seconds, verbose=verbose, method=method,
+                                      num_windows=num_windows, min_bad_fraction=min_bad_fraction, n_jobs=n_jobs)
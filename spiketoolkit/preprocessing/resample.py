@@ -1,5 +1,7 @@
 from spikeextractors import RecordingExtractor
+from fractions import Fraction
 import numpy as np
+from .preprocessing_tools import get_traces_multi
 
 try:
     from scipy import special, signal
@@ -13,14 +15,29 @@ class ResampleRecording(RecordingExtractor):
     installed = HAVE_RR  # check at class level if installed or not
     preprocessor_gui_params = [
         {'name': 'resample_rate', 'type': 'float', 'title': "The resampling frequency"},
+        {'name': 'engine', 'type': 'str', 'value': 'poly', 'default': 'poly', 'title':
+            "'poly' (chunked polyphase filtering) or 'fft' (scipy decimate or resample on each request)"},
+        {'name': 'chunk_size', 'type': 'int', 'value': 30000, 'default': 30000, 'title':
+            "Number of resampled frames computed at once (if 'poly')"},
     ]
     installation_mesg = "To use the ResampleRecording, install scipy: \n\n pip install scipy\n\n"  # err
 
 
-    def __init__(self, recording, resample_rate):
+    def __init__(self, recording, resample_rate, engine='poly', chunk_size=30000, max_denominator=10000):
         assert HAVE_RR, "To use the ResampleRecording, install scipy: \n\n pip install scipy\n\n"
+        if engine not in ['poly', 'fft']:
+            raise ValueError("'engine' must be either 'poly' or 'fft'")
         self._recording = recording
         self._resample_rate = resample_rate
+        self._engine = engine
+        self._chunk_size = chunk_size
+        # rational resampling factor: resampled frame j is at frame j * down / up of the recording
+        ratio = Fraction(float(resample_rate) / float(recording.get_sampling_frequency()))
+        ratio = ratio.limit_denominator(max_denominator)
+        self._up = ratio.numerator
+        self._down = ratio.denominator
+        # half length (in frames of the recording) of the anti-aliasing filter of resample_poly
+        self._padding = int(np.ceil(10 * max(self._up, self._down) / self._up)) + 1
         RecordingExtractor.__init__(self)
         self.copy_channel_properties(recording)
 
@@ -28,9 +45,13 @@ class ResampleRecording(RecordingExtractor):
         return self._resample_rate
 
     def get_num_frames(self):
+        if self._engine == 'poly':
+            return self._recording.get_num_frames() * self._up // self._down
         return int(self._recording.get_num_frames() / self._recording.get_sampling_frequency() * self._resample_rate)
 
     def get_traces(self, channel_ids=None, start_frame=None, end_frame=None):
+        if self._engine == 'poly':
+            return self._get_traces_poly(channel_ids=channel_ids, start_frame=start_frame, end_frame=end_frame)
         if start_frame is None:
             start_frame_not_sampled = 0
             start_frame_sampled = 0
@@ -57,14 +78,57 @@ class ResampleRecording(RecordingExtractor):
             traces_resampled = signal.resample(traces, int(end_frame_sampled - start_frame_sampled), axis=1)
         return traces_resampled
 
+    def _get_traces_poly(self, channel_ids=None, start_frame=None, end_frame=None):
+        if start_frame is None:
+            start_frame = 0
+        if end_frame is None:
+            end_frame = self.get_num_frames()
+        if channel_ids is None:
+            channel_ids = self.get_channel_ids()
+        if isinstance(channel_ids, (int, np.integer)):
+            channel_ids = [channel_ids]
+        traces = None
+        for chunk_start in range(start_frame, end_frame, self._chunk_size):
+            chunk_end = min(chunk_start + self._chunk_size, end_frame)
+            chunk = self._resample_chunk(chunk_start, chunk_end, channel_ids)
+            if traces is None:
+                traces = np.zeros((len(channel_ids), end_frame - start_frame), dtype=chunk.dtype)
+            traces[:, chunk_start - start_frame:chunk_end - start_frame] = chunk
+        if traces is None:
+            traces = np.zeros((len(channel_ids), 0))
+        return traces
+
+    def _resample_chunk(self, start_frame, end_frame, channel_ids):
+        # The recording is read from a multiple of 'down' frames, so that the output of resample_poly falls on the
+        # grid of resampled frames, with enough padding on both sides for the filter. Each resampled frame is then
+        # the same whatever the requested window.
+        up, down = self._up, self._down
+        i1 = ((start_frame * down) // up - self._padding) // down * down
+        i2 = -(-(end_frame * down) // up) + self._padding
+        num_frames = self._recording.get_num_frames()
+        i1b = max(i1, 0)
+        i2b = min(i2, num_frames)
+        raw_traces = self._recording.get_traces(channel_ids=channel_ids, start_frame=i1b, end_frame=i2b)
+        # frames outside of the recording are zeros, as at the edges of resample_poly
+        padded_traces = np.zeros((len(channel_ids), i2 - i1), dtype=np.result_type(raw_traces.dtype, 'float32'))
+        padded_traces[:, i1b - i1:i2b - i1] = raw_traces
+        resampled = signal.resample_poly(padded_traces, up, down, axis=1)
+        offset = start_frame - i1 * up // down
+        return resampled[:, offset:offset + end_frame - start_frame]
+
+    def get_traces_multi(self, windows, channel_ids=None):
+        return get_traces_multi(self, windows=windows, channel_ids=channel_ids)
+
     def get_channel_ids(self):
         return self._recording.get_channel_ids()
 
 
-def resample(recording, resample_rate):
+def resample(recording, resample_rate, engine='poly', chunk_size=30000, max_denominator=10000):
     '''
-    Resamples the recording extractor traces. If the resampling rate is multiple of the sampling rate, the faster
-    scipy decimate function is used.
+    Resamples the recording extractor traces. With the 'poly' engine, traces are resampled chunk by chunk with the
+    scipy resample_poly function (polyphase filtering with rational up/down factors). With the 'fft' engine, if the
+    resampling rate is multiple of the sampling rate, the scipy decimate function is used, otherwise the scipy
+    resample function is applied on each requested window.
 
     Parameters
     ----------
@@ -72,6 +136,14 @@ def resample(recording, resample_rate):
         The recording extractor to be resampled
     resample_rate: int or float
         The resampling frequency
+    engine: str
+        'poly' (default) or 'fft'. The 'poly' engine returns the same resampled frames for any requested window and
+        only reads the requested window plus the filter padding, so memory is bounded by 'chunk_size'.
+    chunk_size: int
+        Number of resampled frames computed at once with the 'poly' engine
+    max_denominator: int
+        Maximum denominator of the rational approximation up / down of resample_rate / sampling_frequency used by
+        the 'poly' engine
 
     Returns
     -------
@@ -81,5 +153,8 @@ def resample(recording, resample_rate):
     '''
     return ResampleRecording(
         recording=recording,
-        resample_rate=resample_rate
+        resample_rate=resample_rate,
+        engine=engine,
+        chunk_size=chunk_size,
+        max_denominator=max_denominator
     )
@@ -0,0 +1,273 @@
+import numpy as np
+from .filterrecording import _check_sos_stability, _get_sos_padding
+from .common_reference import _fast_median
+
+try:
+    import scipy.signal as ss
+    HAVE_SS = True
+except ImportError:
+    HAVE_SS = False
+
+try:
+    import scipy.sparse as sparse
+    HAVE_SPARSE = True
+except ImportError:
+    HAVE_SPARSE = False
+
+
+class StreamingPipeline():
+    '''
+    Push-based counterpart of Pipeline for online preprocessing (e.g. during acquisition). Blocks of incoming samples
+    are pushed one at a time and a preprocessed block of the same length is returned, delayed by a fixed latency
+    (see get_latency). The state kept between blocks (filter states and overlap buffers) has a bounded size, which
+    does not depend on the length of the stream.
+
+    Available stages are:
+        'BandpassFilter' (freq_min=300, freq_max=6000, order=3, causal=True, hop=None): butterworth bandpass filter
+        'NotchFilter' (freq=3000, q=30, causal=True, hop=None): notch filter
+        'CommonReference' (reference='median', groups=None, ref_channels=None): 'median', 'average' or 'single'
+            reference, as in common_reference
+        'Whiten' (whitening_matrix): multiplication by a frozen (num_channels, num_channels) whitening matrix (dense,
+            or scipy.sparse as in the 'local' mode of whiten), e.g. the one estimated offline by whiten on a previous
+            recording
+        'ClipTraces' (a_min=None, a_max=None): clipping of the traces
+
+    Causal filters, re-referencing, whitening and clipping add no latency. Zero-phase filters (causal=False) need
+    'padding' samples of context on both sides (derived from the impulse response of the filter). Incoming samples
+    are buffered and filtered by multiples of 'hop' samples (default: the padding) once their following context has
+    arrived, so each sample is filtered (hop + 2 * padding) / hop times on average, whatever the block sizes. They
+    add a latency of padding + hop - 1 frames, and buffer at most 2 * padding + hop frames between pushes.
+
+    Parameters
+    ----------
+    stages: list
+        Ordered list of stages. Each stage is a stage name or a tuple (name, dict of parameters), e.g.
+        [('BandpassFilter', {'freq_min': 300}), 'CommonReference', ('ClipTraces', {'a_min': -500, 'a_max': 500})].
+    num_channels: int
+        Number of channels of the pushed blocks
+    sampling_frequency: float
+        The sampling frequency of the stream
+    channel_ids: list
+        The channel ids of the stream, used by the 'groups' and 'ref_channels' of 'CommonReference'. If None,
+        channel ids are range(num_channels).
+    dtype: dtype
+        The dtype used for processing and of the returned blocks (default float32)
+    '''
+    def __init__(self, stages, num_channels, sampling_frequency, channel_ids=None, dtype='float32'):
+        if channel_ids is None:
+            channel_ids = list(range(num_channels))
+        assert len(channel_ids) == num_channels, "'channel_ids' must have 'num_channels' elements"
+        self._num_channels = num_channels
+        self._sampling_frequency = float(sampling_frequency)
+        self._channel_ids = list(channel_ids)
+        self._dtype = np.dtype(dtype)
+        self._stages = []
+        for stage in stages:
+            if isinstance(stage, (tuple, list)):
+                name, params = stage
+            else:
+                name, params = stage, {}
+            if name not in streaming_stage_dict:
+                raise ValueError("'" + str(name) + "' is not a streaming stage. Available stages are: " +
+                                 str(list(streaming_stage_dict.keys())))
+            self._stages.append(streaming_stage_dict[name](self, **params))
+        self._latency = int(sum(stage.latency for stage in self._stages))
+
+    def get_latency(self):
+        '''
+        Returns the latency (in frames) of the pipeline: each returned block starts 'latency' frames before the
+        pushed one. The first 'latency' returned frames precede the start of the stream.
+        '''
+        return self._latency
+
+    def get_num_channels(self):
+        return self._num_channels
+
+    def get_channel_ids(self):
+        return list(self._channel_ids)
+
+    def get_sampling_frequency(self):
+        return self._sampling_frequency
+
+    def push(self, block):
+        '''
+        Processes a block of incoming samples.
+
+        Parameters
+        ----------
+        block: np.array
+            (num_channels, num_frames) array with the new samples
+
+        Returns
+        -------
+        traces: np.array
+            (num_channels, num_frames) array with the preprocessed samples, delayed by get_latency() frames
+        '''
+        block = np.asarray(block)
+        if block.ndim != 2 or block.shape[0] != self._num_channels:
+            raise ValueError("'block' must be a (num_channels, num_frames) array")
+        traces = block.astype(self._dtype)
+        if traces.shape[1] == 0:
+            return traces
+        for stage in self._stages:
+            traces = stage.process(traces)
+        return traces
+
+    def flush(self):
+        '''
+        Returns the last get_latency() preprocessed frames, still buffered at the end of the stream (by pushing
+        zeros).
+        '''
+        return self.push(np.zeros((self._num_channels, self._latency), dtype=self._dtype))
+
+    def reset(self):
+        '''
+        Clears the state of all stages, e.g. to start a new stream.
+        '''
+        for stage in self._stages:
+            stage.reset()
+
+
+class _StreamingStage():
+    latency = 0
+
+    def process(self, traces):
+        raise NotImplementedError
+
+    def reset(self):
+        pass
+
+
+class _StreamingSOSFilter(_StreamingStage):
+    def __init__(self, pipeline, sos, causal, hop=None):
+        assert HAVE_SS, "To use the streaming filters, install scipy: \n\n pip install scipy\n\n"
+        _check_sos_stability(sos)
+        self._sos = sos.astype(pipeline._dtype)
+        self._num_channels = pipeline.get_num_channels()
+        self._causal = causal
+        if causal:
+            self.latency = 0
+            self._padding = 0
+        else:
+            self._padding = _get_sos_padding(sos)
+            if hop is None:
+                hop = self._padding
+            self._hop = max(int(hop), 1)
+            self.latency = self._padding + self._hop - 1
+        self.reset()
+
+    def reset(self):
+        if self._causal:
+            self._zi = np.zeros((self._sos.shape[0], self._num_channels, 2), dtype=self._sos.dtype)
+        else:
+            # the stream is preceded by 2 * padding zeros. The buffer keeps the last 2 * padding filtered samples
+            # (context) followed by the samples received since (less than 'hop')
+            self._buffer = np.zeros((self._num_channels, 2 * self._padding + self._hop), dtype=self._sos.dtype)
+            self._num_buffered = 2 * self._padding
+            # filtered samples not returned yet, starting with the (hop - 1) frames of the latency
+            self._queue = np.zeros((self._num_channels, self._hop - 1), dtype=self._sos.dtype)
+
+    def process(self, traces):
+        if self._causal:
+            filtered, self._zi = ss.sosfilt(self._sos, traces, axis=1, zi=self._zi)
+            return filtered
+        P = self._padding
+        num_frames = traces.shape[1]
+        # samples are filtered by multiples of 'hop', once 'padding' samples of context follow them
+        num_filtered = (self._num_buffered + num_frames - 2 * P) // self._hop * self._hop
+        if num_filtered == 0:
+            self._buffer[:, self._num_buffered:self._num_buffered + num_frames] = traces
+            self._num_buffered += num_frames
+            output = self._queue[:, :num_frames]
+            self._queue = self._queue[:, num_frames:]
+            return output
+        stream = np.concatenate([self._buffer[:, :self._num_buffered], traces], axis=1)
+        filtered = ss.sosfiltfilt(self._sos, stream[:, :2 * P + num_filtered], axis=1)
+        self._num_buffered = stream.shape[1] - num_filtered
+        self._buffer[:, :self._num_buffered] = stream[:, num_filtered:]
+        queue = np.concatenate([self._queue, filtered[:, P:P + num_filtered]], axis=1)
+        self._queue = queue[:, num_frames:]
+        return queue[:, :num_frames]
+
+
+class _StreamingBandpassFilter(_StreamingSOSFilter):
+    def __init__(self, pipeline, freq_min=300, freq_max=6000, order=3, causal=True, hop=None):
+        fn = pipeline.get_sampling_frequency() / 2.
+        band = np.array([freq_min, freq_max]) / fn
+        sos = ss.butter(order, band, btype='bandpass', output='sos')
+        _StreamingSOSFilter.__init__(self, pipeline, sos, causal, hop)
+
+
+class _StreamingNotchFilter(_StreamingSOSFilter):
+    def __init__(self, pipeline, freq=3000, q=30, causal=True, hop=None):
+        fn = 0.5 * pipeline.get_sampling_frequency()
+        b, a = ss.iirnotch(freq / fn, q)
+        _StreamingSOSFilter.__init__(self, pipeline, ss.tf2sos(b, a), causal, hop)
+
+
+class _StreamingCommonReference(_StreamingStage):
+    def __init__(self, pipeline, reference='median', groups=None, ref_channels=None):
+        if reference not in ['median', 'average', 'single']:
+            raise ValueError("'reference' must be either 'median', 'average' or 'single'")
+        channel_ids = pipeline.get_channel_ids()
+        self._ref = reference
+        if groups is None:
+            groups = [channel_ids]
+        self._group_idx = [np.array([channel_ids.index(chan) for chan in group if chan in channel_ids])
+                           for group in groups]
+        if reference == 'single':
+            assert ref_channels is not None, "With 'single' reference, provide 'ref_channels'"
+            if isinstance(ref_channels, (int, np.integer)):
+                ref_channels = [ref_channels]
+            assert len(ref_channels) == len(groups), "'ref_channel' and 'groups' must have the same length"
+            self._ref_idx = [channel_ids.index(chan) for chan in ref_channels]
+
+    def process(self, traces):
+        if self._ref == 'single':
+            # reference channels are copied first, since they can belong to a group re-referenced before
+            references = traces[self._ref_idx]
+            for i, group_idx in enumerate(self._group_idx):
+                traces[group_idx] -= references[i:i + 1]
+            return traces
+        for group_idx in self._group_idx:
+            if self._ref == 'median':
+                traces[group_idx] -= _fast_median(traces[group_idx], dtype=traces.dtype)
+            elif self._ref == 'average':
+                traces[group_idx] -= np.mean(traces[group_idx], axis=0, keepdims=True)
+        return traces
+
+
+class _StreamingWhiten(_StreamingStage):
+    def __init__(self, pipeline, whitening_matrix):
+        # dense array, or scipy.sparse matrix (e.g. the one of the 'local' mode of whiten)
+        if HAVE_SPARSE and sparse.issparse(whitening_matrix):
+            whitening_matrix = sparse.csr_matrix(whitening_matrix)
+        else:
+            whitening_matrix = np.asarray(whitening_matrix)
+        num_channels = pipeline.get_num_channels()
+        assert whitening_matrix.shape == (num_channels, num_channels), \
+            "'whitening_matrix' must be a (num_channels, num_channels) array or sparse matrix"
+        self._whitening_matrix = whitening_matrix.astype(pipeline._dtype)
+
+    def process(self, traces):
+        return self._whitening_matrix @ traces
+
+
+class _StreamingClipTraces(_StreamingStage):
+    def __init__(self, pipeline, a_min=None, a_max=None):
+        self._a_min = a_min
+        self._a_max = a_max
+
+    def process(self, traces):
+        if self._a_min is not None or self._a_max is not None:
+            np.clip(traces, self._a_min, self._a_max, out=traces)
+        return traces
+
+
+streaming_stage_dict = {
+    'BandpassFilter': _StreamingBandpassFilter,
+    'NotchFilter': _StreamingNotchFilter,
+    'CommonReference': _StreamingCommonReference,
+    'Whiten': _StreamingWhiten,
+    'ClipTraces': _StreamingClipTraces,
+}
@@ -1,46 +1,25 @@
-from spikeextractors import RecordingExtractor
-import numpy as np
+from .elementwiserecording import ElementwiseRecording
 
-class TransformTracesRecording(RecordingExtractor):
+
+class TransformTracesRecording(ElementwiseRecording):
 
     preprocessor_name = 'TransformTraces'
     installed = True  # check at class level if installed or not
     preprocessor_gui_params = [
         {'name': 'scalar', 'type': 'float', 'title': "Scalar for the traces of the recording extractor"},
         {'name': 'offset', 'type': 'float', 'title': "Offset for the traces of the recording extractor"},
+        {'name': 'dtype', 'type': 'dtype', 'value': None, 'default': None,
+         'title': "Traces dtype. If None, float dtypes are maintained and integer traces are converted to float64."},
     ]
     installation_mesg = ""  # err
 
-    def __init__(self, recording, scalar=1, offset=0):
-        if not isinstance(recording, RecordingExtractor):
-            raise ValueError("'recording' must be a RecordingExtractor")
-        self._recording = recording
+    def __init__(self, recording, scalar=1, offset=0, dtype=None):
         self._scalar = scalar
         self._offset = offset
-        RecordingExtractor.__init__(self)
-        self.copy_channel_properties(recording=self._recording)
-
-    def get_sampling_frequency(self):
-        return self._recording.get_sampling_frequency()
-
-    def get_num_frames(self):
-        return self._recording.get_num_frames()
-
-    def get_channel_ids(self):
-        return self._recording.get_channel_ids()
-
-    def get_traces(self, channel_ids=None, start_frame=None, end_frame=None):
-        if start_frame is None:
-            start_frame = 0
-        if end_frame is None:
-            end_frame = self.get_num_frames()
-        if channel_ids is None:
-            channel_ids = self.get_channel_ids()
-        traces = self._recording.get_traces(channel_ids=channel_ids, start_frame=start_frame, end_frame=end_frame)
-        return traces*self._scalar + self._offset
+        ElementwiseRecording.__init__(self, recording=recording, operations=[('scale', scalar, offset)], dtype=dtype)
 
 
-def transform_traces(recording, scalar=1, offset=0):
+def transform_traces(recording, scalar=1, offset=0, dtype=None):
     '''
     Transforms the traces from the given recording extractor with a scalar
     and offset. New traces = traces*scalar + offset.
@@ -49,15 +28,18 @@ def transform_traces(recording, scalar=1, offset=0):
     ----------
     recording: RecordingExtractor
         The recording extractor to be transformed
-    scalar: float
-        Scalar for the traces of the recording extractor
-    offset: float
-        Offset for the traces of the recording extractor
+    scalar: float or array-like
+        Scalar for the traces of the recording extractor (or one scalar per channel)
+    offset: float or array-like
+        Offset for the traces of the recording extractor (or one offset per channel)
+    dtype: dtype
+        The dtype of the returned traces. If None, float dtypes are maintained and integer traces are converted to
+        float64.
     Returns
     -------
     transform_traces: TransformTracesRecording
         The transformed traces recording extractor object
     '''
     return TransformTracesRecording(
-        recording=recording, scalar=scalar, offset=offset
+        recording=recording, scalar=scalar, offset=offset, dtype=dtype
     )
@@ -1,6 +1,17 @@
 from .filterrecording import FilterRecording
+from .preprocessing_tools import get_covariance, get_random_data_chunks, get_recording_fingerprint
+from pathlib import Path
+import hashlib
+import json
 import numpy as np
 
+try:
+    import scipy.sparse as sparse
+    from scipy.spatial import cKDTree
+    HAVE_SPARSE = True
+except ImportError:
+    HAVE_SPARSE = False
+
 
 class WhitenRecording(FilterRecording):
 
@@ -13,51 +24,165 @@ class WhitenRecording(FilterRecording):
             "If True filtered traces are computed and cached"},
          {'name': 'seed', 'type': 'int', 'value': 0, 'default': 0, 
           'title': "Random seed for reproducibility."},
+        {'name': 'n_jobs', 'type': 'int', 'value': 1, 'default': 1, 'title':
+            "Number of threads used to whiten chunks in parallel"},
+        {'name': 'prefetch_chunks', 'type': 'int', 'value': 0, 'default': 0, 'title':
+            "Number of chunks whitened ahead in the background during sequential reads"},
+        {'name': 'mode', 'type': 'str', 'value': 'global', 'default': 'global', 'title':
+            "'global' (all channels) or 'local' (each channel is whitened with its neighbours within 'radius')"},
+        {'name': 'radius', 'type': 'float', 'value': 100.0, 'default': 100.0, 'title':
+            "Radius (in the units of the channel locations) of the neighbourhoods (if 'local')"},
+        {'name': 'eps', 'type': 'float', 'value': 0.0, 'default': 0.0, 'title':
+            "Regularization added to the eigenvalues of the covariance matrix"},
+        {'name': 'dtype', 'type': 'dtype', 'value': None, 'default': None, 'title':
+            "Traces dtype. If None, dtype is maintained."},
+        {'name': 'fraction', 'type': 'float', 'value': None, 'default': None, 'title':
+            "If given, fraction of the recording scanned to estimate the covariance (otherwise 50 random snippets)"},
+        {'name': 'whitening_folder', 'type': 'str', 'value': None, 'default': None, 'title':
+            "If given, the whitening matrix is saved in (and loaded from) this folder"},
     ]
     installation_mesg = ""  # err
+    _process_traces_out = True  # _process_traces can write into an output buffer
 
-    def __init__(self, recording, chunk_size=30000, cache_chunks=False, seed=0):
+    def __init__(self, recording, chunk_size=30000, cache_chunks=False, seed=0, n_jobs=1, prefetch_chunks=0,
+                 mode='global', radius=100, eps=0, dtype=None, fraction=None, whitening_matrix=None,
+                 whitening_folder=None):
+        if mode not in ['global', 'local']:
+            raise ValueError("'mode' must be either 'global' or 'local'")
         self._recording = recording
-        self._whitening_matrix = self._compute_whitening_matrix(seed=seed)
-        FilterRecording.__init__(self, recording=recording, chunk_size=chunk_size, cache_chunks=cache_chunks)
-
-    def _get_random_data_for_whitening(self, num_chunks=50, chunk_size=500, seed=0):
-        N = self._recording.get_num_frames()
-        random_ints = np.random.RandomState(seed=seed).randint(0, N - chunk_size, size=num_chunks)
-        chunk_list = []
-        for ff in random_ints:
-            chunk = self._recording.get_traces(start_frame=ff,
-                                               end_frame=ff + chunk_size)
-            chunk_list.append(chunk)
-        return np.concatenate(chunk_list, axis=1)
-
-    def _compute_whitening_matrix(self, seed):
-        data = self._get_random_data_for_whitening(seed=seed)
-        
-        # center the data
-        data = data - np.mean(data, axis=1, keepdims=True)
-        
+        self._mode = mode
+        self._radius = radius
+        self._eps = eps
+        self._seed = seed
+        self._fraction = fraction
+        if whitening_matrix is not None:
+            if not (HAVE_SPARSE and sparse.issparse(whitening_matrix)):
+                whitening_matrix = np.asarray(whitening_matrix, dtype='float64')
+            num_channels = recording.get_num_channels()
+            if whitening_matrix.shape != (num_channels, num_channels):
+                raise ValueError("'whitening_matrix' must be a (num_channels, num_channels) matrix")
+            self._whitening_matrix = whitening_matrix
+        elif whitening_folder is not None:
+            self._whitening_matrix = self._load_or_compute_whitening_matrix(whitening_folder, chunk_size, n_jobs)
+        else:
+            self._whitening_matrix = self._compute_whitening_matrix(seed=seed, chunk_size=chunk_size, n_jobs=n_jobs)
+        self._whitening_matrices = dict()
+        FilterRecording.__init__(self, recording=recording, chunk_size=chunk_size, cache_chunks=cache_chunks,
+                                 n_jobs=n_jobs, prefetch_chunks=prefetch_chunks, dtype=dtype)
+
+    def get_whitening_matrix(self):
+        '''
+        Returns the whitening matrix (dense np.array, or scipy.sparse matrix in 'local' mode). It can be passed as
+        'whitening_matrix' to whiten the same data (e.g. in other processes) without estimating it again.
+        '''
+        return self._whitening_matrix
+
+    def _compute_whitening_matrix(self, seed, chunk_size=30000, n_jobs=1):
+        if self._fraction is None:
+            data = get_random_data_chunks(self._recording, seed=seed, n_jobs=n_jobs)
+
+            # center the data
+            data = data - np.mean(data, axis=1, keepdims=True)
+            AAt = data @ np.transpose(data)
+            AAt = AAt / data.shape[1]
+        else:
+            AAt = get_covariance(self._recording, chunk_size=chunk_size, fraction=self._fraction, seed=seed,
+                                 n_jobs=n_jobs)
+
+        if self._mode == 'local':
+            return self._compute_local_whitening_matrix(AAt)
+
         # Original by Jeremy
-        AAt = data @ np.transpose(data)
-        AAt = AAt / data.shape[1]
         U, S, Ut = np.linalg.svd(AAt, full_matrices=True)
-        W = (U @ np.diag(1 / np.sqrt(S))) @ Ut
+        W = (U @ np.diag(1 / np.sqrt(S + self._eps))) @ Ut
         
         # proposed by Alessio
-        # AAt = data @ data.T / data.shape[1]
-        # D, V = np.linalg.eig(AAt)
-        # W = np.dot(np.diag(1.0 / np.sqrt(D + 1e-10)), V)
+        # AAt = data @ data.T / data.shape[1]
+        # D, V = np.linalg.eig(AAt)
+        # W = np.dot(np.diag(1.0 / np.sqrt(D + 1e-10)), V)
         
         return W
 
-    def filter_chunk(self, *, start_frame, end_frame):
+    def _compute_local_whitening_matrix(self, AAt):
+        # Each channel is whitened with the channels within 'radius': its row of the whitening matrix is the one of
+        # the whitening matrix of the covariance of its neighbourhood. The matrix is sparse (num_channels x
+        # num_channels, with one non-zero per neighbour), so applying it is linear in the number of channels.
+        assert HAVE_SPARSE, "To use the 'local' whitening, install scipy: \n\n pip install scipy\n\n"
+        locations = np.array(self._recording.get_channel_locations(), dtype='float64')
+        neighbourhoods = cKDTree(locations).query_ball_point(locations, r=self._radius)
+        rows = []
+        cols = []
+        values = []
+        for i, neighbours in enumerate(neighbourhoods):
+            neighbours = np.sort(np.array(neighbours, dtype='int64'))
+            U, S, Ut = np.linalg.svd(AAt[np.ix_(neighbours, neighbours)], full_matrices=True)
+            W_local = (U @ np.diag(1 / np.sqrt(S + self._eps))) @ Ut
+            rows.extend([i] * len(neighbours))
+            cols.extend(neighbours)
+            values.extend(W_local[np.searchsorted(neighbours, i)])
+        num_channels = len(locations)
+        return sparse.csr_matrix((values, (rows, cols)), shape=(num_channels, num_channels))
+
+    def _load_or_compute_whitening_matrix(self, whitening_folder, chunk_size, n_jobs):
+        # the file is identified by the recording fingerprint and by the parameters of the estimation, so that the
+        # same whitening matrix is reused by other processes and sessions. The channel ids and number of frames of the
+        # recording are saved alongside and checked when loading: the matrix is estimated again if they differ
+        h = hashlib.sha1()
+        h.update(get_recording_fingerprint(self._recording).encode())
+        h.update(str([self._mode, self._radius, self._eps, self._seed, self._fraction]).encode())
+        if self._fraction is not None:
+            h.update(str(chunk_size).encode())
+        whitening_folder = Path(whitening_folder)
+        whitening_folder.mkdir(parents=True, exist_ok=True)
+        if self._mode == 'local':
+            whitening_file = whitening_folder / ('whitening_' + h.hexdigest() + '.npz')
+        else:
+            whitening_file = whitening_folder / ('whitening_' + h.hexdigest() + '.npy')
+        info_file = whitening_folder / ('whitening_' + h.hexdigest() + '.json')
+        info = {'channel_ids': [str(chan) for chan in self._recording.get_channel_ids()],
+                'num_frames': int(self._recording.get_num_frames())}
+        if whitening_file.is_file() and info_file.is_file():
+            with info_file.open('r') as f:
+                saved_info = json.load(f)
+            if saved_info == info:
+                if self._mode == 'local':
+                    return sparse.load_npz(str(whitening_file))
+                else:
+                    return np.load(str(whitening_file))
+        W = self._compute_whitening_matrix(seed=self._seed, chunk_size=chunk_size, n_jobs=n_jobs)
+        if self._mode == 'local':
+            sparse.save_npz(str(whitening_file), W)
+        else:
+            np.save(str(whitening_file), W)
+        with info_file.open('w') as f:
+            json.dump(info, f)
+        return W
+
+    def filter_chunk(self, *, start_frame, end_frame, channel_ids=None):
         chunk = self._recording.get_traces(start_frame=start_frame, end_frame=end_frame)
-        chunk = chunk - np.mean(chunk, axis=1, keepdims=True)
-        chunk2 = self._whitening_matrix @ chunk
-        return chunk2
+        return self._process_traces(chunk.astype(self._get_filter_dtype(), copy=False))
+
+    def _process_traces(self, traces, out=None):
+        # with 'out' (used by Pipeline), 'traces' is a scratch buffer: the mean is removed in place and the product
+        # with a dense whitening matrix is written into 'out'
+        whitening_matrix = self._get_whitening_matrix(traces.dtype)
+        if out is None or not isinstance(whitening_matrix, np.ndarray) or out.dtype != traces.dtype:
+            traces = traces - np.mean(traces, axis=1, keepdims=True)
+            return whitening_matrix @ traces
+        traces -= np.mean(traces, axis=1, keepdims=True)
+        return np.matmul(whitening_matrix, traces, out=out)
+
+    def _get_whitening_matrix(self, dtype):
+        # the (dense or sparse) whitening matrix in the dtype of the traces, so that float32 traces are whitened in
+        # float32
+        dtype = np.result_type(dtype, 'float32')
+        if dtype not in self._whitening_matrices:
+            self._whitening_matrices[dtype] = self._whitening_matrix.astype(dtype)
+        return self._whitening_matrices[dtype]
 
 
-def whiten(recording, chunk_size=30000, cache_chunks=False, seed=0):
+def whiten(recording, chunk_size=30000, cache_chunks=False, seed=0, n_jobs=1, prefetch_chunks=0, mode='global',
+           radius=100, eps=0, dtype=None, fraction=None, whitening_matrix=None, whitening_folder=None):
     '''
     Whitens the recording extractor traces.
 
@@ -67,10 +192,38 @@ def whiten(recording, chunk_size=30000, cache_chunks=False, seed=0):
         The recording extractor to be whitened.
     chunk_size: int
         The chunk size to be used for the filtering.
-    cache_chunks: bool
-        If True, filtered traces are computed and cached all at once (default False).
+    cache_chunks: bool or FilteredChunkCache
+        If True, filtered chunks are cached in memory (default False). A FilteredChunkCache can be passed to share
+        the same memory budget between several filters.
     seed: int
         Random seed for reproducibility
+    n_jobs: int
+        Number of threads used to whiten in parallel the chunks of a request spanning several chunks (default 1)
+    prefetch_chunks: int
+        Number of following chunks whitened in the background after each request, to speed up sequential reads
+        (default 0)
+    mode: str
+        'global' (default) or 'local'. With 'global', all channels are whitened together with a dense whitening
+        matrix. With 'local', each channel is whitened using only its neighbours within 'radius' (using the
+        'location' property), with a sparse whitening matrix: the cost is linear in the number of channels.
+    radius: float
+        Radius of the neighbourhoods of the 'local' mode, in the units of the channel locations (default 100)
+    eps: float
+        Regularization added to the eigenvalues of the covariance matrices (default 0)
+    dtype: dtype
+        The dtype of the returned traces. If None, the dtype of the parent recording is maintained. Traces are
+        whitened in float32, unless dtype is a 64-bit type.
+    fraction: float or None
+        If None (default), the covariance matrix is estimated on 50 random snippets of 500 frames. Otherwise, it is
+        estimated on this fraction (between 0 and 1) of the chunks of the recording, scanned in bounded memory
+        (using 'n_jobs' threads).
+    whitening_matrix: np.array, scipy.sparse matrix, or None
+        If given, this (num_channels, num_channels) whitening matrix is used instead of being estimated (e.g. the
+        one returned by get_whitening_matrix())
+    whitening_folder: str or None
+        If given, the whitening matrix is saved in this folder, identified by the recording fingerprint and the
+        estimation parameters, and loaded (instead of being estimated again) by later whitenings of the same data.
+        The channel ids and number of frames are saved with it and checked when loading.
     Returns
     -------
     whitened_recording: WhitenRecording
@@ -81,5 +234,14 @@ def whiten(recording, chunk_size=30000, cache_chunks=False, seed=0):
         recording=recording,
         chunk_size=chunk_size,
         cache_chunks=cache_chunks,
-        seed=seed
+        seed=seed,
+        n_jobs=n_jobs,
+        prefetch_chunks=prefetch_chunks,
+        mode=mode,
+        radius=radius,
+        eps=eps,
+        dtype=dtype,
+        fraction=fraction,
+        whitening_matrix=whitening_matrix,
+        whitening_folder=whitening_folder
     )
@@ -2,6 +2,7 @@ import numpy as np
 import pytest
 from .utils import create_signal_with_known_waveforms
 import spikeextractors as se
+from spiketoolkit.preprocessing import transform_traces
 from spiketoolkit.postprocessing import get_unit_waveforms, get_unit_templates, get_unit_amplitudes, \
     get_unit_max_channels, set_unit_properties_by_max_channel_properties, compute_unit_pca_scores, export_to_phy
 
@@ -54,6 +55,13 @@ def test_waveforms():
     for (w, w_gt) in zip(wav, waveforms):
         assert np.allclose(w, w_gt[:, :3])
 
+    # test batched reads of preprocessed recordings
+    rec_t = transform_traces(rec, scalar=1, offset=0)
+    wav = get_unit_waveforms(rec_t, sort, ms_before=ms_cut, ms_after=ms_cut, save_as_features=False)
+
+    for (w, w_gt) in zip(wav, waveforms):
+        assert np.allclose(w, w_gt)
+
 
 @pytest.mark.implemented
 def test_templates():
@@ -1,10 +1,16 @@
 import numpy as np
+import pickle
+from concurrent.futures import ThreadPoolExecutor
 import spikeextractors as se
 import pytest
+import scipy.signal as ss
 from spiketoolkit.tests.utils import check_signal_power_signal1_below_signal2
+from spiketoolkit.preprocessing.preprocessing_tools import _imap_windows, _quantiles_cache
 from spiketoolkit.preprocessing import bandpass_filter, blank_saturation, clip_traces, common_reference, \
     normalize_by_quantile, notch_filter, rectify, remove_artifacts, remove_bad_channels, resample, transform_traces, \
-    whiten
+    whiten, lfp, get_traces_multi, get_recording_fingerprint, FilteredChunkCache, Pipeline, \
+    StreamingPipeline, get_covariance, get_quantiles, get_random_data_chunks, QuantileSketch, detect_bad_channels, \
+    get_psd
 
 
 @pytest.mark.implemented
@@ -42,19 +48,395 @@ def test_bandpass_filter_with_cache():
     
     rec_filtered3 = bandpass_filter(rec, freq_min=5000, freq_max=10000, cache_chunks=True, chunk_size=10000)
     rec_filtered3.get_traces()
-    assert rec_filtered3._filtered_cache_chunks.get('0') is not None
+    assert rec_filtered3._filtered_cache_chunks.get(rec_filtered3._get_chunk_code(0)) is not None
     
     rec_filtered4 = bandpass_filter(rec, freq_min=5000, freq_max=10000, cache_chunks=True, chunk_size=None)
     
     assert np.allclose(rec_filtered.get_traces(), rec_filtered2.get_traces(), rtol=1e-02, atol=1e-02)
     assert np.allclose(rec_filtered.get_traces(), rec_filtered3.get_traces(), rtol=1e-02, atol=1e-02)
     assert np.allclose(rec_filtered.get_traces(), rec_filtered4.get_traces(), rtol=1e-02, atol=1e-02)
+
+
+@pytest.mark.implemented
+def test_filtered_chunk_cache():
+    rec, sort = se.example_datasets.toy_example(duration=10, num_channels=4)
+
+    chunk_size = 30000
+    chunk_bytes = 4 * chunk_size * 8
+    cache = FilteredChunkCache(max_bytes=3 * chunk_bytes)
+    rec_f1 = bandpass_filter(rec, freq_min=300, freq_max=6000, chunk_size=chunk_size, cache_chunks=cache)
+    rec_f2 = notch_filter(rec_f1, freq=3000, chunk_size=chunk_size, cache_chunks=cache)
+    assert rec_f1._filtered_cache_chunks is rec_f2._filtered_cache_chunks
+
+    traces = rec_f1.get_traces(start_frame=0, end_frame=2 * chunk_size)
+    assert cache.get_stats()['misses'] == 2
+    assert np.array_equal(traces, rec_f1.get_traces(start_frame=0, end_frame=2 * chunk_size))
+    assert cache.get_stats()['hits'] == 2
+
+    # the two filters do not share chunks, and the least recently used chunk is evicted first
+    rec_f2.get_traces(start_frame=0, end_frame=chunk_size)
+    assert cache.get_stats()['num_chunks'] == 3
+    rec_f1.get_traces(start_frame=0, end_frame=chunk_size)
+    rec_f1.get_traces(start_frame=2 * chunk_size, end_frame=3 * chunk_size)
+    stats = cache.get_stats()
+    assert stats['num_chunks'] == 3
+    assert stats['evictions'] == 1
+    assert stats['total_bytes'] <= stats['max_bytes']
+    assert cache.get(rec_f1._get_chunk_code(1)) is None
+    assert cache.get(rec_f1._get_chunk_code(0)) is not None
+
+
+@pytest.mark.implemented
+def test_filtered_chunk_disk_cache(tmp_path):
+    rec, sort = se.example_datasets.toy_example(duration=10, num_channels=4)
+    rec2, sort2 = se.example_datasets.toy_example(duration=10, num_channels=4, seed=1)
+    assert get_recording_fingerprint(rec) == get_recording_fingerprint(rec)
+    assert get_recording_fingerprint(rec) != get_recording_fingerprint(rec2)
+    # the data of in-memory recordings is hashed, not only the sampled windows
+    traces_scaled = rec.get_traces()
+    traces_scaled[:, 1000:60000] *= 50
+    rec_scaled = se.NumpyRecordingExtractor(traces_scaled, sampling_frequency=rec.get_sampling_frequency())
+    assert get_recording_fingerprint(rec_scaled) != get_recording_fingerprint(rec)
+    # runtime state (e.g. the scratch buffers of a pipeline) does not change the fingerprint
+    rec_pipe = Pipeline(rec, stages=['BandpassFilter', 'CommonReference'])
+    fingerprint = get_recording_fingerprint(rec_pipe)
+    rec_pipe.get_traces(start_frame=0, end_frame=50000)
+    assert get_recording_fingerprint(rec_pipe) == fingerprint
+
+    rec_f = bandpass_filter(rec, freq_min=300, freq_max=6000, chunk_size=30000, cache_folder=tmp_path)
+    traces = rec_f.get_traces(start_frame=10000, end_frame=70000)
+    assert rec_f._filtered_cache_chunks.get_stats()['num_chunks'] == 3
+    assert len(list(tmp_path.iterdir())) == 2
+
+    # same recording and filter: chunks are reused from disk
+    rec_f_reload = bandpass_filter(rec, freq_min=300, freq_max=6000, chunk_size=30000, cache_folder=tmp_path)
+    assert rec_f_reload._filtered_cache_chunks.get_filename() == rec_f._filtered_cache_chunks.get_filename()
+    assert np.allclose(rec_f_reload.get_traces(start_frame=10000, end_frame=70000), traces)
+    assert rec_f_reload._filtered_cache_chunks.get_stats()['misses'] == 0
+
+    # other parameters or recordings use another file
+    rec_f_other = bandpass_filter(rec, freq_min=500, freq_max=6000, chunk_size=30000, cache_folder=tmp_path)
+    rec_f_other2 = bandpass_filter(rec2, freq_min=300, freq_max=6000, chunk_size=30000, cache_folder=tmp_path)
+    assert rec_f_other._filtered_cache_chunks.get_filename() != rec_f._filtered_cache_chunks.get_filename()
+    assert rec_f_other2._filtered_cache_chunks.get_filename() != rec_f._filtered_cache_chunks.get_filename()
+
+    rec_f_mem = bandpass_filter(rec, freq_min=300, freq_max=6000, chunk_size=30000)
+    assert np.allclose(rec_f_mem.get_traces(start_frame=10000, end_frame=70000), traces, atol=1e-3)
+
+    # lazy chains differing outside of the sampled windows use another file
+    rec_a = bandpass_filter(remove_artifacts(rec, [30000]), chunk_size=30000, cache_folder=tmp_path)
+    rec_b = bandpass_filter(remove_artifacts(rec, [200000]), chunk_size=30000, cache_folder=tmp_path)
+    assert rec_a._filtered_cache_chunks.get_filename() != rec_b._filtered_cache_chunks.get_filename()
+    rec_a.get_traces()
+    assert np.allclose(rec_b.get_traces(), bandpass_filter(remove_artifacts(rec, [200000])).get_traces(), atol=1e-3)
+
+    # chunks are cached in the filter dtype
+    assert rec_f._filtered_cache_chunks._chunks.dtype == np.float64
+    rec_f32 = bandpass_filter(rec, freq_min=300, freq_max=6000, chunk_size=30000, cache_folder=tmp_path,
+                              dtype='float32')
+    assert rec_f32._filtered_cache_chunks._chunks.dtype == np.float32
+    assert rec_f32._filtered_cache_chunks.get_filename() != rec_f._filtered_cache_chunks.get_filename()
+
+    # the files are opened again after pickling
+    rec_p = pickle.loads(pickle.dumps(rec_f))
+    assert isinstance(rec_p._filtered_cache_chunks._chunks, np.memmap)
+    assert np.allclose(rec_p.get_traces(start_frame=10000, end_frame=70000), traces)
+
+
+@pytest.mark.implemented
+def test_filter_parallel_chunks():
+    rec, sort = se.example_datasets.toy_example(duration=10, num_channels=4)
+
+    rec_f = bandpass_filter(rec, freq_min=300, freq_max=6000, type='butter', chunk_size=30000)
+    rec_f_par = bandpass_filter(rec, freq_min=300, freq_max=6000, type='butter', chunk_size=30000, n_jobs=4,
+                                prefetch_chunks=2)
+    traces = rec_f.get_traces()
+    assert np.array_equal(rec_f_par.get_traces(), traces)
+
+    # sequential reads use the chunks computed ahead
+    for start_frame in range(0, rec.get_num_frames(), 30000):
+        traces_chunk = rec_f_par.get_traces(start_frame=start_frame, end_frame=start_frame + 30000)
+        assert np.array_equal(traces_chunk, traces[:, start_frame:start_frame + 30000])
+        assert len(rec_f_par._prefetched_chunks) <= 2
+    assert len(rec_f_par._prefetched_chunks) == 0
+
+    # chunks are yielded in order as they are filtered, with at most 2 * n_jobs chunks in flight
+    rec_f_small = bandpass_filter(rec, freq_min=300, freq_max=6000, type='butter', chunk_size=3000, n_jobs=2)
+    started = []
+    filter_chunk = rec_f_small._get_filtered_chunk
+    rec_f_small._get_filtered_chunk = lambda ind, channel_ids=None: started.append(ind) or filter_chunk(ind,
+                                                                                                     channel_ids)
+    for i, chunk in enumerate(rec_f_small._iter_filtered_chunks(list(range(100)))):
+        assert np.allclose(chunk, traces[:, i * 3000:(i + 1) * 3000], atol=1e-2)
+        assert len(started) <= i + 4
+    assert sorted(started) == list(range(100))
+
+    rec_n_par = notch_filter(rec, freq=3000, chunk_size=30000, n_jobs=2, cache_chunks=True)
+    assert np.array_equal(rec_n_par.get_traces(), notch_filter(rec, freq=3000, chunk_size=30000).get_traces())
+
+    # threads are shut down, and started again if needed
+    rec_f_par.close()
+    assert rec_f_par._executor is None
+    assert np.array_equal(rec_f_par.get_traces(), traces)
+    rec_f_par.close()
+
+    # caches are pickled without their lock and chunks
+    cache = pickle.loads(pickle.dumps(rec_n_par._filtered_cache_chunks))
+    assert cache.get_stats()['num_chunks'] == 0
+    cache.add((0, 0), traces[:, :100])
+    assert np.array_equal(cache.get((0, 0)), traces[:, :100])
+
+
+@pytest.mark.implemented
+def test_bandpass_filter_fft_kernels():
+    rec, sort = se.example_datasets.toy_example(duration=10, num_channels=4)
+
+    rec_f = bandpass_filter(rec, freq_min=300, freq_max=6000, type='fft', chunk_size=30000)
+    traces = rec_f.get_traces()
+    # one kernel per padded chunk length
+    assert len(rec_f._kernels) <= 2
+
+    rec_f_workers = bandpass_filter(rec, freq_min=300, freq_max=6000, type='fft', chunk_size=30000, fft_workers=2)
+    assert np.allclose(rec_f_workers.get_traces(), traces)
+
+    chunk = rec.get_traces(start_frame=0, end_frame=12345).astype('float32')
+    filtered_32 = rec_f._do_filter(chunk)
+    assert filtered_32.dtype == np.float32
+    assert filtered_32.shape == chunk.shape
+    assert np.allclose(filtered_32, rec_f._do_filter(chunk.astype('float64')), atol=1e-3)
+
+
+@pytest.mark.implemented
+def test_sos_filters_dtype():
+    rec, sort = se.example_datasets.toy_example(duration=10, num_channels=4)
+    fn = rec.get_sampling_frequency() / 2
+    traces_ref = ss.sosfiltfilt(ss.butter(3, np.array([300, 6000]) / fn, btype='bandpass', output='sos'),
+                                rec.get_traces(), axis=1)
+
+    rec_f = bandpass_filter(rec, freq_min=300, freq_max=6000, type='butter', chunk_size=30000)
+    # padding from the impulse response of the filter
+    assert 0 < rec_f._padding < 3000
+    assert rec_f.get_dtype() == rec.get_traces().dtype
+    # chunks are zero-padded at the edges of the recording
+    assert np.allclose(rec_f.get_traces()[:, 1000:-1000], traces_ref[:, 1000:-1000], atol=1e-2)
+
+    rec_f32 = bandpass_filter(rec, freq_min=300, freq_max=6000, type='butter', chunk_size=30000, dtype='float32')
+    traces_f32 = rec_f32.get_traces()
+    assert rec_f32.get_dtype() == np.float32
+    assert traces_f32.dtype == np.float32
+    assert rec_f32.get_traces(start_frame=100, end_frame=200).dtype == np.float32
+    assert np.allclose(traces_f32[:, 1000:-1000], traces_ref[:, 1000:-1000], atol=1e-2)
+
+    rec_n = notch_filter(rec, freq=60, q=30, dtype='float32')
+    # narrow notch filters ring longer
+    assert rec_n._padding > rec_f._padding
+    assert rec_n.get_traces().dtype == np.float32
+
+
+@pytest.mark.implemented
+def test_causal_filters():
+    rec, sort = se.example_datasets.toy_example(duration=10, num_channels=4)
+    fn = rec.get_sampling_frequency() / 2
+    traces_ref = ss.sosfilt(ss.butter(3, np.array([300, 6000]) / fn, btype='bandpass', output='sos'),
+                            rec.get_traces(), axis=1)
+
+    rec_f = bandpass_filter(rec, freq_min=300, freq_max=6000, type='butter', chunk_size=30000, causal=True)
+    # each chunk warms up the filter on the padding
+    traces_f = rec_f.get_traces()
+    assert np.allclose(traces_f, traces_ref, atol=1e-2)
+    # the output does not depend on the read order nor on the number of threads
+    for n_jobs in [1, 4, 4]:
+        rec_f_par = bandpass_filter(rec, freq_min=300, freq_max=6000, type='butter', chunk_size=30000, causal=True,
+                                    n_jobs=n_jobs, prefetch_chunks=1)
+        rec_f_par.get_traces(start_frame=60000, end_frame=90000)
+        assert np.array_equal(rec_f_par.get_traces(), traces_f)
+    rec_f = bandpass_filter(rec, freq_min=300, freq_max=6000, type='butter', chunk_size=30000, causal=True)
+    assert np.allclose(rec_f.get_traces(start_frame=95000, end_frame=125000), traces_ref[:, 95000:125000],
+                       atol=1e-2)
+    assert np.allclose(rec_f.get_traces(start_frame=150000, end_frame=150100), traces_ref[:, 150000:150100],
+                       atol=1e-2)
+
+    rec_pipe = Pipeline(rec, stages=[('BandpassFilter', {'type': 'butter', 'causal': True}),
+                                     ('NotchFilter', {'freq': 3000, 'q': 10, 'causal': True})])
+    rec_chain = notch_filter(bandpass_filter(rec, type='butter', causal=True), freq=3000, q=10, causal=True)
+    assert np.allclose(rec_pipe.get_traces(), rec_chain.get_traces(), atol=1e-2)
+
+    with pytest.raises(ValueError):
+        bandpass_filter(rec, type='fft', causal=True)
+
+
+@pytest.mark.implemented
+def test_pickle_filters():
+    rec, sort = se.example_datasets.toy_example(duration=10, num_channels=4, seed=0)
+
+    recs = [bandpass_filter(rec, n_jobs=2, prefetch_chunks=1), bandpass_filter(rec, type='butter', causal=True),
+            notch_filter(rec, freq=3000, cache_chunks=True, causal=True), whiten(rec, n_jobs=2),
+            lfp(rec, cache_chunks=True)]
+    for rec_f in recs:
+        traces = rec_f.get_traces(start_frame=1000, end_frame=20000)
+        rec_p = pickle.loads(pickle.dumps(rec_f))
+        assert np.allclose(rec_p.get_traces(start_frame=1000, end_frame=20000), traces)
+        # after unpickling, threads and locks are created again
+        assert np.allclose(rec_p.get_traces(start_frame=1000, end_frame=20000), traces)
+        pickle.dumps(rec_p)
+
+
+@pytest.mark.implemented
+def test_bandpass_filter_short_traces():
+    rec, sort = se.example_datasets.toy_example(duration=10, num_channels=4)
+
+    for filter_type in ['fft', 'butter']:
+        rec_f = bandpass_filter(rec, freq_min=300, freq_max=6000, type=filter_type, chunk_size=30000)
+        traces = rec_f.get_traces()
+        # short requests are filtered directly, long ones chunk by chunk
+        for (start_frame, end_frame) in [(0, 100), (29950, 30050), (150000, 150180), (299900, 300000)]:
+            assert rec_f._use_direct_filtering(start_frame, end_frame)
+            traces_short = rec_f.get_traces(start_frame=start_frame, end_frame=end_frame)
+            assert traces_short.shape == (4, end_frame - start_frame)
+            assert np.allclose(traces_short, traces[:, start_frame:end_frame], rtol=1e-02, atol=1e-02)
+        assert not rec_f._use_direct_filtering(0, 30000)
+
+        traces_chan = rec_f.get_traces(channel_ids=[2, 0], start_frame=1000, end_frame=1200)
+        assert np.allclose(traces_chan, traces[[2, 0], 1000:1200], rtol=1e-02, atol=1e-02)
     
     
     
 
 
 
+@pytest.mark.implemented
+def test_filter_channel_subset():
+    rec, sort = se.example_datasets.toy_example(duration=10, num_channels=4)
+
+    for rec_f in [bandpass_filter(rec, freq_min=300, freq_max=6000, type='butter', chunk_size=30000),
+                  bandpass_filter(rec, freq_min=300, freq_max=6000, type='fft', chunk_size=30000),
+                  notch_filter(rec, freq=3000, chunk_size=30000)]:
+        assert rec_f._get_dependent_channel_ids([3, 1]) == [3, 1]
+        traces = rec_f.get_traces(start_frame=20000, end_frame=100000)
+        traces_sub = rec_f.get_traces(channel_ids=[3, 1], start_frame=20000, end_frame=100000)
+        assert np.allclose(traces_sub, traces[[3, 1]])
+
+    rec_w = whiten(rec)
+    assert rec_w._get_dependent_channel_ids([1]) == rec.get_channel_ids()
+    assert np.allclose(rec_w.get_traces(channel_ids=[2, 0]), rec_w.get_traces()[[2, 0]])
+
+    rec_cmr = common_reference(rec, groups=[[0, 1], [2, 3]])
+    assert rec_cmr._get_dependent_channel_ids([1]) == [0, 1]
+    rec_sin = common_reference(rec, reference='single', ref_channels=[0, 2], groups=[[0, 1], [2, 3]])
+    assert rec_sin._get_dependent_channel_ids([3]) == [2, 3]
+
+
+@pytest.mark.implemented
+def test_get_traces_multi():
+    rec, sort = se.example_datasets.toy_example(duration=10, num_channels=4)
+    rec_f = bandpass_filter(rec, freq_min=300, freq_max=6000, type='butter', chunk_size=30000)
+    traces = rec_f.get_traces()
+    num_frames = rec_f.get_num_frames()
+
+    windows = [(5000, 5100), (-50, 50), (100000, 100300), (5050, 5200), (num_frames - 20, num_frames + 40),
+               (200000, 200100), (num_frames + 10, num_frames + 30)]
+    traces_list = rec_f.get_traces_multi(windows, channel_ids=[3, 1])
+    assert len(traces_list) == len(windows)
+    for (start_frame, end_frame), traces_w in zip(windows, traces_list):
+        assert traces_w.shape == (2, end_frame - start_frame)
+        traces_gt = np.zeros((4, end_frame - start_frame))
+        valid_start = max(start_frame, 0)
+        valid_end = min(end_frame, num_frames)
+        if valid_end > valid_start:
+            traces_gt[:, valid_start - start_frame:valid_end - start_frame] = traces[:, valid_start:valid_end]
+        assert np.allclose(traces_w, traces_gt[[3, 1]], rtol=1e-02, atol=1e-02)
+
+    # any recording extractor can be read with the function
+    traces_list = get_traces_multi(rec, windows)
+    assert np.array_equal(traces_list[0], rec.get_traces(start_frame=5000, end_frame=5100))
+    assert len(get_traces_multi(rec, [])) == 0
+
+
+@pytest.mark.implemented
+def test_get_quantiles():
+    rec, sort = se.example_datasets.toy_example(duration=10, num_channels=4, seed=0)
+    traces = rec.get_traces()
+    q = [0.001, 0.01, 0.5, 0.99, 0.999]
+
+    # exact while the sketch holds all the values, then approximate
+    sketch = QuantileSketch(num_channels=4, sketch_size=10 ** 6)
+    sketch.update(traces[:, :10000])
+    assert np.allclose(sketch.get_quantiles(q), np.quantile(traces[:, :10000], q, axis=1).T)
+    sketch = QuantileSketch(num_channels=4, sketch_size=2048)
+    other = QuantileSketch(num_channels=4, sketch_size=2048, seed=1)
+    sketch.update(traces[:, :100000])
+    other.update(traces[:, 100000:])
+    sketch.merge(other)
+    assert sketch.num_values == traces.shape[1]
+    assert np.sum([level.shape[1] for level in sketch._levels]) < 2048 * 20
+
+    def _get_rank_errors(quantiles, values):
+        # fraction of the values below the estimated quantiles, minus the quantiles
+        return np.array([np.mean(values[i][:, None] < quantiles[i], axis=0) - q for i in range(len(quantiles))])
+
+    assert np.max(np.abs(_get_rank_errors(sketch.get_quantiles(q), traces))) < 0.005
+
+    # random chunks are the same in parallel
+    data = get_random_data_chunks(rec, seed=2)
+    assert data.shape == (4, 50 * 500)
+    assert np.array_equal(data, get_random_data_chunks(rec, seed=2, n_jobs=4))
+
+    q_global = get_quantiles(rec, q, fraction=1, chunk_size=10000, seed=0, use_cache=False)
+    assert q_global.shape == (len(q),)
+    assert np.max(np.abs(_get_rank_errors([q_global], [traces.ravel()]))) < 0.005
+    q_channels = get_quantiles(rec, q, per_channel=True, fraction=1, chunk_size=10000, n_jobs=4, use_cache=False)
+    assert q_channels.shape == (4, len(q))
+    assert np.max(np.abs(_get_rank_errors(q_channels, traces))) < 0.005
+    # deterministic, and cached
+    assert np.array_equal(q_channels, get_quantiles(rec, q, per_channel=True, fraction=1, chunk_size=10000,
+                                                    use_cache=False))
+    assert np.array_equal(q_channels, get_quantiles(rec, q, per_channel=True, fraction=1, chunk_size=10000))
+    assert np.array_equal(q_channels, get_quantiles(rec, q, per_channel=True, fraction=1, chunk_size=10000))
+    assert np.ndim(get_quantiles(rec, 0.5)) == 0
+
+    # the cache is keyed by recording object: recordings differing outside of any sampled frames are not mixed up
+    traces_scaled = traces.copy()
+    traces_scaled[:, 1000:60000] *= 50
+    rec_a = se.NumpyRecordingExtractor(traces, sampling_frequency=rec.get_sampling_frequency())
+    rec_b = se.NumpyRecordingExtractor(traces_scaled, sampling_frequency=rec.get_sampling_frequency())
+    q_a = get_quantiles(rec_a, [0.01, 0.99], fraction=1, chunk_size=10000)
+    q_b = get_quantiles(rec_b, [0.01, 0.99], fraction=1, chunk_size=10000)
+    assert np.array_equal(q_b, get_quantiles(rec_b, [0.01, 0.99], fraction=1, chunk_size=10000, use_cache=False))
+    assert not np.allclose(q_a, q_b)
+    for seed in range(100):
+        get_quantiles(rec_a, 0.5, chunk_size=100, num_chunks=2, seed=seed)
+    assert len(_quantiles_cache) <= 64
+
+    # chunks are reduced as they arrive, with a bounded number of chunks in flight
+    started = []
+    results = _imap_windows(lambda i: started.append(i) or i, range(100), n_jobs=4)
+    for i, result in enumerate(results):
+        assert result == i
+        assert len(started) <= i + 1 + 8
+
+
+@pytest.mark.implemented
+def test_get_psd():
+    rec, sort = se.example_datasets.toy_example(duration=10, num_channels=4, seed=0)
+    traces = rec.get_traces()
+    fs = rec.get_sampling_frequency()
+
+    # same as scipy on the whole recording, whatever the chunks
+    freqs, psd = get_psd(rec, nperseg=1024, chunk_size=7000, n_jobs=3)
+    freqs_gt, psd_gt = ss.welch(traces, fs=fs, nperseg=1024, axis=1)
+    assert psd.shape == (513, 4)
+    assert np.allclose(freqs, freqs_gt)
+    assert np.allclose(psd, psd_gt.T)
+    freqs, psd = get_psd(rec, nperseg=501, noverlap=100, scaling='spectrum', channel_ids=[3, 1])
+    freqs_gt, psd_gt = ss.welch(traces[[3, 1]], fs=fs, nperseg=501, noverlap=100, scaling='spectrum', axis=1)
+    assert np.allclose(psd, psd_gt.T)
+
+    # on a fraction of the recording
+    freqs, psd = get_psd(rec, nperseg=1024, fraction=0.2, n_jobs=2)
+    freqs_gt, psd_gt = ss.welch(traces, fs=fs, nperseg=1024, axis=1)
+    assert np.allclose(np.sum(psd, axis=0), np.sum(psd_gt, axis=1), rtol=0.3)
+
+
 @pytest.mark.implemented
 def test_blank_saturation():
     rec, sort = se.example_datasets.toy_example(duration=10, num_channels=4)
@@ -65,6 +447,23 @@ def test_blank_saturation():
 
     assert np.all(rec_bs.get_traces()[index_below_threshold] < threshold)
 
+    # the parent traces are not modified
+    traces = rec.get_traces()
+    traces[:, 1000:1100] = 1000
+    rec_sat = se.NumpyRecordingExtractor(traces, sampling_frequency=rec.get_sampling_frequency())
+    rec_bs = blank_saturation(rec_sat, threshold=500)
+    traces_bs = rec_bs.get_traces()
+    assert np.all(traces_bs[:, 1000:1100] < 500)
+    assert np.all(rec_sat.get_traces()[:, 1000:1100] == 1000)
+
+    # saturated intervals
+    rec_bs_scan = blank_saturation(rec_sat, threshold=500, scan=True, chunk_size=1050, n_jobs=2)
+    assert np.array_equal(rec_bs_scan.get_traces(), traces_bs)
+    assert np.array_equal(rec_bs_scan.get_traces(channel_ids=[2], start_frame=1050, end_frame=2000),
+                          traces_bs[[2], 1050:2000])
+    assert rec_bs_scan.get_saturation_intervals(0).tolist() == [[1000, 1100]]
+    assert np.array_equal(rec_bs_scan.is_saturated([999, 1000, 1099, 1100], 0), [False, True, True, False])
+
 
 @pytest.mark.implemented
 def test_clip_traces():
@@ -115,10 +514,78 @@ def test_common_reference():
     assert np.allclose(rec_sin_g.get_traces()[3], traces[3] - traces[2])
     assert 'int16' in str(rec_cmr_int16_g.get_dtype())
 
+    # reference channels in another group are subtracted before being re-referenced
+    rec_sin_x = common_reference(rec, reference='single', ref_channels=[2, 0], groups=groups, dtype='float64')
+    traces_sin_x = rec_sin_x.get_traces()
+    assert np.allclose(traces_sin_x[:2], traces[:2] - traces[2])
+    assert np.allclose(traces_sin_x[2:], traces[2:] - traces[0])
+    rec_pipe = Pipeline(rec, stages=[('CommonReference', {'reference': 'single', 'ref_channels': [2, 0],
+                                                          'groups': groups})], dtype='float64')
+    assert np.allclose(rec_pipe.get_traces(), traces_sin_x)
 
-@pytest.mark.notimplemented
+    # channel subsets are returned in the requested order, also with channel ids that are not indices
+    rec_ids = se.SubRecordingExtractor(rec, renamed_channel_ids=[10, 11, 12, 13])
+    rec_cmr_g = common_reference(rec_ids, reference='median', groups=[[10, 12], [11, 13]])
+    rec_sin_g = common_reference(rec_ids, reference='single', ref_channels=[10, 11], groups=[[10, 12], [11, 13]])
+    traces_cmr_g = rec_cmr_g.get_traces()
+    assert np.allclose(traces_cmr_g[[0, 2]], traces[[0, 2]] - np.median(traces[[0, 2]], axis=0, keepdims=True))
+    assert np.allclose(rec_cmr_g.get_traces(channel_ids=[13, 10]), traces_cmr_g[[3, 0]])
+    assert np.allclose(rec_cmr_g.get_traces(channel_ids=[12], start_frame=100, end_frame=200),
+                       traces_cmr_g[[2], 100:200])
+    assert np.allclose(rec_sin_g.get_traces(channel_ids=[13, 12]), traces[[3, 2]] - traces[[1, 0]])
+
+    # int16 traces
+    traces_int16 = (traces * 10).astype('int16')
+    rec_int16 = se.NumpyRecordingExtractor(traces_int16, sampling_frequency=rec.get_sampling_frequency())
+    traces_cmr = traces_int16 - np.median(traces_int16, axis=0, keepdims=True)
+    rec_cmr = common_reference(rec_int16, reference='median')
+    rec_cmr_f32 = common_reference(rec_int16, reference='median', dtype='float32')
+    assert rec_cmr.get_traces().dtype == np.int16
+    assert np.array_equal(rec_cmr.get_traces(), traces_cmr.astype('int16'))
+    assert rec_cmr_f32.get_traces().dtype == np.float32
+    assert np.allclose(rec_cmr_f32.get_traces(), traces_cmr)
+
+    # local reference: channels are 1 um apart, so the annulus contains the adjacent channels
+    rec_loc = common_reference(rec, reference='local', local_radius=(0.5, 1.5))
+    traces_loc = rec_loc.get_traces()
+    assert np.allclose(traces_loc[0], traces[0] - traces[1])
+    assert np.allclose(traces_loc[2], traces[2] - np.median(traces[[1, 3]], axis=0))
+    assert np.allclose(rec_loc.get_traces(channel_ids=[2, 1], start_frame=10, end_frame=50), traces_loc[[2, 1], 10:50])
+    rec_loc = common_reference(rec, reference='local', local_radius=(1.5, 3.5))
+    assert np.allclose(rec_loc.get_traces()[0], traces[0] - np.median(traces[[2, 3]], axis=0))
+    rec_loc_g = common_reference(rec, reference='local', local_radius=(0.5, 1.5), groups=[[0, 1], [2, 3]])
+    assert np.allclose(rec_loc_g.get_traces()[2], traces[2] - traces[3])
+
+
+@pytest.mark.implemented
 def test_norm_by_quantile():
-    pass
+    rec, sort = se.example_datasets.toy_example(duration=10, num_channels=4, seed=0)
+
+    rec_n = normalize_by_quantile(rec, scale=2., median=1., q1=0.05, q2=0.95, seed=0)
+    traces = rec_n.get_traces()
+    q = np.quantile(traces, [0.05, 0.5, 0.95])
+    assert np.isclose(q[1], 1., atol=0.1)
+    assert np.isclose(q[2] - q[0], 2., rtol=0.1)
+
+    assert traces.dtype == np.float32
+    rec_n2 = normalize_by_quantile(rec, scale=2., median=1., q1=0.05, q2=0.95, seed=0, fraction=0.5, n_jobs=2)
+    assert np.allclose(rec_n2.get_traces(), traces, rtol=0.1, atol=0.1)
+
+    # per channel
+    gains = np.array([1., 10., 0.5, 3.])
+    rec_gains = se.NumpyRecordingExtractor(rec.get_traces() * gains[:, None],
+                                           sampling_frequency=rec.get_sampling_frequency())
+    rec_c = normalize_by_quantile(rec_gains, scale=2., median=1., q1=0.05, q2=0.95, mode='per_channel',
+                                  dtype='float64')
+    traces_c = rec_c.get_traces()
+    assert traces_c.dtype == np.float64
+    q = np.quantile(traces_c, [0.05, 0.5, 0.95], axis=1)
+    assert np.allclose(q[1], 1., atol=0.1)
+    assert np.allclose(q[2] - q[0], 2., rtol=0.1)
+    scalar, offset = rec_c.get_scalar_offset()
+    assert np.allclose(scalar * gains, scalar[0] * gains[0], rtol=0.1)
+    assert np.allclose(rec_c.get_traces(channel_ids=[3, 1], start_frame=100, end_frame=200),
+                       traces_c[[3, 1], 100:200])
 
 
 @pytest.mark.implemented
@@ -130,6 +597,14 @@ def test_notch_filter():
     assert check_signal_power_signal1_below_signal2(rec_n.get_traces(), rec.get_traces(), freq_range=[2900, 3100],
                                                     fs=rec.get_sampling_frequency())
 
+    # line noise detection
+    fs = rec.get_sampling_frequency()
+    for line_frequency in [50, 60]:
+        line_noise = 20 * np.sin(2 * np.pi * line_frequency * np.arange(rec.get_num_frames()) / fs)
+        rec_line = se.NumpyRecordingExtractor(rec.get_traces() + line_noise, sampling_frequency=fs)
+        rec_n = notch_filter(rec_line, 'line', q=10)
+        assert rec_n._freq == line_frequency
+
 
 @pytest.mark.implemented
 def test_rectify():
@@ -157,6 +632,40 @@ def test_remove_artifacts():
     assert not np.any(traces_all_1)
     assert not np.any(traces_short_0)
     assert not np.any(traces_short_1)
+    # triggers at the first requested frame and windows of triggers before it
+    assert not np.any(rec_rmart.get_traces(start_frame=triggers[0], end_frame=triggers[0] + 10))
+    assert not np.any(rec_rmart.get_traces(start_frame=triggers[0] + 10, end_frame=triggers[0] + ms_frames))
+    assert np.all(rec_rmart.get_traces(start_frame=triggers[0] + ms_frames, end_frame=triggers[0] + 2 * ms_frames))
+
+    # the traces of a parent returning views are not modified
+    class ViewRecording(se.NumpyRecordingExtractor):
+        def get_traces(self, channel_ids=None, start_frame=None, end_frame=None):
+            return self._timeseries[:, start_frame:end_frame]
+
+    timeseries = rec.get_traces()
+    rec_view = ViewRecording(timeseries.copy(), sampling_frequency=rec.get_sampling_frequency())
+    assert not np.any(remove_artifacts(rec_view, triggers, ms_before=10, ms_after=10).get_traces(
+        start_frame=triggers[0] - 10, end_frame=triggers[0] + 10))
+    assert np.array_equal(rec_view._timeseries, timeseries)
+
+    # median template subtraction
+    traces = rec.get_traces()
+    triggers = np.arange(10000, 290000, 7000)
+    artifact = 100 * np.exp(-np.arange(90) / 20)
+    traces_art = traces.copy()
+    for trig in triggers:
+        traces_art[:, trig - 30:trig + 60] += artifact
+    rec_art = se.NumpyRecordingExtractor(traces_art, sampling_frequency=rec.get_sampling_frequency())
+    rec_rmart_t = remove_artifacts(rec_art, triggers[::-1], ms_before=1, ms_after=2, mode='median_template')
+    template = rec_rmart_t.get_template()
+    assert template.shape == (4, 90)
+    assert np.allclose(template, artifact, atol=10)
+    # exact median up to one batch of triggers, estimated by batches beyond
+    snippets = np.array([traces_art[:, trig - 30:trig + 60] for trig in triggers])
+    assert np.allclose(template, np.median(snippets, axis=0), atol=1e-4)
+    assert np.allclose(rec_rmart_t._compute_template(batch_size=8), template, atol=10)
+    traces_rm = rec_rmart_t.get_traces(start_frame=triggers[3] - 100, end_frame=triggers[3] + 100)
+    assert np.abs(traces_rm - traces[:, triggers[3] - 100:triggers[3] + 100]).max() < 10
 
 
 @pytest.mark.implemented
@@ -181,6 +690,35 @@ def test_remove_bad_channels():
     rec_rm = remove_bad_channels(rec_np, bad_channel_ids=None, bad_threshold=2, seconds=10)
     assert 1 not in rec_rm.get_channel_ids()
 
+    # channel ids (not positions) are removed
+    rec_renamed = se.SubRecordingExtractor(rec_np, renamed_channel_ids=[10, 11, 12, 13])
+    rec_rm = remove_bad_channels(rec_renamed, bad_channel_ids=None, bad_threshold=2)
+    assert rec_rm.get_channel_ids() == [10, 12, 13]
+    assert rec_rm.get_bad_channel_ids() == [11]
+
+    # channels going bad partway through the recording are found in multiple windows
+    np.random.seed(0)
+    common = np.random.randn(300000)
+    timeseries = common + 0.5 * np.random.randn(8, 300000)
+    timeseries[2, 240000:] *= 5  # noisy
+    timeseries[5, 200000:] = 0.5 * np.random.randn(100000)  # disconnected
+    timeseries[6, :30000] += 1.5 * np.sin(2 * np.pi * 13000 * np.arange(30000) / 30000)  # high frequency noise
+    rec_np = se.NumpyRecordingExtractor(timeseries=timeseries, sampling_frequency=30000)
+    rec_rm = remove_bad_channels(rec_np, bad_channel_ids=None, bad_threshold=2, seconds=1)
+    assert rec_rm.get_channel_ids() == list(range(8))
+    rec_rm = remove_bad_channels(rec_np, bad_channel_ids=None, bad_threshold=2, seconds=1, num_windows=10)
+    assert rec_rm.get_bad_channel_ids() == [2]
+    rec_rm = remove_bad_channels(rec_np, bad_channel_ids=None, bad_threshold=2, seconds=1, num_windows=10,
+                                 method='robust', n_jobs=4)
+    assert rec_rm.get_bad_channel_ids() == [2, 5, 6]
+    bad_channel_ids = detect_bad_channels(rec_np, seconds=1, num_windows=10, min_bad_fraction=0.3)
+    assert bad_channel_ids == [5]
+    # opt-in cache, by recording object
+    assert detect_bad_channels(rec_np, seconds=1, num_windows=10, min_bad_fraction=0.3, use_cache=True) == [5]
+    assert detect_bad_channels(rec_np, seconds=1, num_windows=10, min_bad_fraction=0.3, use_cache=True) == [5]
+    rec_np2 = se.NumpyRecordingExtractor(timeseries=np.random.randn(8, 300000), sampling_frequency=30000)
+    assert detect_bad_channels(rec_np2, seconds=1, num_windows=10, min_bad_fraction=0.3, use_cache=True) == []
+
 
 @pytest.mark.implemented
 def test_resample():
@@ -195,6 +733,49 @@ def test_resample():
     assert rec_rsl.get_num_frames() == int(rec.get_num_frames() * 0.1)
     assert rec_rsh.get_num_frames() == int(rec.get_num_frames() * 2)
 
+    # chunked polyphase resampling gives the same frames for any window
+    traces = rec.get_traces()
+    for resample_rate in [2500, 12345.6]:
+        rec_rs = resample(rec, resample_rate, chunk_size=7000)
+        traces_ref = ss.resample_poly(traces, rec_rs._up, rec_rs._down, axis=1)
+        traces_rs = rec_rs.get_traces()
+        assert np.allclose(traces_rs, traces_ref[:, :rec_rs.get_num_frames()])
+        assert np.allclose(rec_rs.get_traces(start_frame=1001, end_frame=1301), traces_rs[:, 1001:1301])
+    rec_rs_fft = resample(rec, resample_rate_low, engine='fft')
+    assert rec_rs_fft.get_traces().shape == (4, rec_rsl.get_num_frames())
+
+
+@pytest.mark.implemented
+def test_lfp():
+    rec, sort = se.example_datasets.toy_example(duration=10, num_channels=4)
+    traces = rec.get_traces()
+
+    rec_lfp = lfp(rec, freq_max=300, lfp_rate=2500, chunk_size=3000)
+    assert rec_lfp.get_sampling_frequency() == 2500
+    assert rec_lfp.get_num_frames() == rec.get_num_frames() // 12
+    traces_lfp = rec_lfp.get_traces()
+    # LFP frames are aligned to the frames of the recording: centered FIR, decimation, then butterworth filter
+    center = (len(rec_lfp._taps) - 1) // 2
+    traces_fir = np.array([np.convolve(trace, rec_lfp._taps)[center:center + len(trace)] for trace in traces])
+    traces_ref = ss.sosfiltfilt(rec_lfp._sos, traces_fir[:, ::12], axis=1)
+    assert np.allclose(traces_lfp[:, 500:-500], traces_ref[:, 500:-500], atol=1e-3)
+    assert np.allclose(rec_lfp.get_traces(channel_ids=[1], start_frame=1001, end_frame=1101),
+                       traces_lfp[[1], 1001:1101], atol=1e-3)
+    assert check_signal_power_signal1_below_signal2(traces_lfp, traces[:, ::12], freq_range=[1000, 1250], fs=2500)
+
+    # the passband is kept
+    fs = rec.get_sampling_frequency()
+    sine = np.tile(np.sin(2 * np.pi * 40 * np.arange(rec.get_num_frames()) / fs), (2, 1))
+    traces_sine = lfp(se.NumpyRecordingExtractor(sine, fs), freq_max=300, lfp_rate=2500).get_traces()
+    assert np.allclose(traces_sine[:, 2000:-2000], sine[:, ::12][:, 2000:-2000], atol=1e-3)
+
+    rec_lfp_bp = lfp(rec, freq_min=1, freq_max=300, lfp_rate=1000, dtype='float32')
+    assert rec_lfp_bp.get_traces().shape == (4, rec.get_num_frames() // 30)
+    assert rec_lfp_bp.get_traces().dtype == np.float32
+
+    with pytest.raises(ValueError):
+        lfp(rec, lfp_rate=2300)
+
 
 @pytest.mark.implemented
 def test_transform_traces():
@@ -207,10 +788,175 @@ def test_transform_traces():
 
     assert np.allclose(rec_t.get_traces(), scalar * rec.get_traces() + offset)
 
+    # per channel scalars
+    scalars = np.array([1, 2, 3, 4])
+    rec_t = transform_traces(rec, scalar=scalars, offset=offset, dtype='float32')
+    traces_t = rec_t.get_traces(channel_ids=[2, 0])
+    assert traces_t.dtype == np.float32
+    assert np.allclose(traces_t, scalars[[2, 0], None] * rec.get_traces(channel_ids=[2, 0]) + offset, atol=1e-3)
+
 
 @pytest.mark.implemented
-def test_whiten():
+def test_elementwise_collapse():
     rec, sort = se.example_datasets.toy_example(duration=10, num_channels=4)
+    traces = rec.get_traces()
+
+    rec_chain = rectify(clip_traces(transform_traces(rec, scalar=2, offset=-1), a_min=[-20, -10, -30, -5], a_max=15))
+    # the chain is a single node reading the original recording
+    assert rec_chain._recording is rec
+    assert [op[0] for op in rec_chain.get_operations()] == ['scale', 'clip', 'abs']
+    traces_gt = np.abs(np.clip(2 * traces - 1, np.array([-20, -10, -30, -5])[:, None], 15))
+    assert np.allclose(rec_chain.get_traces(), traces_gt)
+    assert np.allclose(rec_chain.get_traces(channel_ids=[3, 1], start_frame=10, end_frame=100),
+                       traces_gt[[3, 1], 10:100])
+    # parents are not modified
+    assert np.array_equal(rec.get_traces(), traces)
+
+    # integer traces keep their dtype, unless they are scaled
+    rec_int = se.NumpyRecordingExtractor(traces.astype('int16'), sampling_frequency=rec.get_sampling_frequency())
+    assert rectify(clip_traces(rec_int, a_min=-5)).get_traces().dtype == np.int16
+    assert transform_traces(rectify(rec_int), scalar=0.5).get_traces().dtype == np.float64
+    assert transform_traces(rectify(rec_int), scalar=0.5, dtype='float32').get_traces().dtype == np.float32
+    # parents with an integer dtype are not collapsed
+    rec_round = transform_traces(transform_traces(rec, scalar=0.5, dtype='int16'), scalar=2)
+    assert rec_round._recording is not rec
+    assert np.allclose(rec_round.get_traces(), 2 * (0.5 * traces).astype('int16'))
+    rec_int_clip = transform_traces(rectify(clip_traces(rec_int, a_min=-5.5)), scalar=0.5)
+    assert rec_int_clip._recording is not rec_int
+    traces_int_clip = np.abs(np.clip(traces.astype('int16'), -5.5, None).astype('int16'))
+    assert np.array_equal(rec_int_clip.get_traces(), 0.5 * traces_int_clip)
+
+    rec_pipe = Pipeline(rec, stages=[('TransformTraces', {'scalar': 2, 'offset': -1}),
+                                     ('ClipTraces', {'a_min': -20, 'a_max': 15}), 'Rectify'])
+    assert rec_pipe._fused
+    assert np.allclose(rec_pipe.get_traces(), np.abs(np.clip(2 * traces - 1, -20, 15)))
+
+
+@pytest.mark.implemented
+def test_pipeline():
+    rec, sort = se.example_datasets.toy_example(duration=10, num_channels=4)
+
+    rec_chain = clip_traces(transform_traces(notch_filter(bandpass_filter(rec, freq_min=300, freq_max=6000),
+                                                          freq=3000, q=10), scalar=2, offset=1), a_min=-20, a_max=20)
+    rec_pipe = Pipeline(rec, stages=[('BandpassFilter', {'freq_min': 300, 'freq_max': 6000}),
+                                     ('NotchFilter', {'freq': 3000, 'q': 10}),
+                                     ('TransformTraces', {'scalar': 2, 'offset': 1}),
+                                     ('ClipTraces', {'a_min': -20, 'a_max': 20})], chunk_size=30000)
+    assert rec_pipe._fused
+    assert rec_pipe._padding == sum(stage._padding for stage in rec_pipe.get_stages()[:2])
+    assert rec_pipe.get_num_frames() == rec.get_num_frames()
+    traces_chain = rec_chain.get_traces()
+    assert np.allclose(rec_pipe.get_traces(), traces_chain, atol=1e-2)
+    assert np.allclose(rec_pipe.get_traces(channel_ids=[3, 0], start_frame=1000, end_frame=1500),
+                       traces_chain[[3, 0], 1000:1500], atol=1e-2)
+
+    rec_pipe = Pipeline(rec, stages=['BandpassFilter', 'CommonReference', 'Whiten'])
+    rec_chain = whiten(common_reference(bandpass_filter(rec)))
+    assert np.allclose(rec_pipe.get_traces(), rec_chain.get_traces(), atol=1e-2)
+
+    # chunks are processed in the filter dtype, whitening writes into the second buffer
+    rec_pipe = Pipeline(rec, stages=[('CommonReference', {}), ('Whiten', {'dtype': 'float32'})])
+    rec_chain = whiten(common_reference(rec), dtype='float32')
+    assert np.allclose(rec_pipe.get_traces(), rec_chain.get_traces(), atol=1e-2)
+    buffers = rec_pipe._get_thread_buffers()
+    assert buffers[0].dtype == np.float32
+    assert buffers[1] is not None and buffers[1].dtype == np.float32
+
+    # concurrent reads give the same traces as a sequential read
+    rec_pipe = Pipeline(rec, stages=['BandpassFilter', 'CommonReference', 'Whiten'], chunk_size=3000)
+    windows = [(i, i + 20000) for i in range(0, 280000, 10000)]
+    traces_seq = [rec_pipe.get_traces(start_frame=w[0], end_frame=w[1]) for w in windows]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        traces_conc = list(executor.map(lambda w: rec_pipe.get_traces(start_frame=w[0], end_frame=w[1]), windows))
+    for t_seq, t_conc in zip(traces_seq, traces_conc):
+        assert np.array_equal(t_seq, t_conc)
+    rec_pipe_p = pickle.loads(pickle.dumps(rec_pipe))
+    assert np.array_equal(rec_pipe_p.get_traces(start_frame=0, end_frame=20000), traces_seq[0])
+
+    groups = [[0, 1], [2, 3]]
+    rec_pipe = Pipeline(rec, stages=['BandpassFilter', ('CommonReference', {'groups': groups, 'reference': 'average'})])
+    rec_chain = common_reference(bandpass_filter(rec), groups=groups, reference='average')
+    assert np.allclose(rec_pipe.get_traces(), rec_chain.get_traces(), atol=1e-2)
+
+    # stages that cannot be fused are read through the lazy chain
+    rec_pipe = Pipeline(rec, stages=['BandpassFilter', ('Resample', {'resample_rate': 10000})])
+    assert not rec_pipe._fused
+    assert rec_pipe.get_sampling_frequency() == 10000
+    assert rec_pipe.get_num_frames() == rec.get_num_frames() // 3
+
+    with pytest.raises(ValueError):
+        Pipeline(rec, stages=['NotAPreprocessor'])
+
+
+@pytest.mark.implemented
+def test_streaming_pipeline():
+    rec, sort = se.example_datasets.toy_example(duration=10, num_channels=4)
+    traces = rec.get_traces()
+    fs = rec.get_sampling_frequency()
+    block_sizes = [1000, 30, 25000, 7000, 1]
+
+    def push_blocks(stream):
+        blocks = []
+        pos = 0
+        while pos < traces.shape[1]:
+            for block_size in block_sizes:
+                blocks.append(stream.push(traces[:, pos:pos + block_size]))
+                pos += block_size
+        return np.concatenate(blocks, axis=1)
+
+    W = np.linalg.inv(np.cov(traces))
+    stream = StreamingPipeline([('BandpassFilter', {'freq_min': 300, 'freq_max': 6000}),
+                                ('NotchFilter', {'freq': 3000, 'q': 10}), 'CommonReference',
+                                ('Whiten', {'whitening_matrix': W}), ('ClipTraces', {'a_min': -5, 'a_max': 5})],
+                               num_channels=4, sampling_frequency=fs, dtype='float64')
+    assert stream.get_latency() == 0
+    rec_chain = common_reference(notch_filter(bandpass_filter(rec, type='butter', causal=True), freq=3000, q=10,
+                                              causal=True))
+    traces_stream = push_blocks(stream)
+    assert traces_stream.shape == traces.shape
+    # the lazy chain warms up each chunk on its padding, instead of carrying the filter states
+    assert np.allclose(traces_stream, np.clip(W @ rec_chain.get_traces(), -5, 5), atol=1e-4)
+
+    # sparse whitening matrices of the 'local' mode
+    W_local = whiten(rec, mode='local', radius=1.5).get_whitening_matrix()
+    stream = StreamingPipeline([('Whiten', {'whitening_matrix': W_local})], num_channels=4, sampling_frequency=fs,
+                               dtype='float64')
+    assert np.allclose(push_blocks(stream), W_local @ traces)
+
+    # zero-phase filters are delayed by their padding
+    stream = StreamingPipeline([('BandpassFilter', {'causal': False})], num_channels=4, sampling_frequency=fs)
+    latency = stream.get_latency()
+    assert latency > 0
+    traces_stream = push_blocks(stream)
+    traces_f = bandpass_filter(rec, type='butter').get_traces()
+    assert traces_stream.dtype == np.float32
+    assert np.allclose(traces_stream[:, latency + 1000:], traces_f[:, 1000:-latency], atol=1e-2)
+    assert stream.flush().shape == (4, latency)
+    # samples are filtered by hops, with a bounded buffer
+    stream = StreamingPipeline([('BandpassFilter', {'causal': False, 'hop': 100})], num_channels=4,
+                               sampling_frequency=fs)
+    padding = stream._stages[0]._padding
+    assert stream.get_latency() == padding + 99
+    traces_stream = push_blocks(stream)
+    assert stream._stages[0]._buffer.shape == (4, 2 * padding + 100)
+    latency = stream.get_latency()
+    assert np.allclose(traces_stream[:, latency + 1000:], traces_f[:, 1000:-latency], atol=1e-2)
+
+    # reference channels in another group
+    stream = StreamingPipeline([('CommonReference', {'reference': 'single', 'groups': [[0, 1], [2, 3]],
+                                                     'ref_channels': [2, 0]})],
+                               num_channels=4, sampling_frequency=fs, dtype='float64')
+    rec_ref = common_reference(rec, reference='single', groups=[[0, 1], [2, 3]], ref_channels=[2, 0],
+                               dtype='float64')
+    assert np.allclose(push_blocks(stream), rec_ref.get_traces())
+
+    with pytest.raises(ValueError):
+        StreamingPipeline(['Resample'], num_channels=4, sampling_frequency=fs)
+
+
+@pytest.mark.implemented
+def test_whiten():
+    rec, sort = se.example_datasets.toy_example(duration=10, num_channels=4, seed=0)
     
     rec_w = whiten(rec)
     cov_w = np.cov(rec_w.get_traces())
@@ -221,6 +967,57 @@ def test_whiten():
     rec_w2 = whiten(rec, chunk_size=30000)
     
     assert np.array_equal(rec_w.get_traces(), rec_w2.get_traces())
+
+    # local whitening with neighbourhoods of 3 channels (channels are 1 um apart)
+    rec_wl = whiten(rec, mode='local', radius=1.5, eps=1e-8, dtype='float32')
+    W = rec_wl._whitening_matrix
+    assert W.nnz == 2 + 3 + 3 + 2
+    assert W[0, 3] == 0
+    traces_wl = rec_wl.get_traces()
+    assert traces_wl.dtype == np.float32
+    # each channel is decorrelated from its neighbours
+    cov_wl = np.cov(traces_wl)
+    assert np.allclose(np.diag(cov_wl), 1, atol=0.3)
+    rec_wl_all = whiten(rec, mode='local', radius=10)
+    assert np.allclose(rec_wl_all.get_traces(), rec_w.get_traces())
+
+
+@pytest.mark.implemented
+def test_whitening_matrix(tmp_path):
+    rec, sort = se.example_datasets.toy_example(duration=10, num_channels=4, seed=0)
+    traces = rec.get_traces()
+
+    cov = get_covariance(rec, chunk_size=30000)
+    assert np.allclose(cov, np.cov(traces, bias=True))
+    assert np.allclose(get_covariance(rec, chunk_size=7000, n_jobs=4), cov)
+    assert get_covariance(rec, fraction=0.3).shape == (4, 4)
+
+    rec_w = whiten(rec, fraction=1)
+    assert np.allclose(np.cov(rec_w.get_traces()), np.eye(4), atol=0.1)
+
+    rec_w2 = whiten(rec, whitening_matrix=rec_w.get_whitening_matrix())
+    assert np.array_equal(rec_w2.get_traces(), rec_w.get_traces())
+    with pytest.raises(ValueError):
+        whiten(rec, whitening_matrix=np.eye(3))
+
+    # lists are accepted
+    rec_w2 = whiten(rec, whitening_matrix=rec_w.get_whitening_matrix().tolist())
+    assert np.array_equal(rec_w2.get_traces(), rec_w.get_traces())
+
+    rec_w3 = whiten(rec, fraction=1, mode='local', radius=1.5, whitening_folder=tmp_path)
+    assert len(list(tmp_path.glob('*.npz'))) == 1
+    rec_w4 = whiten(rec, fraction=1, mode='local', radius=1.5, whitening_folder=tmp_path)
+    assert len(list(tmp_path.glob('*.npz'))) == 1
+    assert np.allclose(rec_w4.get_whitening_matrix().toarray(), rec_w3.get_whitening_matrix().toarray())
+    rec_w5 = whiten(rec, fraction=1, whitening_folder=tmp_path)
+    assert len(list(tmp_path.glob('*.npy'))) == 1
+    # a saved matrix is not loaded for a recording with other channels or number of frames
+    info_file = tmp_path / (list(tmp_path.glob('*.npy'))[0].stem + '.json')
+    info_file.write_text(info_file.read_text().replace(str(rec.get_num_frames()), '123'))
+    np.save(str(list(tmp_path.glob('*.npy'))[0]), np.eye(4))
+    rec_w6 = whiten(rec, fraction=1, whitening_folder=tmp_path)
+    assert np.allclose(rec_w6.get_whitening_matrix(), rec_w5.get_whitening_matrix())
+    assert str(rec.get_num_frames()) in info_file.read_text()
     
     
     